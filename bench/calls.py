@@ -0,0 +1,74 @@
+""" Measures non-tail calls: runs a deep non-tail recursion and reports the
+    wall time together with the number of call records allocated per call.
+
+    Usage (from the repository root):
+        python bench/calls.py [depth] [rounds]
+
+    Before the call-info stack, every non-tail call allocated one Dump
+    (1.0 records/call). With the preallocated vm.callinfo array, records are
+    only allocated when the call depth exceeds the deepest one seen so far.
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import __pypy_path__
+from sanya import vm as vm_module
+from sanya.compilation import compile_list_of_expr
+from sanya.parser import parse_string
+from sanya.stdlib import open_lib
+
+PROGRAM = """
+(define count
+  (lambda (n)
+    (if (< n 1)
+      0
+      (+ 1 (count (- n 1))))))
+(define repeat
+  (lambda (i)
+    (if (< 0 i)
+      (begin (count %(depth)d) (repeat (- i 1)))
+      0)))
+(repeat %(rounds)d)
+"""
+
+def main(argv):
+    depth = 1000
+    rounds = 100
+    if len(argv) > 1:
+        depth = int(argv[1])
+    if len(argv) > 2:
+        rounds = int(argv[2])
+
+    counters = {'records': 0, 'calls': 0}
+    record_init = vm_module.CallInfo.__init__
+    save_callinfo = vm_module.VM.save_callinfo
+    def counting_init(self):
+        counters['records'] += 1
+        record_init(self)
+    def counting_save(self):
+        counters['calls'] += 1
+        save_callinfo(self)
+    vm_module.CallInfo.__init__ = counting_init
+    vm_module.VM.save_callinfo = counting_save
+
+    w_skel = compile_list_of_expr(parse_string(
+        PROGRAM % {'depth': depth, 'rounds': rounds}))
+    vm = vm_module.VM()
+    open_lib(vm)
+    vm.bootstrap(w_skel)
+    start = time.time()
+    vm.run()
+    elapsed = time.time() - start
+
+    calls = counters['calls']
+    print 'non-tail calls:    %d' % calls
+    print 'records allocated: %d' % counters['records']
+    print 'records per call:  %.4f' % (float(counters['records']) / calls)
+    print 'time:              %.3fs (%.0f calls/s)' % (elapsed,
+                                                       calls / elapsed)
+
+if __name__ == '__main__':
+    main(sys.argv)
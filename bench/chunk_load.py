@@ -0,0 +1,89 @@
+""" Measures how long compiled chunks take to load and to dump: builds
+    chunks of a given number of instructions, writes them to a file with
+    chunkio.dump and reads them back with chunkio.load. It also reports
+    the time chunkio.open_chunk takes, which only decodes the toplevel
+    skeleton, as when the vm runs a chunk.
+
+    Usage (from the repository root):
+        python bench/chunk_load.py [instructions ...]
+
+    The instructions are those of test-scripts/sum.scm, repeated, with
+    ten skeletons per chunk. They are loaded but not run.
+    Before the chunk was read at once, every integer took four
+    stream.read(1) calls and every byte dumped one stream.write.
+"""
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import __pypy_path__
+from pypy.rlib.streamio import open_file_as_stream
+from sanya import chunkio
+from sanya.closure import W_Skeleton
+from sanya.compilation import compile_list_of_expr
+from sanya.parser import parse_string
+
+SIZES = [1000, 10000, 100000, 1000000]
+NB_SKELETONS = 10
+
+def make_chunk(ninstrs):
+    f = open(os.path.join(ROOT, 'test-scripts', 'sum.scm'))
+    try:
+        source = f.read()
+    finally:
+        f.close()
+    w_model = compile_list_of_expr(parse_string(source))
+    codes = []
+    for w_skel in [w_model] + w_model.skeleton_registry:
+        codes.extend(w_skel.codes)
+    per_skel = ninstrs // (NB_SKELETONS + 1)
+    skels = []
+    for i in xrange(NB_SKELETONS + 1):
+        skel_codes = (codes * (per_skel // len(codes) + 1))[:per_skel]
+        skels.append(W_Skeleton(skel_codes, w_model.consts,
+                w_model.frame_size, [], [], 0, False, False, None))
+    w_root = skels[0]
+    w_root.skeleton_registry = skels[1:]
+    return w_root
+
+def measure(ninstrs, path):
+    w_root = make_chunk(ninstrs)
+    start = time.time()
+    stream = open_file_as_stream(path, 'w')
+    chunkio.dump(w_root, stream)
+    stream.close()
+    dump_time = time.time() - start
+
+    start = time.time()
+    stream = open_file_as_stream(path, 'r')
+    w_loaded = chunkio.load(stream)
+    stream.close()
+    load_time = time.time() - start
+    assert len(w_loaded.skeleton_registry) == NB_SKELETONS
+
+    start = time.time()
+    chunkio.open_chunk(path)
+    open_time = time.time() - start
+    return dump_time, load_time, open_time, os.path.getsize(path)
+
+def main(argv):
+    sizes = [int(arg) for arg in argv[1:]] or SIZES
+    fd, path = tempfile.mkstemp(suffix='.scmc')
+    os.close(fd)
+    try:
+        print '%8s %10s %9s %9s %12s %9s' % ('instrs', 'bytes', 'dump s',
+                'load s', 'instrs/sec', 'open s')
+        for ninstrs in sizes:
+            dump_time, load_time, open_time, nbytes = measure(ninstrs, path)
+            print '%8d %10d %9.3f %9.3f %12.0f %9.3f' % (ninstrs, nbytes,
+                    dump_time, load_time, ninstrs / max(load_time, 1e-9),
+                    open_time)
+    finally:
+        os.remove(path)
+
+if __name__ == '__main__':
+    main(sys.argv)
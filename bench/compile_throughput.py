@@ -0,0 +1,115 @@
+""" Measures compile throughput: compiles synthetic programs of a given
+    number of forms and reports the forms compiled per second.
+
+    Usage (from the repository root):
+        python bench/compile_throughput.py [forms ...]
+
+    These shapes are compiled for every size:
+      flat   -- that many toplevel (define fN (lambda (x) (+ x N))).
+      begin  -- one (begin ...) of that many (set! x (+ x N)).
+      cps    -- that many lambdas nested as continuations, as in the
+                output of transform.transform_list_of_expr:
+                (lambda (k0) (k0 0 (lambda (k1) (k1 1 (lambda ...))))).
+      let    -- that many lets in a lambda, each one in the body of the
+                previous one: (let ((x0 0)) (let ((x1 1)) ... x0)).
+      app    -- that many applications in a lambda, each one the operand
+                of the previous one: (g (g ... (g 0))).
+      if     -- that many ifs in a lambda, each one the alternative of
+                the previous one: (if (< x 0) 0 (if (< x 1) 1 ...)).
+    The programs are built as objects, so the parser isn't measured. A
+    shape that fails to compile is reported with its exception; e.g. the
+    cps and let ones used to exceed the recursion limit, as nested lambdas
+    and nested forms were compiled recursively. In the nested shapes, the
+    frame of the lambda grows with the size, which made the slot
+    allocation and the liveness analysis of the peephole optimizer take
+    quadratic time.
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import __pypy_path__
+from sanya.compilation import compile_list_of_expr
+from sanya.objectmodel import W_Fixnum, make_symbol, pylist2scm, w_nil
+
+SIZES = [1000, 10000, 100000]
+
+def sym(sval):
+    return make_symbol(sval)
+
+def flat_program(nforms):
+    expr_list = []
+    for i in xrange(nforms):
+        w_lambda = pylist2scm([sym('lambda'), pylist2scm([sym('x')]),
+                pylist2scm([sym('+'), sym('x'), W_Fixnum(i)])])
+        expr_list.append(pylist2scm([sym('define'), sym('f%d' % i),
+                                     w_lambda]))
+    return expr_list
+
+def begin_program(nforms):
+    body = [sym('begin')]
+    for i in xrange(nforms):
+        body.append(pylist2scm([sym('set!'), sym('x'),
+                pylist2scm([sym('+'), sym('x'), W_Fixnum(i)])]))
+    return [pylist2scm([sym('define'), sym('x'), W_Fixnum(0)]),
+            pylist2scm(body)]
+
+def cps_program(nforms):
+    # built from the inside out
+    w_expr = pylist2scm([sym('k%d' % (nforms - 1)), W_Fixnum(0)])
+    for i in xrange(nforms - 1, 0, -1):
+        w_lambda = pylist2scm([sym('lambda'), pylist2scm([sym('k%d' % i)]),
+                               w_expr])
+        w_expr = pylist2scm([sym('k%d' % (i - 1)), W_Fixnum(i), w_lambda])
+    return [pylist2scm([sym('lambda'), pylist2scm([sym('k0')]), w_expr])]
+
+def let_program(nforms):
+    # built from the inside out
+    w_expr = sym('x0')
+    for i in xrange(nforms - 1, -1, -1):
+        w_binding = pylist2scm([sym('x%d' % i), W_Fixnum(i)])
+        w_expr = pylist2scm([sym('let'), pylist2scm([w_binding]), w_expr])
+    return [pylist2scm([sym('lambda'), w_nil, w_expr])]
+
+def app_program(nforms):
+    w_expr = W_Fixnum(0)
+    for i in xrange(nforms):
+        w_expr = pylist2scm([sym('g'), w_expr])
+    return [pylist2scm([sym('lambda'), pylist2scm([sym('g')]), w_expr])]
+
+def if_program(nforms):
+    # built from the inside out
+    w_expr = W_Fixnum(nforms)
+    for i in xrange(nforms - 1, -1, -1):
+        w_test = pylist2scm([sym('<'), sym('x'), W_Fixnum(i)])
+        w_expr = pylist2scm([sym('if'), w_test, W_Fixnum(i), w_expr])
+    return [pylist2scm([sym('lambda'), pylist2scm([sym('x')]), w_expr])]
+
+SHAPES = [('flat', flat_program), ('begin', begin_program),
+          ('cps', cps_program), ('let', let_program), ('app', app_program),
+          ('if', if_program)]
+
+def measure(make_program, nforms):
+    expr_list = make_program(nforms)
+    start = time.time()
+    compile_list_of_expr(expr_list)
+    return time.time() - start
+
+def main(argv):
+    sizes = [int(arg) for arg in argv[1:]] or SIZES
+    print '%-6s %8s %9s %12s' % ('shape', 'forms', 'seconds', 'forms/sec')
+    for nforms in sizes:
+        for name, make_program in SHAPES:
+            try:
+                elapsed = measure(make_program, nforms)
+            except (RuntimeError, MemoryError), e:
+                print '%-6s %8d   failed: %s' % (name, nforms,
+                                                 e.__class__.__name__)
+                continue
+            print '%-6s %8d %9.3f %12.0f' % (name, nforms, elapsed,
+                                             nforms / max(elapsed, 1e-9))
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,47 @@
+""" Reports the frame sizes the compiler allocates: for every source file,
+    the number of skeletons, and the total and largest frame_size among
+    them.
+
+    Usage (from the repository root):
+        python bench/frame_size.py [file.scm ...]
+
+    Without arguments, the programs in test-scripts/ are compiled.
+"""
+import glob
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import __pypy_path__
+from sanya.compilation import compile_list_of_expr
+from sanya.parser import parse_string
+
+def measure(path):
+    f = open(path)
+    try:
+        source = f.read()
+    finally:
+        f.close()
+    w_skel = compile_list_of_expr(parse_string(source))
+    sizes = [w_skel.frame_size] + [w_child.frame_size for w_child in
+                                   w_skel.skeleton_registry]
+    return len(sizes), sum(sizes), max(sizes)
+
+def main(argv):
+    paths = argv[1:]
+    if not paths:
+        paths = sorted(glob.glob(os.path.join(ROOT, 'test-scripts', '*.scm')))
+
+    print '%-36s %6s %6s %6s' % ('program', 'skels', 'total', 'max')
+    all_total = 0
+    for path in paths:
+        nskels, total, largest = measure(path)
+        all_total += total
+        print '%-36s %6d %6d %6d' % (os.path.basename(path), nskels, total,
+                                     largest)
+    print 'total frame slots: %d' % all_total
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,73 @@
+""" Measures primitive-procedure call throughput: runs a loop which calls
+    car, cdr, cons and null? through the generic Call instruction and
+    reports the calls per second together with the number of argument
+    lists handed to py_call.
+
+    Usage (from the repository root):
+        python bench/primitives.py [iterations]
+
+    Before the fixed-arity protocol every primitive call built a python
+    list for its arguments. Now calls with up to three arguments go
+    through W_PyProc.call0 ... call3 and py_call is never reached here.
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import __pypy_path__
+from sanya.compilation import compile_list_of_expr
+from sanya.objectmodel import W_PyProc
+from sanya.parser import parse_string
+from sanya.stdlib import lib, open_lib
+from sanya.vm import VM
+
+# 6 primitive calls per iteration. Note that null? is used as a value
+# rather than as an if predicate, which would be inlined.
+CALLS_PER_ITERATION = 6
+PROGRAM = """
+(define loop
+  (lambda (n p)
+    (if (< 0 n)
+      (begin
+        (car p)
+        (cdr p)
+        (null? p)
+        (loop (- n 1) (cdr (cons (car p) p))))
+      0)))
+(loop %(iterations)d (cons 1 2))
+"""
+
+def main(argv):
+    iterations = 100000
+    if len(argv) > 1:
+        iterations = int(argv[1])
+
+    counters = {'lists': 0}
+    def counting(py_call):
+        def counting_py_call(self, py_args):
+            counters['lists'] += 1
+            return py_call(self, py_args)
+        return counting_py_call
+    for cls in [W_PyProc] + [w_proc.__class__ for w_proc in lib.values()]:
+        if 'py_call' in cls.__dict__:
+            cls.py_call = counting(cls.__dict__['py_call'])
+
+    w_skel = compile_list_of_expr(parse_string(
+        PROGRAM % {'iterations': iterations}))
+    vm = VM()
+    open_lib(vm)
+    vm.bootstrap(w_skel)
+    start = time.time()
+    vm.run()
+    elapsed = time.time() - start
+
+    calls = iterations * CALLS_PER_ITERATION
+    print 'primitive calls:   %d' % calls
+    print 'py_call lists:     %d' % counters['lists']
+    print 'time:              %.3fs (%.0f calls/s)' % (elapsed,
+                                                       calls / elapsed)
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,67 @@
+""" Measures how long quoted constants take to dump and to load: compiles
+    (quote (...)) of a proper list of a given number of elements, or of
+    a list nested that deep in its cars, and round-trips it through
+    chunkio.dump_to_string and chunkio.load_from_string.
+
+    Usage (from the repository root):
+        python bench/quoted_consts.py [elements ...]
+
+    The elements are the fixnums 0 to 9, repeated, so the chunk's size
+    tells how well the repeated sublists of the nested shape are shared.
+    Before constants were dumped as lists, every pair was written and read
+    by a recursive call, and the long shapes exceeded the recursion limit.
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import __pypy_path__
+from sanya import chunkio
+from sanya.compilation import compile_list_of_expr
+from sanya.objectmodel import W_Fixnum, W_Pair, make_symbol, pylist2scm, w_nil
+
+SIZES = [10000, 100000, 1000000]
+
+def flat_datum(nelems):
+    return pylist2scm([W_Fixnum(i % 10) for i in xrange(nelems)])
+
+def nested_datum(nelems):
+    # (((... (0 1) ...) 8 9) 0 1), every level of the 10 fixnums in its cdr
+    w_datum = w_nil
+    for i in xrange(nelems // 10):
+        w_datum = W_Pair(w_datum, flat_datum(10))
+    return w_datum
+
+SHAPES = [('flat', flat_datum), ('nested', nested_datum)]
+
+def measure(make_datum, nelems):
+    w_quote = pylist2scm([make_symbol('quote'), make_datum(nelems)])
+    w_skel = compile_list_of_expr([w_quote])
+    start = time.time()
+    data = chunkio.dump_to_string(w_skel)
+    dump_time = time.time() - start
+    start = time.time()
+    chunkio.load_from_string(data)
+    load_time = time.time() - start
+    return dump_time, load_time, len(data)
+
+def main(argv):
+    sizes = [int(arg) for arg in argv[1:]] or SIZES
+    print '%-6s %8s %10s %9s %9s %12s' % ('shape', 'elements', 'bytes',
+            'dump s', 'load s', 'elems/sec')
+    for nelems in sizes:
+        for name, make_datum in SHAPES:
+            try:
+                dump_time, load_time, nbytes = measure(make_datum, nelems)
+            except (RuntimeError, MemoryError), e:
+                print '%-6s %8d   failed: %s' % (name, nelems,
+                                                 e.__class__.__name__)
+                continue
+            print '%-6s %8d %10d %9.3f %9.3f %12.0f' % (name, nelems,
+                    nbytes, dump_time, load_time,
+                    nelems / max(load_time, 1e-9))
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,166 @@
+""" A directory of the compiled chunks of the files that were run, so that
+    running the same source again loads its chunk instead of parsing and
+    compiling it. @see targetscheme.run_file
+
+    A chunk is named after the md5 of the source and of the compiler's
+    version, which includes the options that change the generated code.
+    It is written to a temporary file which is then renamed, so concurrent
+    runs see either no chunk or a whole one. Chunks are touched when they
+    are used, and once the directory is larger than CHUNK_CACHE_SIZE, the
+    least recently used ones are removed.
+
+    The cache never makes a run fail: chunks that can't be read or written
+    are compiled or skipped as if there were no cache.
+"""
+import os
+
+from pypy.rlib import rmd5
+from pypy.rlib.listsort import TimSort
+from sanya import chunkio
+from sanya.compilation import COMPILER_REVISION
+from sanya.config import (CHUNK_CACHE, CHUNK_CACHE_ENV, CHUNK_CACHE_SIZE,
+                          CONSTANT_FOLDING, PEEPHOLE, INLINE_BUDGET)
+
+CHUNK_SUFFIX = '.scmc'
+
+def compiler_version():
+    return 'sanya-%d-%d-%d%d-%d' % (COMPILER_REVISION,
+            chunkio.CHUNK_VERSION, CONSTANT_FOLDING, PEEPHOLE,
+            INLINE_BUDGET)
+
+def default_cache():
+    """ Return the cache in the directory that CHUNK_CACHE_ENV names, or in
+        $HOME/.cache/sanya, or None if there's no cache.
+    """
+    if not CHUNK_CACHE:
+        return None
+    path = os.environ.get(CHUNK_CACHE_ENV)
+    if path is None:
+        home = os.environ.get('HOME')
+        if not home:
+            return None
+        path = home + '/.cache/sanya'
+    if not path:
+        return None
+    return ChunkCache(path, CHUNK_CACHE_SIZE)
+
+class ChunkCache(object):
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+
+    def chunk_path(self, source):
+        digest = rmd5.RMD5(compiler_version() + '\0' + source).hexdigest()
+        return self.path + '/' + digest + CHUNK_SUFFIX
+
+    def lookup(self, source):
+        """ Return the chunkio.LazyChunk of source, or None if it's not
+            cached or its chunk is broken, which is then removed. All the
+            skeletons of the chunk are checked, so none of them fails when
+            it is decoded during the run.
+        """
+        path = self.chunk_path(source)
+        try:
+            chunk = chunkio.open_chunk(path)
+            chunk.verify_all()
+        except OSError:
+            return None
+        except ValueError:
+            remove_file(path)
+            return None
+        try:
+            os.utime(path, None) # used now
+        except OSError:
+            pass
+        return chunk
+
+    def store(self, source, w_skel):
+        """ Cache w_skel as the chunk of source. w_skel must not have been
+            bootstrapped yet, since that takes its skeleton_registry.
+        """
+        path = self.chunk_path(source)
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        data = chunkio.dump_to_string(w_skel)
+        try:
+            make_dirs(self.path)
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                         0644)
+            try:
+                write_all(fd, data)
+            finally:
+                os.close(fd)
+            os.rename(tmp_path, path)
+        except OSError:
+            remove_file(tmp_path)
+            return
+        self.evict(path)
+
+    def evict(self, keep_path):
+        """ Remove the least recently used chunks, but keep_path, until
+            the cache fits in max_size.
+        """
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            return
+        entries = []
+        total_size = 0
+        for name in names:
+            if not name.endswith(CHUNK_SUFFIX):
+                continue # e.g., being written
+            path = self.path + '/' + name
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue # removed by another run
+            entries.append(CacheEntry(path, st.st_size, st.st_mtime))
+            total_size += st.st_size
+        if total_size <= self.max_size:
+            return
+        EntrySort(entries).sort()
+        for entry in entries:
+            if total_size <= self.max_size:
+                break
+            if entry.path == keep_path:
+                continue
+            remove_file(entry.path)
+            total_size -= entry.size
+
+class CacheEntry(object):
+    def __init__(self, path, size, mtime):
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+
+class EntrySort(TimSort):
+    """ Least recently used first.
+    """
+    def lt(self, a, b):
+        return a.mtime < b.mtime
+
+def make_dirs(path):
+    """ Create the directory path and its missing parents.
+    """
+    parts = path.split('/')
+    current = ''
+    for i in xrange(len(parts)):
+        if i > 0:
+            current += '/'
+        current += parts[i]
+        if current and not os.path.isdir(current):
+            try:
+                os.mkdir(current, 0755)
+            except OSError:
+                if not os.path.isdir(current): # unless another run did it
+                    raise
+
+def write_all(fd, data):
+    written = 0
+    while written < len(data):
+        written += os.write(fd, data[written:])
+
+def remove_file(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
@@ -1,63 +1,662 @@
+import os
 
-from sanya.instruction_set import make_instr
+from pypy.rlib import rmmap
+from sanya.instruction_set import new_instr, op_map, BranchIfFalse, OpenCell
 from sanya.closure import W_Skeleton
 from sanya.objectmodel import (make_symbol, W_Fixnum,
                                W_Pair, make_bool, w_unspecified, w_nil)
 
-CHUNK_HEADER = '-' + 'sanya' + '--'
+# A chunk starts with CHUNK_MAGIC and the version of its format, one byte.
+# Version 1 is only read, its version byte is '-' and its numbers are all
+# 4-byte words, @see load_skel_v1. Versions 2 to 4 were never released
+# and are not read. In this version, the header is followed by
+#   the adler-32 checksum of the table of sections and of the sections of
+#   symbols and skeletons, which are decoded at once, as a word,
+#   the number of sections and, for each, its tag, its offset from the end
+#   of this table and its size,
+#   the sections, @see ChunkEncoder.
+# and the numbers are unsigned LEB128 varints, @see dump_varint. The code
+# and the constants of each skeleton have their own checksum, which is
+# checked when they are decoded, @see LazyChunk.load_skel, or before, by
+# LazyChunk.verify_all.
+CHUNK_MAGIC = '-' + 'sanya' + '-'
+CHUNK_VERSION = 5
+
+SECTION_SYMBOLS = 'Y'
+SECTION_CONSTS = 'K'
+SECTION_CODE = 'C'
+SECTION_SKELETONS = 'S'
 
 def dump(root_skel, stream):
-    stream.write(CHUNK_HEADER)
-    dump_skel(root_skel, stream)
-    dump_number(len(root_skel.skeleton_registry), stream)
-    for skel in root_skel.skeleton_registry:
-        dump_skel(skel, stream)
+    stream.write(dump_to_string(root_skel))
 
 def load(stream):
-    assert stream.read(len(CHUNK_HEADER)) == CHUNK_HEADER, 'Wrong chunk header'
-    root_skel = load_skel(stream)
-    nskeletons = load_number(stream)
-    skeleton_registry = [None] * nskeletons
-    for i in xrange(nskeletons):
-        skeleton_registry[i] = load_skel(stream)
-    root_skel.skeleton_registry = skeleton_registry
-    return root_skel
+    return load_from_string(stream.readall())
 
-# ___________________________________________________________________________
-# implementation details
+def dump_to_string(root_skel):
+    encoder = ChunkEncoder()
+    encoder.dump_skel(root_skel)
+    for skel in root_skel.skeleton_registry:
+        encoder.dump_skel(skel)
+    return encoder.getvalue()
+
+def load_from_string(data):
+    chunk = LazyChunk(ChunkReader(data))
+    skeleton_registry = chunk.w_root.skeleton_registry
+    for i in xrange(len(skeleton_registry)):
+        if skeleton_registry[i] is None:
+            skeleton_registry[i] = chunk.load_skeleton(i)
+    return chunk.w_root
+
+def open_chunk(filename):
+    """ Return the LazyChunk of the file, which is memory-mapped if
+        possible.
+    """
+    fd = os.open(filename, os.O_RDONLY, 0)
+    try:
+        try:
+            stream = MappedChunkReader(rmmap.mmap(fd, 0,
+                                                  access=rmmap.ACCESS_READ))
+        except (rmmap.RValueError, rmmap.REnvironmentError):
+            # e.g., an empty file, which is reported by LazyChunk
+            stream = ChunkReader(read_fd(fd))
+    finally:
+        os.close(fd)
+    return LazyChunk(stream)
+
+def read_fd(fd):
+    pieces = []
+    while True:
+        s = os.read(fd, 65536)
+        if not s:
+            break
+        pieces.append(s)
+    return ''.join(pieces)
+
+class LazyChunk(object):
+    """ A chunk whose toplevel skeleton is decoded at once, and the others
+        when they are first needed. Those of a chunk of version 1, which
+        has no table of sections, are all decoded at once.
+        @see vm.VM.load_skeleton
+
+        So a damaged skeleton is only found when it is decoded, which may
+        be in the middle of a run, unless verify_all is called first.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        if stream.read(len(CHUNK_MAGIC)) != CHUNK_MAGIC:
+            raise ValueError('chunk -- wrong header')
+        version = stream.read_char()
+        if version == '-':
+            self.version = 1
+            self.init_v1()
+        elif ord(version) == CHUNK_VERSION:
+            self.version = ord(version)
+            self.init_sections()
+        elif ord(version) < CHUNK_VERSION:
+            # those of the development versions, which were never released
+            raise ValueError('chunk -- unsupported version %d, recompile it'
+                             % ord(version))
+        else:
+            raise ValueError('chunk -- unsupported version %d'
+                             % ord(version))
+
+    def load_skeleton(self, index):
+        """ Decode skeleton_registry[index].
+        """
+        assert self.version != 1
+        # the toplevel skeleton is the first one
+        self.stream.pos = self.offsets[index + 1]
+        return self.load_skel()
+
+    def init_v1(self):
+        stream = self.stream
+        self.offsets = None
+        self.w_root = load_skel_v1(stream)
+        nskeletons = load_number(stream)
+        skeleton_registry = [None] * nskeletons
+        for i in xrange(nskeletons):
+            skeleton_registry[i] = load_skel_v1(stream)
+        self.w_root.skeleton_registry = skeleton_registry
+
+    def init_sections(self):
+        stream = self.stream
+        checksum = load_word(stream)
+        table_start = stream.pos
+        self.symbols_start = -1
+        self.consts_start = -1
+        self.code_start = -1
+        self.skeletons_start = -1
+        nsections = load_varint(stream)
+        tags = [' '] * nsections
+        offsets = [0] * nsections
+        sizes = [0] * nsections
+        for i in xrange(nsections):
+            tags[i] = stream.read_char()
+            offsets[i] = load_varint(stream)
+            sizes[i] = load_varint(stream)
+        sections_start = stream.pos
+        self.consts_end = -1
+        self.code_end = -1
+        value = adler32(stream, table_start, sections_start, 1)
+        for i in xrange(nsections):
+            start = sections_start + offsets[i]
+            if start + sizes[i] > stream.size:
+                raise ValueError('chunk -- truncated section %s' % tags[i])
+            if tags[i] == SECTION_SYMBOLS:
+                self.symbols_start = start
+                value = adler32(stream, start, start + sizes[i], value)
+            elif tags[i] == SECTION_CONSTS:
+                self.consts_start = start
+                self.consts_end = start + sizes[i]
+            elif tags[i] == SECTION_CODE:
+                self.code_start = start
+                self.code_end = start + sizes[i]
+            elif tags[i] == SECTION_SKELETONS:
+                self.skeletons_start = start
+                value = adler32(stream, start, start + sizes[i], value)
+            # and the others are for later versions
+        if (self.symbols_start < 0 or self.consts_start < 0 or
+                self.code_start < 0 or self.skeletons_start < 0):
+            raise ValueError('chunk -- missing section')
+        if checksum != value:
+            raise ValueError('chunk -- checksum mismatch')
+
+        stream.pos = self.symbols_start
+        nsymbols = load_varint(stream)
+        self.symbols = [None] * nsymbols
+        for i in xrange(nsymbols):
+            self.symbols[i] = make_symbol(stream.read(load_varint(stream)))
+
+        stream.pos = self.skeletons_start
+        nskeletons = load_varint(stream)
+        if nskeletons < 1:
+            raise ValueError('chunk -- no toplevel skeleton')
+        self.offsets = [0] * nskeletons
+        for i in xrange(nskeletons):
+            self.offsets[i] = stream.pos
+            skip_skel_record(stream)
+            stream.consume(4) # checksum
+        stream.pos = self.offsets[0]
+        self.w_root = self.load_skel()
+        self.w_root.skeleton_registry = [None] * (nskeletons - 1)
+
+    def verify_all(self):
+        """ Check the checksums of the code and constants of the skeletons
+            which are not decoded yet, without decoding them, and raise a
+            ValueError if one doesn't match.
+        """
+        if self.version == 1:
+            return # all decoded
+        stream = self.stream
+        nskeletons = len(self.offsets)
+        code_offsets = [0] * nskeletons
+        const_offsets = [0] * nskeletons
+        checksums = [0] * nskeletons
+        for i in xrange(nskeletons):
+            stream.pos = self.offsets[i]
+            code_offsets[i] = load_varint(stream)
+            load_varint(stream) # ncodes
+            const_offsets[i] = load_varint(stream)
+            skip_skel_record(stream, 3)
+            checksums[i] = load_word(stream)
+        # the code and constants of each skeleton follow those of the
+        # previous one, @see ChunkEncoder
+        code_end = self.code_end
+        consts_end = self.consts_end
+        for i in xrange(nskeletons - 1, 0, -1): # the toplevel one is decoded
+            code_start = self.code_start + code_offsets[i]
+            consts_start = self.consts_start + const_offsets[i]
+            if code_start > code_end or consts_start > consts_end:
+                raise ValueError('chunk -- overlapping skeletons')
+            value = adler32(stream, code_start, code_end, 1)
+            value = adler32(stream, consts_start, consts_end, value)
+            if checksums[i] != value:
+                raise ValueError('chunk -- checksum mismatch')
+            code_end = code_start
+            consts_end = consts_start
+
+    def load_skel(self):
+        """ Decode the skeleton whose record is at stream.pos.
+            @see ChunkEncoder.dump_skel
+        """
+        stream = self.stream
+        code_offset = load_varint(stream)
+        ncodes = load_varint(stream)
+        const_offset = load_varint(stream)
+        nconsts = load_varint(stream)
+        frame_size = load_varint(stream)
+        cellvalues = load_varint_list(stream)
+        fresh_cells = load_varint_list(stream)
+        nb_args = load_varint(stream)
+        flags = ord(stream.read_char())
+        checksum = load_word(stream)
+
+        start = stream.pos = self.code_start + code_offset
+        codes = [None] * ncodes
+        for i in xrange(ncodes):
+            codes[i] = load_instr(stream)
+        value = adler32(stream, start, stream.pos, 1)
+        start = stream.pos = self.consts_start + const_offset
+        consts = self.load_consts(nconsts)
+        if checksum != adler32(stream, start, stream.pos, value):
+            raise ValueError('chunk -- checksum mismatch')
+        return W_Skeleton(codes, consts, frame_size, cellvalues,
+                fresh_cells, nb_args, (flags & SKEL_VARARGS) != 0,
+                (flags & SKEL_CAPTURED) != 0, None)
+
+    def load_consts(self, nconsts):
+        """ Run the stack machine that builds the constants of a skeleton,
+            @see ChunkEncoder.dump_consts
+        """
+        stream = self.stream
+        consts = [None] * nconsts
+        values = [] # the stack
+        pairs = [] # the pairs built so far, which K_REF refers to
+        i = 0
+        while i < nconsts:
+            tag = stream.read_char()
+            if tag == K_END:
+                if len(values) != 1:
+                    raise ValueError('chunk -- malformed constant')
+                consts[i] = values.pop()
+                i += 1
+
+            elif tag == K_SYMBOL:
+                values.append(self.load_symbol())
+
+            elif tag == K_FIXNUM:
+                values.append(W_Fixnum(unzigzag(load_varint(stream))))
+
+            elif tag == K_LIST:
+                length = load_varint(stream)
+                if length < 1 or length >= len(values):
+                    raise ValueError('chunk -- malformed list constant')
+                w_list = values.pop() # the tail
+                for j in xrange(length):
+                    w_list = W_Pair(values.pop(), w_list)
+                    pairs.append(w_list)
+                values.append(w_list)
+
+            elif tag == K_REF:
+                index = load_varint(stream)
+                if index >= len(pairs):
+                    raise ValueError('chunk -- unknown constant %d' % index)
+                values.append(pairs[index])
+
+            else:
+                values.append(load_atom(tag))
+        return consts
+
+    def load_symbol(self):
+        index = load_varint(self.stream)
+        if index >= len(self.symbols):
+            raise ValueError('chunk -- unknown symbol %d' % index)
+        return self.symbols[index]
+
+class ChunkEncoder(object):
+    """ Encodes skeletons to the sections of a chunk:
+        SECTION_SYMBOLS   the number of symbols, then each one's name.
+        SECTION_CONSTS    the constants of every skeleton, in turn, @see
+                          dump_consts. Symbols are referred to by their
+                          index.
+        SECTION_CODE      the instructions of every skeleton, in turn. Each
+                          is its opcode, a byte, and then the operands it
+                          uses, @see op_operands.
+        SECTION_SKELETONS the number of skeletons, then for each, the
+                          offsets and sizes of its code and constants, the
+                          rest of its fields and the adler-32 checksum of
+                          its code and then its constants, as a word. The
+                          first one is the toplevel skeleton.
+        The skeletons' records are small, so that finding them all is
+        cheap, and their code and constants are decoded when needed.
+    """
+    def __init__(self):
+        self.symbol_index = {} # maps the name of a symbol to its index
+        self.symbols = ChunkWriter()
+        self.consts = ChunkWriter()
+        self.code = ChunkWriter()
+        self.skeletons = ChunkWriter()
+        self.nb_skeletons = 0
+
+    def dump_skel(self, skel):
+        code_offset = self.code.size
+        code_piece = len(self.code.pieces)
+        for instr in skel.codes:
+            dump_instr(instr, self.code)
+        const_offset = self.consts.size
+        const_piece = len(self.consts.pieces)
+        self.dump_consts(skel.consts)
+        value = adler32_of(self.code.getvalue_from(code_piece), 1)
+        value = adler32_of(self.consts.getvalue_from(const_piece), value)
+
+        stream = self.skeletons
+        dump_varint(code_offset, stream)
+        dump_varint(len(skel.codes), stream)
+        dump_varint(const_offset, stream)
+        dump_varint(len(skel.consts), stream)
+        dump_varint(skel.frame_size, stream)
+        dump_varint_list(skel.cell_recipt, stream)
+        dump_varint_list(skel.fresh_cells, stream)
+        dump_varint(skel.nb_args, stream)
+        flags = 0
+        if skel.varargs_p:
+            flags |= SKEL_VARARGS
+        if skel.captured_p:
+            flags |= SKEL_CAPTURED
+        stream.write(chr(flags))
+        dump_word(value, stream)
+        self.nb_skeletons += 1
+
+    def dump_consts(self, consts):
+        """ Dump the constants of a skeleton as the instructions of a stack
+            machine, each constant ending with K_END:
+            K_SYMBOL, K_FIXNUM and the other atoms push themselves,
+            K_LIST n pops a tail and then n elements, and pushes the list
+                of them, whose pairs are numbered in the order they are
+                built, from the tail on,
+            K_REF i pushes the i-th pair built.
+            The pairs whose structure is that of a pair built before are
+            dumped as K_REF, so shared or repeated data is built once.
+            Both this and LazyChunk.load_consts use explicit stacks,
+            since quoted data may be deeply nested.
+        """
+        # maps each pair to the index of its structure, which
+        # structures maps the key of, @see const_key
+        canonical = {}
+        structures = {}
+        self.number_pairs(consts, canonical, structures)
+        built = {} # maps the index of a structure to the pair built so
+        self.nb_pairs_built = 0
+        for const in consts:
+            self.dump_const(const, canonical, built)
+            self.consts.write(K_END)
+
+    def number_pairs(self, consts, canonical, structures):
+        """ Give every pair in consts the index of its structure, which is
+            the same for the pairs that are equal. Their cars and cdrs are
+            numbered first.
+        """
+        pending = consts[:]
+        while pending:
+            w_obj = pending[-1]
+            if not w_obj.is_pair() or w_obj in canonical:
+                pending.pop()
+                continue
+            assert isinstance(w_obj, W_Pair)
+            car_key = self.const_key(w_obj.car, canonical)
+            if car_key is None:
+                pending.append(w_obj.car)
+                continue
+            cdr_key = self.const_key(w_obj.cdr, canonical)
+            if cdr_key is None:
+                pending.append(w_obj.cdr)
+                continue
+            pending.pop()
+            key = car_key + ' ' + cdr_key
+            index = structures.get(key, -1)
+            if index < 0:
+                index = len(structures)
+                structures[key] = index
+            canonical[w_obj] = index
+
+    def const_key(self, const, canonical):
+        """ A string which tells the structure of const, or None if const
+            is a pair which isn't numbered yet.
+        """
+        if const.is_pair():
+            index = canonical.get(const, -1)
+            if index < 0:
+                return None
+            return '#%d' % index
+        elif const.is_symbol():
+            return 'S%d' % self.get_symbol_index(const.get_symbol())
+        elif const.is_fixnum():
+            return 'I%d' % const.get_fixnum()
+        elif const.is_null():
+            return K_NULL
+        elif const.is_boolean():
+            if const.to_bool():
+                return K_TRUE
+            return K_FALSE
+        elif const.is_unspecified():
+            return K_UNSPEC
+        else:
+            raise TypeError('unknown constant -- %s' % const.to_string())
+
+    def dump_const(self, w_const, canonical, built):
+        stream = self.consts
+        tasks = [ConstTask(w_const, None)]
+        while tasks:
+            task = tasks.pop()
+            if task.spine is not None:
+                spine = task.spine
+                stream.write(K_LIST)
+                dump_varint(len(spine), stream)
+                # the decoder builds them from the tail on
+                for i in xrange(len(spine) - 1, -1, -1):
+                    index = canonical[spine[i]]
+                    if index not in built:
+                        built[index] = self.nb_pairs_built
+                    self.nb_pairs_built += 1
+                continue
+
+            const = task.w_value
+            if const.is_symbol():
+                stream.write(K_SYMBOL)
+                dump_varint(self.get_symbol_index(const.get_symbol()),
+                            stream)
+
+            elif const.is_fixnum():
+                stream.write(K_FIXNUM)
+                dump_varint(zigzag(const.get_fixnum()), stream)
+
+            elif const.is_pair():
+                index = canonical[const]
+                if index in built:
+                    stream.write(K_REF)
+                    dump_varint(built[index], stream)
+                    continue
+                # the pairs of the list up to a tail which is built already
+                # or not a pair, in a single K_LIST.
+                spine = [const]
+                w_rest = const
+                assert isinstance(w_rest, W_Pair)
+                w_rest = w_rest.cdr
+                while w_rest.is_pair() and canonical[w_rest] not in built:
+                    spine.append(w_rest)
+                    assert isinstance(w_rest, W_Pair)
+                    w_rest = w_rest.cdr
+                tasks.append(ConstTask(None, spine))
+                tasks.append(ConstTask(w_rest, None))
+                for i in xrange(len(spine) - 1, -1, -1):
+                    w_pair = spine[i]
+                    assert isinstance(w_pair, W_Pair)
+                    tasks.append(ConstTask(w_pair.car, None))
+
+            else:
+                dump_atom(const, stream)
+
+    def get_symbol_index(self, sval):
+        index = self.symbol_index.get(sval, -1)
+        if index < 0:
+            index = len(self.symbol_index)
+            self.symbol_index[sval] = index
+            dump_varint(len(sval), self.symbols)
+            self.symbols.write(sval)
+        return index
+
+    def getvalue(self):
+        symbols = ChunkWriter()
+        dump_varint(len(self.symbol_index), symbols)
+        symbols.write(self.symbols.getvalue())
+        skeletons = ChunkWriter()
+        dump_varint(self.nb_skeletons, skeletons)
+        skeletons.write(self.skeletons.getvalue())
+        sections = [(SECTION_SYMBOLS, symbols.getvalue()),
+                    (SECTION_CONSTS, self.consts.getvalue()),
+                    (SECTION_CODE, self.code.getvalue()),
+                    (SECTION_SKELETONS, skeletons.getvalue())]
+
+        table = ChunkWriter()
+        dump_varint(len(sections), table)
+        offset = 0
+        for tag, data in sections:
+            table.write(tag)
+            dump_varint(offset, table)
+            dump_varint(len(data), table)
+            offset += len(data)
+        table_data = table.getvalue()
+        value = adler32_of(table_data, 1)
+        for tag, data in sections:
+            if tag == SECTION_SYMBOLS or tag == SECTION_SKELETONS:
+                value = adler32_of(data, value)
+
+        stream = ChunkWriter()
+        stream.write(CHUNK_MAGIC)
+        stream.write(chr(CHUNK_VERSION))
+        dump_word(value, stream)
+        stream.write(table_data)
+        for tag, data in sections:
+            stream.write(data)
+        return stream.getvalue()
+
+class ConstTask(object):
+    """ Dump w_value, or else the K_LIST of spine, a list of pairs.
+        @see ChunkEncoder.dump_const
+    """
+    def __init__(self, w_value, spine):
+        self.w_value = w_value
+        self.spine = spine
 
-def dump_skel(skel, stream):
-    dump_instr_list(skel.codes, stream)
-    dump_const_list(skel.consts, stream)
-    dump_number(skel.frame_size, stream)
+class ChunkWriter(object):
+    """ Collects the bytes of a chunk, which is then written at once.
+    """
+    def __init__(self):
+        self.pieces = []
+        self.size = 0 # the number of bytes written
 
-    dump_number(len(skel.cell_recipt), stream)
-    for cellvalue_repr in skel.cell_recipt:
-        dump_number(cellvalue_repr, stream)
+    def write(self, s):
+        self.pieces.append(s)
+        self.size += len(s)
 
-    dump_number(len(skel.fresh_cells), stream)
-    for shadow_id in skel.fresh_cells:
-        dump_number(shadow_id, stream)
+    def getvalue(self):
+        return ''.join(self.pieces)
 
-    dump_number(skel.nb_args, stream)
-    if skel.varargs_p:
-        stream.write('\x01')
-    else:
-        stream.write('\x00')
-    stream.write('\n')
+    def getvalue_from(self, index):
+        """ The bytes written since there were index pieces.
+        """
+        return ''.join(self.pieces[index:])
+
+class ChunkReader(object):
+    """ A chunk read at once, which is decoded from offset pos on.
+    """
+    def __init__(self, data):
+        self.data = data
+        self.size = len(data)
+        self.pos = 0
+
+    def char_at(self, pos):
+        return self.data[pos]
+
+    def slice(self, start, stop):
+        return self.data[start:stop]
+
+    def consume(self, n):
+        """ Skip n bytes, and return the offset of the first one.
+        """
+        pos = self.pos
+        if n < 0 or pos < 0 or pos + n > self.size:
+            raise ValueError('chunk -- unexpected end of data')
+        self.pos = pos + n
+        return pos
+
+    def read(self, n):
+        pos = self.consume(n)
+        return self.slice(pos, pos + n)
+
+    def read_char(self):
+        return self.char_at(self.consume(1))
+
+class MappedChunkReader(ChunkReader):
+    """ A ChunkReader of a memory-mapped file, whose pages are only read
+        when the skeletons in them are decoded.
+    """
+    def __init__(self, mmap):
+        ChunkReader.__init__(self, '')
+        self.mmap = mmap
+        self.size = mmap.len()
+
+    def char_at(self, pos):
+        return self.mmap.getitem(pos)
 
-def dump_instr_list(instr_list, stream):
-    dump_number(len(instr_list), stream)
-    for instr in instr_list:
-        dump_instr(instr, stream)
+    def slice(self, start, stop):
+        return self.mmap.getslice(start, stop - start)
+
+# ___________________________________________________________________________
+# implementation details
+
+SKEL_VARARGS = 0x1
+SKEL_CAPTURED = 0x2
+
+# the operands of the instructions in a chunk, 'x' being Bx, by opcode.
+# The others are 0 and not dumped.
+instr_operands = {
+    'Halt':         '',
+    'MoveLocal':    'AB',
+    'LoadGlobal':   'AB',
+    'LoadCell':     'AB',
+    'LoadConst':    'AB',
+    'StoreGlobal':  'AB',
+    'StoreCell':    'AB',
+    'BuildClosure': 'AB',
+    'Return':       'B',
+    'Branch':       'x',
+    'BranchIfFalse': 'Ax',
+    'BranchBack':   'x',
+    'OpenCell':     'AB',
+}
+op_operands = ['ABC'] * (max(op_map.values()) + 1)
+for op_name, op_num in op_map.items():
+    if op_name in instr_operands:
+        op_operands[op_num] = instr_operands[op_name]
+
+# the largest operand, which is a machine word on every platform
+MAX_OPERAND = (1 << 31) - 1
 
 def dump_instr(instr, stream):
-    dump_number(instr.dump_u32(), stream)
+    if not instr.op_num:
+        raise ValueError('no opnum')
+    stream.write(chr(instr.op_num))
+    for field in op_operands[instr.op_num]:
+        if field == 'A':
+            operand = instr.A
+        elif field == 'B':
+            operand = instr.B
+        elif field == 'C':
+            operand = instr.C
+        else:
+            operand = instr.Bx
+        if operand < 0 or operand > MAX_OPERAND:
+            raise ValueError('operand out of range -- %d in %s' % (
+                operand, instr.__class__.__name__))
+        dump_varint(operand, stream)
 
-def dump_const_list(const_list, stream):
-    dump_number(len(const_list), stream)
-    for const in const_list:
-        dump_const(const, stream)
+def load_instr(stream):
+    op = ord(stream.read_char())
+    if op >= len(op_operands):
+        raise ValueError('unknown opcode -- %d' % op)
+    A = B = C = Bx = 0
+    for field in op_operands[op]:
+        if field == 'A':
+            A = load_varint(stream)
+        elif field == 'B':
+            B = load_varint(stream)
+        elif field == 'C':
+            C = load_varint(stream)
+        else:
+            Bx = load_varint(stream)
+    return new_instr(op, A, B, C, Bx)
 
 K_SYMBOL = 'S'
 K_FIXNUM = 'I'
@@ -66,23 +665,11 @@ K_NULL = 'u'
 K_TRUE = 't'
 K_FALSE = 'f'
 K_UNSPEC = '?'
-def dump_const(const, stream):
-    if const.is_symbol():
-        stream.write(K_SYMBOL)
-        dump_string(const.get_symbol(), stream)
-
-    elif const.is_fixnum():
-        stream.write(K_FIXNUM)
-        dump_number(const.get_fixnum(), stream)
-
-    elif const.is_pair():
-        # XXX: recursive call -- stack overflow?
-        assert isinstance(const, W_Pair)
-        stream.write(K_PAIR)
-        dump_const(const.car, stream)
-        dump_const(const.cdr, stream)
-
-    elif const.is_null():
+K_LIST = 'L'
+K_REF = 'R'
+K_END = '.'
+def dump_atom(const, stream):
+    if const.is_null():
         stream.write(K_NULL)
 
     elif const.is_boolean():
@@ -97,120 +684,216 @@ def dump_const(const, stream):
     else:
         raise TypeError('unknown constant -- %s' % const.to_string())
 
-def dump_number(ival, stream):
-    assert abs(ival) < ((1 << 31) - 1), 'Number too large to dump'
-    c4 = (ival >> 24) & 0xff
-    c3 = (ival >> 16) & 0xff
-    c2 = (ival >> 8) & 0xff
-    c1 = ival & 0xff
+def load_atom(tag):
+    if tag == K_NULL:
+        return w_nil
+
+    elif tag == K_TRUE:
+        return make_bool(True)
+
+    elif tag == K_FALSE:
+        return make_bool(False)
+
+    elif tag == K_UNSPEC:
+        return w_unspecified
+
+    else:
+        raise ValueError('unknown tag -- %s' % tag)
+
+def dump_varint(uval, stream):
+    """ Dump uval, which is not negative, 7 bits at a time from the lowest
+        ones. The high bit of a byte tells whether more follow.
+    """
+    assert uval >= 0, 'Negative varint'
+    while uval >= 0x80:
+        stream.write(chr((uval & 0x7f) | 0x80))
+        uval >>= 7
+    stream.write(chr(uval))
+
+def load_varint(stream):
+    uval = 0
+    shift = 0
+    while True:
+        byte = ord(stream.read_char())
+        uval |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return uval
+        shift += 7
+        if shift > 56:
+            raise ValueError('chunk -- varint too long')
+
+def dump_varint_list(ints, stream):
+    dump_varint(len(ints), stream)
+    for ival in ints:
+        dump_varint(ival, stream)
+
+def load_varint_list(stream):
+    ints = [0] * load_varint(stream)
+    for i in xrange(len(ints)):
+        ints[i] = load_varint(stream)
+    return ints
+
+def zigzag(ival):
+    """ Map the signed ival to an unsigned one, those of small magnitude
+        to small ones: 0, -1, 1, -2 ... to 0, 1, 2, 3 ...
+    """
+    if ival < 0:
+        return (~ival << 1) | 1
+    return ival << 1
+
+def unzigzag(uval):
+    if uval & 1:
+        return ~(uval >> 1)
+    return uval >> 1
+
+def adler32(stream, start, stop, value):
+    """ Update value, an adler-32 checksum which starts at 1, with the
+        bytes of stream from start to stop.
+    """
+    a = value & 0xffff
+    b = value >> 16
+    for pos in xrange(start, stop):
+        a = (a + ord(stream.char_at(pos))) % 65521
+        b = (b + a) % 65521
+    return (b << 16) | a
+
+def adler32_of(s, value):
+    return adler32(ChunkReader(s), 0, len(s), value)
+
+def skip_skel_record(stream, nread=0):
+    """ Skip the rest of the record of a skeleton, whose first nread
+        fields were read, but its checksum.
+    """
+    for i in xrange(nread, 5): # code and consts offsets and sizes, and
+        load_varint(stream)    # frame_size
+    load_varint_list(stream) # cell recipe
+    load_varint_list(stream) # fresh cells
+    load_varint(stream) # nb_args
+    stream.consume(1) # flags
+
+def dump_word(u32, stream):
+    """ Dump an unsigned 32-bit word.
+    """
     # using little endian here
-    stream.write(chr(c1))
-    stream.write(chr(c2))
-    stream.write(chr(c3))
-    stream.write(chr(c4))
-
-def dump_string(sval, stream):
-    dump_number(len(sval), stream)
-    stream.write(sval)
-
-def load_skel(stream):
-    codes = load_instr_list(stream)
-    consts = load_const_list(stream)
+    stream.write(chr(u32 & 0xff) + chr((u32 >> 8) & 0xff) +
+                 chr((u32 >> 16) & 0xff) + chr((u32 >> 24) & 0xff))
+
+def load_number(stream):
+    return load_word(stream)
+
+def load_word(stream):
+    pos = stream.consume(4)
+    return ((ord(stream.char_at(pos + 3)) << 24) |
+            (ord(stream.char_at(pos + 2)) << 16) |
+            (ord(stream.char_at(pos + 1)) << 8) | ord(stream.char_at(pos)))
+
+# ___________________________________________________________________________
+# the format of version 1, which used fixed 4-byte numbers.
+
+def load_skel_v1(stream):
+    codes = load_instr_list_v1(stream)
+    consts = load_const_list_v1(stream)
     frame_size = load_number(stream)
 
     ncellvalues = load_number(stream)
     cellvalues = [-1] * ncellvalues
     for i in xrange(ncellvalues):
         cellvalues[i] = load_number(stream)
-    
+
     nfresh_cells = load_number(stream)
     fresh_cells = [-1] * nfresh_cells
     for i in xrange(nfresh_cells):
         fresh_cells[i] = load_number(stream)
+    # version 1 opened the cellvalues when the frame was entered. Branches
+    # are relative, so prepending doesn't change them.
+    open_cells = [None] * nfresh_cells
+    for i in xrange(nfresh_cells):
+        open_cells[i] = OpenCell(i, fresh_cells[i])
+    codes = open_cells + codes
 
     nb_args = load_number(stream)
-    nxt_chr = stream.read(1)
-    if nxt_chr == '\x01':
-        varargs_p = True
-    elif nxt_chr == '\x00':
-        varargs_p = False
-    else:
-        raise ValueError('hasvararg -- not 0/1')
-
-    stream.read(1) # the newline
-    return W_Skeleton(codes, consts, frame_size,
-            cellvalues, fresh_cells, nb_args, varargs_p, None)
-
-def load_instr_list(stream):
+    varargs_p = load_bool(stream, 'hasvararg')
+    if stream.read_char() != '\n':
+        # the development versions which added a captured flag here kept
+        # the header of version 1.
+        raise ValueError('chunk -- unsupported version, recompile it')
+    return W_Skeleton(codes, consts, frame_size, cellvalues, fresh_cells,
+            nb_args, varargs_p, len(fresh_cells) != 0, None)
+
+def load_instr_list_v1(stream):
     ncodes = load_number(stream)
     codes = [None] * ncodes
     for i in xrange(ncodes):
-        codes[i] = load_instr(stream)
+        codes[i] = load_instr_v1(stream)
     return codes
 
-def load_instr(stream):
-    u32 = load_number(stream)
-    instr = make_instr(u32)
-    return instr
-
-def load_const_list(stream):
+def load_instr_v1(stream):
+    """ An instruction word of version 1, op:5 A:9 B:9 C:9, in which Bx
+        was written at B's offset, so that it also overlapped A.
+    """
+    u32 = load_word(stream)
+    op = u32 >> 27
+    A = (u32 >> 18) & 0x1ff
+    B = (u32 >> 9) & 0x1ff
+    C = u32 & 0x1ff
+    Bx = (u32 >> 9) & 0x3ffff
+    if op == BranchIfFalse.op_num:
+        # only the bits of Bx that A didn't overwrite.
+        Bx &= 0x1ff
+    return new_instr(op, A, B, C, Bx)
+
+def load_const_list_v1(stream):
     nconsts = load_number(stream)
     consts = [None] * nconsts
     for i in xrange(nconsts):
-        consts[i] = load_const(stream)
+        consts[i] = load_const_v1(stream)
     return consts
 
-def load_const(stream):
-    tag = stream.read(1)
-    if tag == K_SYMBOL:
-        return make_symbol(load_string(stream))
-
-    elif tag == K_FIXNUM:
-        return W_Fixnum(load_number(stream))
-
-    elif tag == K_PAIR:
-        # XXX: recursive call -- stack overflow?
-        car = load_const(stream)
-        cdr = load_const(stream)
-        return W_Pair(car, cdr)
-
-    elif tag == K_NULL:
-        return w_nil
-
-    elif tag == K_TRUE:
-        return make_bool(True)
-
-    elif tag == K_FALSE:
-        return make_bool(False)
-
-    elif tag == K_UNSPEC:
-        return w_unspecified
-
-    else:
-        raise ValueError('unknown tag -- %s' % tag)
-
-def load_number(stream):
-    """ Ugly since RPython want the string to be of length 1...
+def load_const_v1(stream):
+    """ A constant of version 1, in which a pair is K_PAIR followed by its
+        car and its cdr. The pairs whose car or cdr is yet to be read are
+        kept on a stack, since the pairs of a list nest in their cdrs.
     """
-    c1 = stream.read(1)[0]
-    v1 = ord(c1)
-
-    c2 = stream.read(1)[0]
-    v2 = ord(c2)
-
-    c3 = stream.read(1)[0]
-    v3 = ord(c3)
+    pairs = []
+    cars_read = []
+    while True:
+        tag = stream.read_char()
+        if tag == K_PAIR:
+            pairs.append(W_Pair(w_nil, w_nil))
+            cars_read.append(False)
+            continue
+
+        elif tag == K_SYMBOL:
+            w_value = make_symbol(load_string(stream))
+
+        elif tag == K_FIXNUM:
+            ival = load_number(stream)
+            if ival >= 1 << 31: # it was dumped in two's complement
+                ival -= 1 << 32
+            w_value = W_Fixnum(ival)
 
-    c4 = stream.read(1)[0]
-    v4 = ord(c4)
-    return (v4 << 24) | (v3 << 16) | (v2 << 8) | v1
+        else:
+            w_value = load_atom(tag)
+
+        # w_value completes the pairs whose cdr it is
+        while pairs and cars_read[-1]:
+            w_pair = pairs.pop()
+            cars_read.pop()
+            w_pair.cdr = w_value
+            w_value = w_pair
+        if not pairs:
+            return w_value
+        pairs[-1].car = w_value
+        cars_read[-1] = True
+
+def load_bool(stream, what):
+    nxt_chr = stream.read_char()
+    if nxt_chr == '\x01':
+        return True
+    elif nxt_chr == '\x00':
+        return False
+    else:
+        raise ValueError('%s -- not 0/1' % what)
 
 def load_string(stream):
-    slen = load_number(stream)
-    buf = []
-    while slen > 0:
-        s = stream.read(slen)
-        slen -= len(s)
-        buf.append(s)
-    return ''.join(buf)
-
+    return stream.read(load_number(stream))
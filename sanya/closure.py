@@ -3,7 +3,7 @@
 from pypy.rlib.jit import unroll_safe
 from sanya.objectmodel import W_Root
 
-# XXX: consider unify this with vm.Dump and vm.Frame?
+# XXX: consider unify this with vm.CallInfo?
 class W_Skeleton(W_Root):
     """ Closure skeleton, just like function prototype in Lua,
         contains every runtime information about a closure,
@@ -29,15 +29,22 @@ class W_Skeleton(W_Root):
                         ; when entering a new closure
             nb_args ; number of args required
             varargs_p ; whether the closure accepts varargs or not.
+            captured_p ; whether some local of this closure's frame is
+                       ; captured by an inner closure. If not, entering
+                       ; and leaving the frame doesn't need to create or
+                       ; escape any cellvalue.
             skeleton_registry ; list of skeletons, @see Lua's KPROTO
+            global_cells ; maps the index of a global's name in {consts} to
+                         ; its binding cell. Filled in by vm.link_skeleton().
     """
     _immutable_fields_ = ['codes', 'consts', 'frame_size', 'cell_recipt',
-                          'fresh_cells', 'nb_args', 'varargs_p']
+                          'fresh_cells', 'nb_args', 'varargs_p', 'captured_p']
 
     def __init__(self, codes, consts, frame_size, cell_recipt,
-            fresh_cells, nb_args, varargs_p, skeleton_registry):
+            fresh_cells, nb_args, varargs_p, captured_p, skeleton_registry):
         # Those are all immutables except for skeleton_registry, which
-        # will be set to None when bootstraping vm.
+        # will be set to None when bootstraping vm, and global_cells, which
+        # is filled in when linking.
         self.codes = codes
         self.consts = consts
         self.frame_size = frame_size
@@ -45,7 +52,9 @@ class W_Skeleton(W_Root):
         self.fresh_cells = fresh_cells
         self.nb_args = nb_args
         self.varargs_p = varargs_p
+        self.captured_p = captured_p
         self.skeleton_registry = skeleton_registry
+        self.global_cells = None
 
     def is_procedure_skeleton(self):
         return True
@@ -107,19 +116,20 @@ class W_CellValue(W_Root):
     """ Cellvalues are used to implement nested scope / closures.
 
         A cellvalue can be in two status: not-escaped or escaped.
-        When it's not escaped, it contains a frame and an index pointing
-        to a frame slot. When it's escaped, the value on the frame slot
-        will be 'grabbed' out and stored inside this cell.
+        When it's not escaped, it contains the vm's register stack and the
+        absolute index of a stack slot. When it's escaped, the value on the
+        stack slot will be 'grabbed' out and stored inside this cell.
 
         Cellvalues only exist in closure instances that is built
         during runtime, since cellvalue's constructor require an
-        existing frame as the first parameter.
+        existing stack as the first parameter.
     """
-    def __init__(self, baseframe, slotindex):
-        self.baseframe = baseframe
-        self.slotindex = slotindex
+    def __init__(self, stack, stackindex):
+        self.stack = stack
+        self.stackindex = stackindex
         self.escaped = False
         self.escaped_value = None
+        self.next_open = None # @see vm.VM.open_cellvalue
 
     def to_string(self):
         return '#<cellvalue>'
@@ -131,8 +141,7 @@ class W_CellValue(W_Root):
         buf.append('cellvalue value=')
         buf.append(self.getvalue().to_string())
         if not self.escaped:
-            buf.append(' frame=%s' % str(self.baseframe))
-            buf.append(' slotindex=%s' % str(self.slotindex))
+            buf.append(' stackindex=%s' % str(self.stackindex))
         buf.append('>')
         return ''.join(buf)
 
@@ -143,47 +152,32 @@ class W_CellValue(W_Root):
         if self.escaped:
             return self.escaped_value
         else:
-            return self.baseframe[self.slotindex]
+            return self.stack[self.stackindex]
 
     def setvalue(self, value):
         if self.escaped:
             self.escaped_value = value
         else:
-            self.baseframe[self.slotindex] = value
-
-    def try_escape(self, frame):
-        if self.baseframe is frame:
-            self.escaped = True
-            self.escaped_value = self.baseframe[self.slotindex]
-            self.baseframe = None
-            self.slotindex = -1
-            return True
-        else:
-            return False
+            self.stack[self.stackindex] = value
 
-class CellValueNode(object):
-    """ Container class to store cellvalues in doubly-linked list.
-    """
-    _immutable_fields_ = ['val']
-    def __init__(self, val, prevnode, nextnode):
-        self.val = val
-        self.prevnode = prevnode
-        self.nextnode = nextnode
-
-    def remove(self):
-        """ Return this node and return the next node.
+    def escape(self):
+        """ Grab the value out of the stack slot, which is about to die.
         """
-        res = self.nextnode
-        self.prevnode.nextnode = self.nextnode
-        self.nextnode.prevnode = self.prevnode
-        self.nextnode = None
-        self.prevnode = None
-        return res
+        self.escaped = True
+        self.escaped_value = self.stack[self.stackindex]
+        self.stack = None
+        self.stackindex = -1
 
-    def append(self, val):
-        """ Hmmm... The name of this function should actually be ``prepend``.
-        """
-        new_node = CellValueNode(val, self, self.nextnode)
-        self.nextnode.prevnode = new_node
-        self.nextnode = new_node
+class W_GlobalCell(W_Root):
+    """ Binding cell of a global variable. There is exactly one per global
+        name in a vm, and skeletons are linked against them so that global
+        accesses don't have to hash the name.
 
+        w_value is None while the global is not defined yet.
+    """
+    def __init__(self, w_symbol):
+        self.w_symbol = w_symbol
+        self.w_value = None
+
+    def to_string(self):
+        return '#<global-cell %s>' % self.w_symbol.to_string()
@@ -1,25 +1,601 @@
 """ Things to concern:
     - How to make sure cellvalues are shared? <== The main point of this impl.
     - How to efficiently allocate frame slots?
+      Locals keep their slot, temporaries are given back as soon as their
+      value is consumed, @see SkeletonWalker.alloc_frame_slot
     - Deferred allocation of frame slot: Yes I can learn from my libjit impl.
 """
 
 from pypy.rlib.jit import dont_look_inside
 from sanya.instruction_set import (Instr, MoveLocal, LoadConst,
         LoadCell, LoadGlobal, StoreCell, StoreGlobal, BuildClosure,
-        Return, BranchIfFalse, Branch, TailCall, Call)
-from sanya.objectmodel import w_unspecified, scmlist2py
+        Return, BranchIfFalse, Branch, BranchBack, TailCall, Call,
+        CallKnown, TailCallKnown, OpenCell, arith_instr_map,
+        compare_and_branch_map, inlined_primitive_names)
+from sanya.objectmodel import (w_unspecified, w_nil, scmlist2py,
+        pylist2scm, make_symbol, W_Pair)
 from sanya.closure import W_Skeleton
+from sanya.config import (CONSTANT_FOLDING, PEEPHOLE, INLINE_BUDGET,
+        INLINE_REPORT)
+from sanya.optimize import fold_constants, peephole, remove_instrs
 
 class SchemeSyntaxError(Exception):
     pass
 
+# bumped whenever the code that the compiler generates changes, so that the
+# chunks compiled before aren't used any more. @see chunkcache
+COMPILER_REVISION = 5
+
 @dont_look_inside
 def compile_list_of_expr(expr_list):
     # using default sematics.
-    walker = SkeletonWalker()
-    walker.visit_list_of_expr(expr_list)
-    return walker.to_closure_skeleton()
+    return CompilationSession(whole_program_p=True).compile(expr_list)
+
+class CompilationSession(object):
+    """ Compiles the successive inputs of a repl, or of a program that
+        embeds the vm, for one vm.
+
+        The skeletons of every input go to the same skeleton_registry,
+        which only grows, so that the closures and the code of the earlier
+        inputs still find theirs. The vm then only links the new ones.
+        @see vm.VM.bootstrap
+
+        Constants are only folded when the input is the whole program,
+        which whole_program_p tells: a later input could rebind a
+        primitive that the code of the earlier ones was folded with.
+    """
+    def __init__(self, whole_program_p=False):
+        self.skeleton_registry = []
+        self.whole_program_p = whole_program_p
+
+    @dont_look_inside
+    def compile(self, expr_list):
+        """ Return the toplevel skeleton of expr_list.
+        """
+        scan = BindingScan(expr_list)
+        nb_skeletons = len(self.skeleton_registry)
+        if self.whole_program_p:
+            assert nb_skeletons == 0, 'a whole program is compiled once'
+        walker = SkeletonWalker()
+        walker.skeleton_registry = self.skeleton_registry
+        walker.fold_constants_p = (CONSTANT_FOLDING and self.whole_program_p
+                                   and not rebinds_primitive(scan))
+        # the toplevel's locals are those of the lambdas inlined into it.
+        walker.set_binding_scan(scan)
+        try:
+            walker.visit_list_of_expr(expr_list)
+            w_skel = walker.to_closure_skeleton()
+        except SchemeSyntaxError:
+            # forget the skeletons of the input, some are not compiled.
+            del self.skeleton_registry[nb_skeletons:]
+            raise
+        if INLINE_REPORT:
+            walker.print_inline_report()
+        return w_skel
+
+def rebinds_primitive(scan):
+    """ Whether there is a (define name ...) or (set! name ...) of one of the
+        builtins that constant folding relies on, anywhere in the
+        expressions of scan, a BindingScan of the whole program.
+        @see optimize.ConstantFolder
+    """
+    for sval in inlined_primitive_names:
+        if sval in scan.nb_defines or sval in scan.rebound:
+            return True
+    return False
+
+class BindingScan(object):
+    """ Finds the (define name ...) and (set! name ...) forms anywhere in a
+        list of expressions, including the nested lambdas. This looks at
+        the syntax only, so it may see forms that aren't, e.g., inside a
+        quote. The answers are thus conservative.
+
+        The scan of a lambda body is given the set! forms of the whole
+        program, and then skips the nested lambdas but the immediately
+        applied ones, since the defines of the others bind their own
+        locals. Every lambda is thus scanned once, rather than once per
+        enclosing lambda.
+    """
+    def __init__(self, expr_list, rebound=None):
+        self.nb_defines = {} # maps name to the number of its defines
+        self.lambda_defined = {} # names defined to a lambda at least once
+        nested_p = rebound is None
+        if rebound is None:
+            rebound = {}
+        self.rebound = rebound # names that are set!
+        pending = expr_list[:]
+        while pending:
+            w_expr = pending.pop()
+            if not w_expr.is_pair():
+                continue
+            assert isinstance(w_expr, W_Pair)
+            if not nested_p and is_lambda_form(w_expr):
+                continue
+            self.scan_form(w_expr, nested_p)
+            w_head = w_expr.car
+            if is_lambda_form(w_head): # then (formals . body) is scanned
+                assert isinstance(w_head, W_Pair)
+                w_head = w_head.cdr
+            pending.append(w_head)
+            w_rest = w_expr.cdr
+            while w_rest.is_pair():
+                assert isinstance(w_rest, W_Pair)
+                pending.append(w_rest.car)
+                w_rest = w_rest.cdr
+
+    def scan_form(self, w_form, nested_p):
+        w_head = w_form.car
+        w_rest = w_form.cdr
+        if not w_head.is_symbol() or not w_rest.is_pair():
+            return
+        assert isinstance(w_rest, W_Pair)
+        w_name = w_rest.car
+        if not w_name.is_symbol():
+            return
+        sval = w_name.to_string()
+        if w_head.to_string() == 'define':
+            self.nb_defines[sval] = self.nb_defines.get(sval, 0) + 1
+            if w_rest.cdr.is_pair():
+                w_value = w_rest.cdr
+                assert isinstance(w_value, W_Pair)
+                if is_lambda_form(w_value.car):
+                    self.lambda_defined[sval] = None
+        elif w_head.to_string() == 'set!' and nested_p:
+            self.rebound[sval] = None
+
+    def defined_once_to_lambda(self, sval):
+        return (self.nb_defines.get(sval, 0) == 1 and
+                sval in self.lambda_defined and sval not in self.rebound)
+
+def heap_push(heap, item):
+    """ Add item to heap, a list whose item at index i is no larger than
+        those at 2 * i + 1 and 2 * i + 2.
+    """
+    i = len(heap)
+    heap.append(item)
+    while i > 0:
+        parent = (i - 1) >> 1
+        if heap[parent] <= item:
+            break
+        heap[i] = heap[parent]
+        i = parent
+    heap[i] = item
+
+def heap_pop(heap):
+    """ Remove and return the smallest item of heap, @see heap_push
+    """
+    smallest = heap[0]
+    item = heap.pop()
+    size = len(heap)
+    if size > 0:
+        i = 0
+        while True:
+            child = 2 * i + 1
+            if child >= size:
+                break
+            if child + 1 < size and heap[child + 1] < heap[child]:
+                child += 1
+            if item <= heap[child]:
+                break
+            heap[i] = heap[child]
+            i = child
+        heap[i] = item
+    return smallest
+
+def is_lambda_form(w_expr):
+    if not w_expr.is_pair():
+        return False
+    assert isinstance(w_expr, W_Pair)
+    return w_expr.car.is_symbol() and w_expr.car.to_string() == 'lambda'
+
+def collect_symbols(expr_list, symbols):
+    """ Add every symbol in expr_list to the dict symbols, and return the
+        number of pairs and atoms in it.
+    """
+    size = 0
+    pending = expr_list[:]
+    while pending:
+        w_expr = pending.pop()
+        if w_expr.is_pair():
+            assert isinstance(w_expr, W_Pair)
+            pending.append(w_expr.car)
+            pending.append(w_expr.cdr)
+        elif w_expr.is_null():
+            continue
+        elif w_expr.is_symbol():
+            symbols[w_expr.to_string()] = None
+        size += 1
+    return size
+
+def may_capture(expr_list, memo):
+    """ Whether a closure may be created in expr_list: it has a lambda, or
+        a named let or a do, whose loop may be compiled as a closure.
+        @see LoopScan
+        memo maps the pairs scanned to the answer for them, so that the
+        nested forms, which are asked about in turn, are scanned once.
+    """
+    for w_root in expr_list:
+        pending = [w_root]
+        while pending:
+            w_expr = pending[-1]
+            if not w_expr.is_pair() or w_expr in memo:
+                pending.pop()
+                continue
+            assert isinstance(w_expr, W_Pair)
+            if capture_form_p(w_expr):
+                memo[w_expr] = True
+                pending.pop()
+                continue
+            w_car = w_expr.car
+            w_cdr = w_expr.cdr
+            car_p = w_car.is_pair() and w_car not in memo
+            cdr_p = w_cdr.is_pair() and w_cdr not in memo
+            if car_p:
+                pending.append(w_car)
+            if cdr_p:
+                pending.append(w_cdr)
+            if not (car_p or cdr_p): # both are answered
+                memo[w_expr] = ((w_car.is_pair() and memo[w_car]) or
+                                (w_cdr.is_pair() and memo[w_cdr]))
+                pending.pop()
+        if w_root.is_pair() and memo[w_root]:
+            return True
+    return False
+
+def capture_form_p(w_expr):
+    w_head = w_expr.car
+    if not w_head.is_symbol():
+        return False
+    head = w_head.to_string()
+    if head == 'lambda' or head == 'do':
+        return True
+    w_rest = w_expr.cdr
+    if head == 'let' and w_rest.is_pair():
+        assert isinstance(w_rest, W_Pair)
+        return w_rest.car.is_symbol()
+    return False
+
+def symbols_p(items_w):
+    for w_item in items_w:
+        if not w_item.is_symbol():
+            return False
+    return True
+
+def symbol_names(symbols_w):
+    return [w_symbol.to_string() for w_symbol in symbols_w]
+
+def parse_bindings(w_bindings, names, inits, steps=None):
+    """ Append the names and init expressions of w_bindings, which is
+        ((name init) ...), to names and inits. If steps is given, the
+        bindings are those of a do, (name init [step]), and the steps are
+        appended to it, None for the missing ones. Return whether
+        w_bindings is well-formed.
+    """
+    lst = []
+    if not scmlist2py(w_bindings, lst).is_null():
+        return False
+    for w_binding in lst:
+        binding = []
+        if not scmlist2py(w_binding, binding).is_null():
+            return False
+        if len(binding) == 2:
+            if steps is not None:
+                steps.append(None)
+        elif len(binding) != 3 or steps is None:
+            return False
+        else:
+            steps.append(binding[2])
+        if not binding[0].is_symbol():
+            return False
+        names.append(binding[0])
+        inits.append(binding[1])
+    return True
+
+class LoopCandidate(object):
+    """ A named let or a do, in a LoopScan.
+    """
+    def __init__(self, w_key, name, argcount):
+        self.w_key = w_key # the cdr of the form
+        self.name = name
+        self.argcount = argcount
+        self.failed_p = False
+        # the index of the enclosing candidate of the same name, or -1
+        self.outer_index = -1
+
+class LoopScan(object):
+    """ Finds whether each named let, (let name (argcount bindings) .
+        body), in a form can be compiled to a loop: body creates no closure
+        and refers to name only by calling it with argcount arguments in
+        tail position, so that the calls can branch back. A do is a loop
+        when its body creates no closure. @see do_as_named_let
+        This looks at the syntax only, and says no to anything it isn't
+        sure about. An inner loop which is a closure is one such thing, so
+        the enclosing ones are closures too.
+
+        The form is walked once, however its loops nest, and the answers go
+        to memo, keyed by the cdr of the loop forms. An expression is in
+        tail position in the candidates from its tail_from on, those
+        entered since its last step that is not in tail position.
+    """
+    def __init__(self, memo):
+        self.memo = memo
+        self.candidates = [] # the enclosing ones, innermost last
+        self.name_index = {} # maps a name to its innermost candidate
+        # the expressions to scan with their tail_from, or the candidates
+        # to enter (ENTER) or to leave (LEAVE), the next one last.
+        self.pending = []
+        self.pending_tail_from = []
+        self.pending_candidates = []
+
+    ENTER = -1
+    LEAVE = -2
+
+    def scan(self, w_form):
+        self.push_expr(w_form, 0)
+        while self.pending:
+            w_expr = self.pending.pop()
+            tail_from = self.pending_tail_from.pop()
+            candidate = self.pending_candidates.pop()
+            if candidate is None:
+                self.scan_expr(w_expr, tail_from)
+            elif tail_from == self.ENTER:
+                self.enter(candidate)
+            else:
+                self.leave(candidate)
+
+    def push_expr(self, w_expr, tail_from, candidate=None):
+        self.pending.append(w_expr)
+        self.pending_tail_from.append(tail_from)
+        self.pending_candidates.append(candidate)
+
+    def push_exprs(self, exprs, tail_from):
+        # the first one is scanned first
+        for i in xrange(len(exprs) - 1, -1, -1):
+            self.push_expr(exprs[i], tail_from)
+
+    def push_body(self, body, tail_from, inner_from):
+        """ Only the last expression of body is in tail position.
+        """
+        if body:
+            self.push_expr(body[-1], tail_from)
+            self.push_exprs(body[:-1], inner_from)
+
+    def enter(self, candidate):
+        candidate.outer_index = self.name_index.get(candidate.name, -1)
+        self.name_index[candidate.name] = len(self.candidates)
+        self.candidates.append(candidate)
+        if candidate.name in SkeletonWalker.special_form_list:
+            self.fail_all()
+
+    def leave(self, candidate):
+        self.candidates.pop()
+        if candidate.outer_index < 0:
+            del self.name_index[candidate.name]
+        else:
+            self.name_index[candidate.name] = candidate.outer_index
+        self.memo[candidate.w_key] = not candidate.failed_p
+
+    def fail(self, index):
+        """ The candidate at index isn't a loop, nor are the enclosing ones.
+        """
+        while index >= 0 and not self.candidates[index].failed_p:
+            self.candidates[index].failed_p = True
+            index -= 1
+
+    def fail_all(self):
+        self.fail(len(self.candidates) - 1)
+
+    def fail_name(self, sval):
+        if sval in self.name_index:
+            self.fail(self.name_index[sval])
+
+    def scan_expr(self, w_expr, tail_from):
+        # the tail_from of the subexpressions not in tail position, which
+        # is that of those of an inner candidate plus one.
+        inner_from = len(self.candidates)
+        if w_expr.is_symbol():
+            self.fail_name(w_expr.to_string())
+            return
+        if not w_expr.is_pair():
+            return
+        assert isinstance(w_expr, W_Pair)
+        lst = []
+        if not scmlist2py(w_expr.cdr, lst).is_null():
+            self.fail_all()
+            return
+        head = ''
+        if w_expr.car.is_symbol():
+            head = w_expr.car.to_string()
+
+        if head in self.name_index:
+            index = self.name_index[head]
+            if (index < tail_from or
+                    len(lst) != self.candidates[index].argcount):
+                self.fail(index)
+            self.push_exprs(lst, inner_from)
+        elif head == 'quote':
+            pass
+        elif head == 'lambda':
+            self.fail_all()
+        elif head == 'if':
+            if not lst:
+                self.fail_all()
+                return
+            self.push_exprs(lst[1:], tail_from)
+            self.push_expr(lst[0], inner_from)
+        elif head == 'begin':
+            self.push_body(lst, tail_from, inner_from)
+        elif head == 'define' or head == 'set!':
+            if lst and lst[0].is_symbol():
+                self.fail_name(lst[0].to_string())
+            self.push_exprs(lst[1:], inner_from)
+        elif head == 'let' or head == 'let*' or head == 'letrec':
+            if not lst:
+                self.fail_all()
+                return
+            inner = ''
+            if head == 'let' and lst[0].is_symbol():
+                inner = lst[0].to_string()
+                lst = lst[1:]
+                if not lst:
+                    self.fail_all()
+                    return
+                self.fail_name(inner)
+            names = []
+            inits = []
+            if not parse_bindings(lst[0], names, inits):
+                self.fail_all()
+                return
+            for w_name in names:
+                self.fail_name(w_name.to_string())
+            if inner:
+                candidate = LoopCandidate(w_expr.cdr, inner, len(names))
+                self.push_expr(w_expr, self.LEAVE, candidate)
+                self.push_body(lst[1:], tail_from, inner_from + 1)
+                self.push_expr(w_expr, self.ENTER, candidate)
+            else:
+                self.push_body(lst[1:], tail_from, inner_from)
+            self.push_exprs(inits, inner_from)
+        elif head == 'do':
+            names = []
+            inits = []
+            steps = []
+            test = []
+            if (len(lst) < 2 or
+                    not parse_bindings(lst[0], names, inits, steps) or
+                    not scmlist2py(lst[1], test).is_null() or not test):
+                self.fail_all()
+                return
+            for w_name in names:
+                self.fail_name(w_name.to_string())
+            # its name can't be referred to. @see do_as_named_let
+            candidate = LoopCandidate(w_expr.cdr, do_loop_symbol.to_string(),
+                                      len(names))
+            self.push_expr(w_expr, self.LEAVE, candidate)
+            for w_step in steps:
+                if w_step is not None:
+                    self.push_expr(w_step, inner_from + 1)
+            self.push_exprs(lst[2:], inner_from + 1)
+            self.push_body(test[1:], tail_from, inner_from + 1)
+            self.push_expr(test[0], inner_from + 1)
+            self.push_expr(w_expr, self.ENTER, candidate)
+            self.push_exprs(inits, inner_from)
+        else:
+            # an application
+            self.push_exprs(lst, inner_from)
+            self.push_expr(w_expr.car, inner_from)
+
+# _________________________________________________________________________
+# the binding forms which are compiled as closures, when they can't be
+# compiled to frame slots or loops.
+
+lambda_symbol = make_symbol('lambda')
+define_symbol = make_symbol('define')
+let_symbol = make_symbol('let')
+do_symbol = make_symbol('do')
+letrec_symbol = make_symbol('letrec')
+if_symbol = make_symbol('if')
+begin_symbol = make_symbol('begin')
+# not readable, so it doesn't clash with the names in the program.
+do_loop_symbol = make_symbol('do loop')
+
+def let_as_application(names, inits, body):
+    """ ((lambda (name ...) . body) init ...)
+    """
+    w_lambda = W_Pair(lambda_symbol, W_Pair(pylist2scm(names),
+                                            pylist2scm(body)))
+    return W_Pair(w_lambda, pylist2scm(inits))
+
+def letrec_as_application(names, inits, body):
+    """ ((lambda () (define name init) ... . body))
+    """
+    forms = []
+    for i in xrange(len(names)):
+        forms.append(pylist2scm([define_symbol, names[i], inits[i]]))
+    forms.extend(body)
+    return pylist2scm([W_Pair(lambda_symbol, W_Pair(w_nil,
+                                                   pylist2scm(forms)))])
+
+def named_let_as_application(w_name, names, inits, body):
+    """ ((letrec ((name (lambda (name ...) . body))) name) init ...)
+    """
+    w_lambda = W_Pair(lambda_symbol, W_Pair(pylist2scm(names),
+                                            pylist2scm(body)))
+    w_letrec = pylist2scm([letrec_symbol,
+                          pylist2scm([pylist2scm([w_name, w_lambda])]),
+                          w_name])
+    return W_Pair(w_letrec, pylist2scm(inits))
+
+def let_star_as_let(names, inits, body):
+    """ (let ((name init)) (let ((name init)) ... (let () . body)))
+    """
+    w_expr = W_Pair(let_symbol, W_Pair(w_nil, pylist2scm(body)))
+    for i in xrange(len(names) - 1, -1, -1):
+        w_binding = pylist2scm([names[i], inits[i]])
+        w_expr = pylist2scm([let_symbol, pylist2scm([w_binding]), w_expr])
+    return w_expr
+
+def do_as_named_let(names, inits, steps, test, commands):
+    """ (let <do loop> ((name init) ...)
+            (if test (begin . results)
+                (begin command ... (<do loop> step ...))))
+        where a missing step is the name itself.
+    """
+    bindings = []
+    next_values = []
+    for i in xrange(len(names)):
+        bindings.append(pylist2scm([names[i], inits[i]]))
+        if steps[i] is None:
+            next_values.append(names[i])
+        else:
+            next_values.append(steps[i])
+    w_next = W_Pair(do_loop_symbol, pylist2scm(next_values))
+    w_results = W_Pair(begin_symbol, pylist2scm(test[1:]))
+    w_commands = W_Pair(begin_symbol, pylist2scm(commands + [w_next]))
+    w_body = pylist2scm([if_symbol, test[0], w_results, w_commands])
+    return pylist2scm([let_symbol, do_loop_symbol, pylist2scm(bindings),
+                      w_body])
+
+class KnownProcedure(object):
+    """ A local that is bound once and for all to a lambda, whose skeleton
+        will be skeleton_registry[skel_index]. @see CallKnown
+    """
+    def __init__(self, skel_index, nb_args, varargs_p):
+        self.skel_index = skel_index
+        self.nb_args = nb_args
+        self.varargs_p = varargs_p
+        # the rest is about inlining, @see SkeletonWalker.may_inline
+        self.name = ''
+        self.owner = None # the walker that defines it
+        self.scopes = [] # the owner's scopes the lambda is in
+        self.params = [] # formal names
+        self.body = [] # the lambda body, a pylist
+        self.body_size = 0
+        self.body_symbols = {} # every symbol in the body
+
+    def accepts(self, argcount):
+        if self.varargs_p:
+            return argcount >= self.nb_args
+        return argcount == self.nb_args
+
+    def set_body(self, name, owner, scopes, params, body):
+        self.name = name
+        self.owner = owner
+        self.scopes = scopes
+        self.params = params
+        self.body = body
+        self.body_size = collect_symbols(body, self.body_symbols)
+        self.capture_p = may_capture(body, owner.capture_memo)
+
+    def inlinable_p(self):
+        """ Whether the body may be substituted for a call at all: it's
+            small, not recursive and it neither creates a closure nor
+            binds a local.
+        """
+        symbols = self.body_symbols
+        return (not self.varargs_p and self.body_size <= INLINE_BUDGET and
+                not self.capture_p and 'define' not in symbols and
+                self.name not in symbols)
 
 # XXX: how to better represent multiple flags?
 class CompilationFlag(object):
@@ -57,6 +633,9 @@ class SkeletonWalker(Walker):
         self.global_variables = {} # hmmm... not used until we can modify glvar
         self.instrs = []
         self.frame_size = 0
+        self.slot_states = [] # SLOT_*, for each frame slot
+        # a heap of the slots that were freed, @see alloc_frame_slot
+        self.free_slots = []
         self.consts = []
         self.const_index_map = {} # maps consts to its id
         self.cell_recipe = [] # list of packed ints, @see closure.ClosSkel 
@@ -64,8 +643,23 @@ class SkeletonWalker(Walker):
         # temporarily maps frame index to shadow_cv's index
         self.fresh_cell_map = {}
         self.fresh_cells = [] # list of ints
+        # maps a frame index to the instrs indices where it was allocated to
+        # a binding, in order, @see alloc_local_slot
+        self.local_allocs = {}
+        # the (frame index, BuildClosure's instrs index) of each capture
+        # of a local by an inner lambda, @see place_open_cells
+        self.captures = []
+        # the instrs index of this walker's BuildClosure in its parent
+        self.closure_index = -1
+        # the slots reserved for the defines of the bodies being visited,
+        # by name, innermost last. @see reserve_defines
+        self.reserved_slots = []
 
         self.local_variables = {} # frame variable and opened cellvalues
+        # the bindings of the let forms and of the inlined procedures'
+        # arguments, which shadow local_variables, innermost last.
+        # @see push_scope
+        self.scopes = []
         self.nb_args = 0
         self.varargs_p = False
         if parent_skeleton:
@@ -75,28 +669,207 @@ class SkeletonWalker(Walker):
 
         self.parent_skeleton = parent_skeleton
         self.deferred_lambdas = []
+        # deferred_lambdas[:nb_resumed_lambdas] are being or were compiled
+        self.nb_resumed_lambdas = 0
+        # index of this skeleton in skeleton_registry, -1 for the toplevel.
+        self.skel_index = -1
+        # locals which may be KnownProcedures, @see BindingScan
+        self.known_candidates = {}
+        # the BindingScan of the compiled expressions, @see set_binding_scan
+        self.binding_scan = None
+        # names of the KnownProcedures whose body is being inlined
+        self.inlining = {}
+        # maps an inlined procedure's description to its call site count,
+        # shared by the whole program. @see print_inline_report
+        if parent_skeleton:
+            self.inline_report = parent_skeleton.inline_report
+        else:
+            self.inline_report = {}
+        # the memos of may_capture and of LoopScan, shared by the whole
+        # program.
+        if parent_skeleton:
+            self.capture_memo = parent_skeleton.capture_memo
+            self.loop_memo = parent_skeleton.loop_memo
+        else:
+            self.capture_memo = {}
+            self.loop_memo = {}
+        if parent_skeleton:
+            self.fold_constants_p = parent_skeleton.fold_constants_p
+        else:
+            self.fold_constants_p = CONSTANT_FOLDING
+
+        # the forms whose subexpressions are being visited, innermost
+        # last. @see visit
+        self.form_visits = []
+        # number of applications whose proc and arguments are being
+        # evaluated. A callee's frame overlaps every slot above its proc
+        # slot, so no local binding may be created while this is nonzero.
+        self.pending_applications = 0
 
     @dont_look_inside
     def to_closure_skeleton(self):
-        for dfd_lambda in self.deferred_lambdas:
-            dfd_lambda.resume_compilation()
+        """ Compile the deferred lambdas, and theirs in turn, and return
+            the skeleton of this walker.
+
+            A walker is finished after all the lambdas inside it, which may
+            open its slots as cellvalues. The walkers being compiled are
+            kept on an explicit stack, innermost last, so that the depth
+            of nested lambdas, e.g. in a CPS-transformed program, is not
+            limited by that of the interpreter's stack.
+        """
+        walkers = [self]
+        dfd_lambdas = [None] # the lambda each of walkers compiles
+        while True:
+            walker = walkers[-1]
+            if walker.nb_resumed_lambdas < len(walker.deferred_lambdas):
+                dfd_lambda = walker.deferred_lambdas[
+                        walker.nb_resumed_lambdas]
+                walker.nb_resumed_lambdas += 1
+                walkers.append(dfd_lambda.resume_compilation())
+                dfd_lambdas.append(dfd_lambda)
+                continue
+            walkers.pop()
+            dfd_lambda = dfd_lambdas.pop()
+            w_skel = walker.finish_skeleton()
+            if dfd_lambda is None:
+                return w_skel
+            dfd_lambda.finish_compilation(w_skel)
+
+    @dont_look_inside
+    def finish_skeleton(self):
+        """ Optimize the instrs and build the skeleton, once every lambda
+            inside this walker is compiled.
+        """
         self.deferred_lambdas = []
+        self.nb_resumed_lambdas = 0
+
+        self.instrs = self.place_open_cells()
+        if self.fold_constants_p:
+            self.instrs = fold_constants(self)
+        if PEEPHOLE:
+            self.instrs = peephole(self)
 
         if self.parent_skeleton: # is not toplevel
             return W_Skeleton(self.instrs,
                     self.consts, self.frame_size,
                     self.cell_recipe, self.fresh_cells,
-                    self.nb_args, self.varargs_p, None)
+                    self.nb_args, self.varargs_p, self.captured_p(), None)
         else: # toplevel -- should pass its closure skeleton table
             return W_Skeleton(self.instrs,
                     self.consts, self.frame_size,
                     self.cell_recipe, self.fresh_cells,
-                    self.nb_args, self.varargs_p, self.skeleton_registry)
+                    self.nb_args, self.varargs_p, self.captured_p(),
+                    self.skeleton_registry)
+
+    def place_open_cells(self):
+        """ Return the instrs, where the placeholders of alloc_local_slot
+            are the OpenCell of the captured bindings or are dropped.
+            A lambda captures the binding of the slot allocated last before
+            its BuildClosure. The internal defines that it refers to ahead
+            are opened on entry instead.
+        """
+        instrs = self.instrs
+        dead = [False] * len(instrs)
+        for i in xrange(len(instrs)):
+            dead[i] = instrs[i] is None
+        entry_cells = []
+        opened_on_entry = {}
+        for slotindex, closure_index in self.captures:
+            shadow_id = self.fresh_cell_map[slotindex]
+            alloc_index = -1
+            for i in self.local_allocs.get(slotindex, []):
+                if i < closure_index:
+                    alloc_index = i
+            if alloc_index >= 0:
+                instrs[alloc_index] = OpenCell(shadow_id, slotindex)
+                dead[alloc_index] = False
+            elif slotindex not in opened_on_entry:
+                opened_on_entry[slotindex] = None
+                entry_cells.append(OpenCell(shadow_id, slotindex))
+        # branches are relative, so prepending doesn't change them.
+        return entry_cells + remove_instrs(instrs, dead)
+
+    def captured_p(self):
+        """ Whether some local of this skeleton is captured by an inner
+            lambda, @see closure.W_Skeleton
+        """
+        return len(self.fresh_cells) != 0
+
+    # Frame slots are either free, hold a temporary value, or hold a local
+    # variable. Temporaries are released by whoever consumes their value,
+    # so that the slot can be reused. Locals are never released since
+    # cellvalues may point to them. The exception is the formals of an
+    # inlined procedure, which nothing can capture.
+    #
+    # A callee's frame overlaps every slot above its proc slot. So the proc
+    # and argument slots of a Call are allocated above every slot in use,
+    # @see alloc_top_slots. Everything else takes the lowest free slot,
+    # which is below the proc slot of every pending call.
+    SLOT_FREE = 0
+    SLOT_TEMP = 1
+    SLOT_LOCAL = 2
+
+    def alloc_frame_slot(self, state=SLOT_TEMP):
+        """ Return the lowest free slot, marked as state.
+
+            Every slot is pushed to the heap free_slots when it's freed, and
+            the heap also keeps those that were taken since by
+            alloc_top_slots, which are skipped here.
+        """
+        slot_states = self.slot_states
+        free_slots = self.free_slots
+        while free_slots:
+            i = heap_pop(free_slots)
+            if slot_states[i] == self.SLOT_FREE:
+                slot_states[i] = state
+                return i
+        return self.push_frame_slots(len(slot_states), 1, state)
+
+    def free_slot(self, slotindex):
+        self.slot_states[slotindex] = self.SLOT_FREE
+        heap_push(self.free_slots, slotindex)
+
+    def alloc_top_slots(self, count):
+        """ Return the first of {count} contiguous temporary slots that sit
+            above every slot in use.
+        """
+        top = len(self.slot_states)
+        while top > 0 and self.slot_states[top - 1] == self.SLOT_FREE:
+            top -= 1
+        return self.push_frame_slots(top, count, self.SLOT_TEMP)
+
+    def push_frame_slots(self, first, count, state):
+        slot_states = self.slot_states
+        for i in xrange(first, first + count):
+            if i < len(slot_states):
+                slot_states[i] = state
+            else:
+                slot_states.append(state)
+        if len(slot_states) > self.frame_size:
+            self.frame_size = len(slot_states)
+        return first
+
+    def alloc_local_slot(self):
+        """ Return the lowest free slot for a new binding, and emit a
+            placeholder for the OpenCell of the binding, in case a lambda
+            captures it. @see place_open_cells
+        """
+        slotindex = self.alloc_frame_slot(self.SLOT_LOCAL)
+        if slotindex in self.local_allocs:
+            self.local_allocs[slotindex].append(len(self.instrs))
+        else:
+            self.local_allocs[slotindex] = [len(self.instrs)]
+        self.instrs.append(None)
+        return slotindex
 
-    def alloc_frame_slot(self):
-        res = self.frame_size
-        self.frame_size += 1
-        return res
+    def release(self, value_repr):
+        """ The value of value_repr is consumed. If it's a temporary, its
+            slot can be reused.
+        """
+        if value_repr.on_frame():
+            slotindex = value_repr.to_index()
+            if self.slot_states[slotindex] == self.SLOT_TEMP:
+                self.free_slot(slotindex)
 
     def new_const_slot(self, w_obj):
         if w_obj in self.const_index_map:
@@ -119,6 +892,101 @@ class SkeletonWalker(Walker):
         assert isinstance(instr, Instr)
         self.instrs.append(instr)
 
+    def set_binding_scan(self, scan):
+        """ scan is the BindingScan of the expressions this compiles. The
+            locals that are defined once to a lambda and never set! are
+            known procedures.
+        """
+        self.binding_scan = scan
+        for sval in scan.lambda_defined:
+            if (scan.defined_once_to_lambda(sval) and
+                    sval not in self.local_variables):
+                self.known_candidates[sval] = None
+
+    def push_scope(self, scope):
+        """ Make the bindings of scope, which maps names to value reprs,
+            visible until the matching pop_scope.
+        """
+        self.scopes.append(scope)
+
+    def pop_scope(self):
+        return self.scopes.pop()
+
+    def close_scope(self, result_value_repr, release_p):
+        """ Pop the innermost scope, whose body evaluated to
+            result_value_repr. If release_p, no closure can refer to its
+            slots, so they are given back; the one holding the result, if
+            any, becomes a temporary of the caller.
+        """
+        scope = self.pop_scope()
+        if release_p:
+            for value_repr in scope.values():
+                if not value_repr.on_frame():
+                    continue
+                if value_repr is result_value_repr:
+                    self.slot_states[value_repr.to_index()] = self.SLOT_TEMP
+                else:
+                    self.free_slot(value_repr.to_index())
+        return result_value_repr
+
+    def may_capture(self, expr_list):
+        return may_capture(expr_list, self.capture_memo)
+
+    def loop_p(self, w_head, w_args):
+        """ Whether the named let or the do (w_head . w_args) can be
+            compiled to a loop. @see LoopScan
+        """
+        if w_args not in self.loop_memo:
+            LoopScan(self.loop_memo).scan(W_Pair(w_head, w_args))
+        return self.loop_memo[w_args]
+
+    def no_lambda_since(self, nb_lambdas):
+        """ Whether no lambda was visited since there were nb_lambdas
+            deferred_lambdas, so that no closure can refer to the slots of
+            the scopes opened since then.
+        """
+        return len(self.deferred_lambdas) == nb_lambdas
+
+    def bind_local(self, sval, value_repr):
+        """ Bind sval in the innermost scope, if any.
+        """
+        if self.scopes:
+            self.scopes[-1][sval] = value_repr
+        else:
+            self.local_variables[sval] = value_repr
+
+    def scoped_lookup(self, sval):
+        """ Return the value repr that sval is bound to in this walker, or
+            None if it's not a local of it (yet).
+        """
+        i = len(self.scopes) - 1
+        while i >= 0:
+            scope = self.scopes[i]
+            if sval in scope:
+                return scope[sval]
+            i -= 1
+        return self.local_variables.get(sval, None)
+
+    def binding_scope(self, sval, scopes):
+        """ Return the innermost of scopes, or local_variables, that binds
+            sval, or None.
+        """
+        i = len(scopes) - 1
+        while i >= 0:
+            if sval in scopes[i]:
+                return scopes[i]
+            i -= 1
+        if sval in self.local_variables:
+            return self.local_variables
+        return None
+
+    def print_inline_report(self):
+        descrs = self.inline_report.keys()
+        descrs.sort()
+        for descr in descrs:
+            print 'inlined %s at %d call sites' % (descr,
+                    self.inline_report[descr])
+
     @dont_look_inside
     def visit_list_of_expr(self, w_exprlist):
         """ Visit a list of expression, compile them to a closure skeleton with
@@ -127,67 +995,129 @@ class SkeletonWalker(Walker):
         """
         tco_flag = CompilationFlag(CompilationFlag.TCO)
         last_value_repr = None
+        if self.parent_skeleton: # the toplevel defines globals
+            self.reserve_defines(w_exprlist, self.local_variables)
         for i in xrange(len(w_exprlist)): # RPython doesn't like enumerate...
             w_expr = w_exprlist[i]
             if i == len(w_exprlist) - 1:
                 last_value_repr = self.visit(w_expr, tco_flag)
             else:
-                last_value_repr = self.visit(w_expr)
+                self.release(self.visit(w_expr))
+        if self.parent_skeleton:
+            self.reserved_slots.pop()
         self.emit(Return(self.cast_to_local(last_value_repr).to_index()))
 
     @dont_look_inside
     def visit(self, w_object, flag=None):
+        """ Visit w_object and return its value repr. A form is visited by
+            a FormVisit, which asks for its subexpressions one at a time,
+            and the ones being run are on form_visits rather than on the
+            interpreter's stack. So deeply nested forms are compiled here,
+            in a loop.
+        """
         if flag is None:
             flag = CompilationFlag()
+        depth = len(self.form_visits)
+        value_repr = self.dispatch(w_object, flag)
+        while len(self.form_visits) > depth:
+            form_visit = self.form_visits[-1]
+            if value_repr is None: # it asks for a subexpression
+                value_repr = self.dispatch(form_visit.w_next,
+                                           form_visit.next_flag)
+            else:
+                value_repr = form_visit.resume(self, value_repr)
+                if value_repr is not None:
+                    self.form_visits.pop()
+        return value_repr
+
+    def dispatch(self, w_object, flag):
+        """ Start visiting w_object: return its value repr, or None if a
+            FormVisit was pushed instead, which visit then runs.
+        """
         return w_object.accept_compiler_walker(self, flag)
 
+    def start_form_visit(self, form_visit):
+        """ Push form_visit and start it. @see dispatch
+        """
+        self.form_visits.append(form_visit)
+        value_repr = form_visit.start(self)
+        if value_repr is not None:
+            self.form_visits.pop()
+        return value_repr
+
     @dont_look_inside
     def local_lookup(self, w_symbol, flag=None):
-        """ Recursively lookup for a symbol until toplevel is reached.
+        """ Lookup for a symbol in this walker, then in the enclosing ones
+            until toplevel is reached. A local of an enclosing walker is
+            opened as a cellvalue in every walker in between, from the
+            outside in.
         """
         assert w_symbol.is_symbol()
         sval = w_symbol.to_string()
 
-        if sval in self.local_variables:
-            return self.local_variables[sval]
-        else:
-            if self.parent_skeleton:
-                # Firstly look at outer's locals to look for cellvalues.
-                # Since we need exactly to open the cellvalue exactly one
-                # level inside the closure with that frame.
-                found = self.parent_skeleton.local_lookup(w_symbol, flag)
-                if found.on_frame():
-                    # Here we share the cellvalue between sibling closures
-                    if (found.slotindex in
-                            self.parent_skeleton.fresh_cell_map):
-                        shadow_id = self.parent_skeleton.fresh_cell_map[
-                            found.slotindex]
-                    else:
-                        shadow_id = self.parent_skeleton.new_fresh_cell(
-                                found.slotindex)
-                        self.parent_skeleton.fresh_cell_map[
-                            found.slotindex] = shadow_id
-
-                    new_cval_index = len(self.cell_recipe)
-                    self.cell_recipe.append(
-                            (shadow_id << 1) | 0x1)
-                    value_repr = CellValueRepr(new_cval_index)
-
-                elif found.is_cell(): # copy from it
-                    new_cval_index = len(self.cell_recipe)
-                    self.cell_recipe.append( # copy outer cellval
-                            found.cellindex << 1)
-                    value_repr = CellValueRepr(new_cval_index)
-
-                elif found.is_global():
-                    return found
-                else:
-                    raise ValueError('unknown value repr -- %s' % found)
-                self.local_variables[sval] = value_repr
-                return value_repr
-            else:
+        # the walkers that don't bind sval, innermost first
+        walkers = []
+        walker = self
+        found = walker.scoped_lookup(sval)
+        while found is None:
+            walkers.append(walker)
+            walker = walker.parent_skeleton
+            if walker is None:
                 # If we cannot find the symbol, then it must be a global.
                 return GlobalValueRepr(w_symbol)
+            found = walker.scoped_lookup(sval)
+
+        i = len(walkers) - 1
+        while i >= 0 and not found.is_global():
+            found = walkers[i].open_cellvalue(sval, found)
+            i -= 1
+        return found
+
+    def open_cellvalue(self, sval, found):
+        """ Bind sval to a new cellvalue of this walker, which refers to
+            found, the value repr sval is bound to in the parent walker.
+            Since we need exactly to open the cellvalue exactly one level
+            inside the closure with that frame.
+        """
+        parent = self.parent_skeleton
+        if found.on_frame():
+            # Here we share the cellvalue between sibling closures
+            if found.slotindex in parent.fresh_cell_map:
+                shadow_id = parent.fresh_cell_map[found.slotindex]
+            else:
+                shadow_id = parent.new_fresh_cell(found.slotindex)
+                parent.fresh_cell_map[found.slotindex] = shadow_id
+            parent.captures.append((found.slotindex, self.closure_index))
+
+            new_cval_index = len(self.cell_recipe)
+            self.cell_recipe.append(
+                    (shadow_id << 1) | 0x1)
+            value_repr = CellValueRepr(new_cval_index)
+
+        elif found.is_cell(): # copy from it
+            new_cval_index = len(self.cell_recipe)
+            self.cell_recipe.append( # copy outer cellval
+                    found.cellindex << 1)
+            value_repr = CellValueRepr(new_cval_index)
+
+        else:
+            raise ValueError('unknown value repr -- %s' % found)
+        value_repr.known = found.known
+        self.local_variables[sval] = value_repr
+        return value_repr
+
+    def lookup_known(self, w_symbol):
+        """ Return the KnownProcedure that w_symbol refers to, or None.
+            Unlike local_lookup, this doesn't open any cellvalue.
+        """
+        sval = w_symbol.to_string()
+        walker = self
+        while walker is not None:
+            found = walker.scoped_lookup(sval)
+            if found is not None:
+                return found.known
+            walker = walker.parent_skeleton
+        return None
 
     def visit_fixnum_const(self, w_fixnum, flag=None):
         assert w_fixnum.is_fixnum()
@@ -197,7 +1127,8 @@ class SkeletonWalker(Walker):
         assert w_boolean.is_boolean()
         return ConstValueRepr(self.new_const_slot(w_boolean))
 
-    special_form_list = 'define set! if quote lambda begin'.split(' ')
+    special_form_list = ('define set! if quote lambda begin '
+                         'let let* letrec do').split(' ')
     def symbol_is_special_form(self, w_symbol):
         assert w_symbol.is_symbol()
         sval = w_symbol.to_string()
@@ -218,9 +1149,19 @@ class SkeletonWalker(Walker):
                 raise SchemeSyntaxError, ('define require the first arg '
                         'to be symbol -- got %s' % w_name.to_string())
             w_expr = lst[1]
-            value_repr = self.visit(w_expr)
-            self.visit_binding(w_name, value_repr) # create binding for define
-            return ConstValueRepr(self.new_const_slot(w_unspecified))
+            new_val = self.new_local_binding(w_name)
+            if (new_val is not None and
+                    w_name.to_string() in self.known_candidates and
+                    is_lambda_form(w_expr)):
+                assert isinstance(w_expr, W_Pair)
+                visit_flag = CompilationFlag(0, desired_destination=new_val)
+                dfd_lambda = self.visit_lambda(w_expr.cdr, visit_flag)
+                new_val.known = dfd_lambda.as_known_procedure(
+                        w_name.to_string())
+                self.bind_local(w_name.to_string(), new_val)
+                return ConstValueRepr(self.new_const_slot(w_unspecified))
+            return self.start_form_visit(BindingVisit(sval, w_name, w_expr,
+                                                      new_val, flag))
 
         elif sval == 'set!':
             lst = []
@@ -233,9 +1174,8 @@ class SkeletonWalker(Walker):
                 raise SchemeSyntaxError, ('set! require the first arg '
                         'to be symbol -- got %s' % w_name.to_string())
             w_expr = lst[1]
-            value_repr = self.visit(w_expr)
-            self.visit_rebind(w_name, value_repr) # change binding for define
-            return ConstValueRepr(self.new_const_slot(w_unspecified))
+            return self.start_form_visit(BindingVisit(sval, w_name, w_expr,
+                                                      None, flag))
 
         elif sval == 'if':
             # (if pred iftrue [else])
@@ -249,41 +1189,8 @@ class SkeletonWalker(Walker):
             if len(lst) not in (2, 3) or not w_rest.is_null():
                 raise SchemeSyntaxError, 'if require 2 to 3 args'
 
-            w_pred = lst[0]
-            w_iftrue = lst[1]
-
-            # predicate value repr
-            # XXX: Note that this is a temporary variable and can be reused
-            #      if we return this frame slot to the allocator.
-            pred_local_val = self.cast_to_local(self.visit(w_pred))
-
-            # saved instr index, for jump to else
-            iftrue_branch_instr_index = len(self.instrs)
-            self.instrs.append(None) # branch length to be calculated
-
-            # if_true instrs
-            iftrue_result_repr = self.visit(w_iftrue, flag)
-            self.set_frame_slot(result_value_repr, iftrue_result_repr)
-            iftrue_branch_jumpby = (len(self.instrs) -
-                    iftrue_branch_instr_index)
-            self.instrs[iftrue_branch_instr_index] = BranchIfFalse(
-                    pred_local_val.to_index(), iftrue_branch_jumpby)
-
-            iffalse_branch_instr_index = len(self.instrs)
-            self.instrs.append(None) # branch length to be calculated
-            if len(lst) == 2:
-                self.set_frame_slot(result_value_repr,
-                        ConstValueRepr(self.new_const_slot(w_unspecified)))
-            else: # has else
-                w_iffalse = lst[2]
-                iffalse_result_repr = self.visit(w_iffalse, flag)
-                self.set_frame_slot(result_value_repr, iffalse_result_repr)
-
-            iffalse_branch_jumpby = (len(self.instrs) -
-                    iffalse_branch_instr_index - 1)
-            self.instrs[iffalse_branch_instr_index] = Branch(
-                    iffalse_branch_jumpby)
-            return result_value_repr
+            return self.start_form_visit(IfVisit(lst, result_value_repr,
+                                                 flag))
 
         elif sval == 'quote':
             # (quote datum)
@@ -294,55 +1201,288 @@ class SkeletonWalker(Walker):
             return ConstValueRepr(self.new_const_slot(lst[0]))
 
         elif sval == 'lambda':
-            lst = []
-            w_rest = scmlist2py(w_args, lst)
-            if not w_rest.is_null():
-                raise SchemeSyntaxError, 'lambda -- not a well-formed list'
-            if len(lst) < 2:
-                raise SchemeSyntaxError, 'lambda -- missing expression'
-            if flag.has_dest():
-                frame_val_repr = flag.get_dest()
-            else:
-                frame_val_repr = FrameValueRepr(self.alloc_frame_slot())
-            current_instr_pos = len(self.instrs)
-            self.instrs.append(None)
-            # compile the lambdas in the end
-            self.deferred_lambdas.append(DeferredLambdaCompilation(
-                self, lst, current_instr_pos, frame_val_repr))
-            return frame_val_repr
+            return self.visit_lambda(w_args, flag).dest_val_repr
 
         elif sval == 'begin':
             lst = []
             w_rest = scmlist2py(w_args, lst)
             if not w_rest.is_null():
                 raise SchemeSyntaxError, 'begin -- not a well-formed list'
-            for i, w_expr in enumerate(lst):
-                if i != len(lst) - 1:
-                    self.visit(w_expr)
-                else:
-                    return self.visit(w_expr, flag)
+            if lst:
+                return self.start_form_visit(SequenceVisit(lst, flag))
             # when there is no args: return unspecified
             return ConstValueRepr(self.new_const_slot(w_unspecified))
 
+        elif sval == 'let':
+            return self.visit_let(w_args, flag)
+
+        elif sval == 'let*':
+            # (let* ((name init) ...) body ...)
+            lst = []
+            w_rest = scmlist2py(w_args, lst)
+            names = []
+            inits = []
+            if (not w_rest.is_null() or len(lst) < 2 or
+                    not parse_bindings(lst[0], names, inits)):
+                raise SchemeSyntaxError, 'let* -- not a well-formed form'
+            return self.dispatch(let_star_as_let(names, inits, lst[1:]),
+                                 flag)
+
+        elif sval == 'letrec':
+            return self.visit_letrec(w_args, flag)
+
+        elif sval == 'do':
+            # (do ((name init [step]) ...) (test result ...) command ...)
+            lst = []
+            w_rest = scmlist2py(w_args, lst)
+            names = []
+            inits = []
+            steps = []
+            test = []
+            if (not w_rest.is_null() or len(lst) < 2 or
+                    not parse_bindings(lst[0], names, inits, steps) or
+                    not scmlist2py(lst[1], test).is_null() or not test):
+                raise SchemeSyntaxError, 'do -- not a well-formed form'
+            w_loop = do_as_named_let(names, inits, steps, test, lst[2:])
+            # @see LoopScan
+            self.loop_memo[w_loop.cdr] = self.loop_p(do_symbol, w_args)
+            return self.dispatch(w_loop, flag)
+
         else:
             raise ValueError, 'not a special form'
 
+    def new_local_binding(self, w_name):
+        """ If (define w_name ...) creates a new local binding, allocate and
+            return its slot. The caller adds it to the local variables once
+            the value is computed. Otherwise return None, and the define is
+            done by visit_binding.
+        """
+        assert w_name.is_symbol()
+        sval = w_name.to_string()
+        if self.scopes:
+            # shadows whatever is outside the scope. The scope's slots don't
+            # outlive a pending application, @see visit_let
+            if sval in self.scopes[-1]:
+                return None
+            return FrameValueRepr(self.reserved_slot(sval))
+        if not self.parent_skeleton or sval in self.local_variables:
+            return None
+        if self.pending_applications and not self.reserved_p(sval):
+            # e.g., under a quasiquote, @see reserve_defines
+            raise SchemeSyntaxError('define -- cannot create a local '
+                    'binding inside an application')
+        return FrameValueRepr(self.reserved_slot(sval))
+
+    def reserve_defines(self, body, scope):
+        """ Allocate the slots of the bindings that the defines in body will
+            create, those of the names that scope doesn't bind yet, on
+            entry to body. They thus sit below the proc slot of every call
+            in it, and their cellvalues can be opened on entry, as a lambda
+            may refer to a define that comes after it.
+            @see place_open_cells
+
+            The defines directly in body come first, and then those nested
+            in its expressions, e.g., in the operand of an application, but
+            not in the nested lambdas and scopes, which bind their own.
+        """
+        reserved = {}
+        nested_w = []
+        for w_expr in body:
+            self.reserve_define(w_expr, scope, reserved, nested_w)
+        nested_w.reverse() # visited in order
+        while nested_w:
+            subexprs_w = []
+            self.reserve_define(nested_w.pop(), scope, reserved, subexprs_w)
+            subexprs_w.reverse()
+            nested_w.extend(subexprs_w)
+        self.reserved_slots.append(reserved)
+
+    def reserve_define(self, w_expr, scope, reserved, nested_w):
+        """ Reserve the slot of w_expr if it's a (define name ...) which
+            creates a binding, and append the subexpressions of w_expr
+            which may contain other defines to nested_w.
+        """
+        if not w_expr.is_pair():
+            return
+        assert isinstance(w_expr, W_Pair)
+        w_head = w_expr.car
+        w_args = w_expr.cdr
+        if w_head.is_symbol():
+            sval = w_head.to_string()
+            if sval == 'quote' or sval == 'lambda':
+                return
+            elif sval == 'let' or sval == 'let*' or sval == 'do':
+                # only their inits are outside their scopes, and only the
+                # first one of a let*.
+                if not w_args.is_pair():
+                    return
+                assert isinstance(w_args, W_Pair)
+                w_bindings = w_args.car
+                if w_bindings.is_symbol() and w_args.cdr.is_pair():
+                    w_rest = w_args.cdr # a named let
+                    assert isinstance(w_rest, W_Pair)
+                    w_bindings = w_rest.car
+                while w_bindings.is_pair():
+                    assert isinstance(w_bindings, W_Pair)
+                    w_binding = w_bindings.car
+                    if w_binding.is_pair() and w_binding.cdr.is_pair():
+                        w_init = w_binding.cdr
+                        assert isinstance(w_init, W_Pair)
+                        nested_w.append(w_init.car)
+                    if sval == 'let*':
+                        break
+                    w_bindings = w_bindings.cdr
+                return
+            elif sval == 'letrec' or sval == 'quasiquote':
+                return
+            elif sval == 'define' and w_args.is_pair():
+                assert isinstance(w_args, W_Pair)
+                if not w_args.car.is_symbol():
+                    return # reported by visit_special_form
+                name = w_args.car.to_string()
+                if name not in scope and name not in reserved:
+                    reserved[name] = self.alloc_local_slot()
+                w_args = w_args.cdr # and the value
+        else:
+            nested_w.append(w_head)
+        while w_args.is_pair():
+            assert isinstance(w_args, W_Pair)
+            nested_w.append(w_args.car)
+            w_args = w_args.cdr
+
+    def reserved_p(self, sval):
+        return bool(self.reserved_slots) and sval in self.reserved_slots[-1]
+
+    def reserved_slot(self, sval):
+        """ Return the slot of a new binding of sval, which is the one
+            reserve_defines reserved for it, if any.
+        """
+        if self.reserved_slots:
+            reserved = self.reserved_slots[-1]
+            if sval in reserved:
+                slotindex = reserved[sval]
+                del reserved[sval]
+                return slotindex
+        return self.alloc_local_slot()
+
+    @dont_look_inside
+    def visit_let(self, w_args, flag):
+        """ (let ((name init) ...) body ...), evaluated in new local slots
+            which are bound in a scope of their own.
+            Or the named let, @see visit_named_let
+        """
+        lst = []
+        w_rest = scmlist2py(w_args, lst)
+        if not w_rest.is_null() or len(lst) < 2:
+            raise SchemeSyntaxError, 'let -- not a well-formed form'
+        if lst[0].is_symbol():
+            if len(lst) < 3:
+                raise SchemeSyntaxError, 'let -- missing expression'
+            return self.visit_named_let(w_args, lst[0], lst[1], lst[2:],
+                                        flag)
+        names = []
+        inits = []
+        if not parse_bindings(lst[0], names, inits):
+            raise SchemeSyntaxError, 'let -- malformed bindings'
+        body = lst[1:]
+        if self.pending_applications and self.may_capture(body):
+            # a closure may refer to the slots after the scope ends, but a
+            # pending call will overwrite them. @see new_local_binding
+            return self.dispatch(let_as_application(names, inits, body),
+                                 flag)
+        return self.visit_let_scope(names, inits, body, flag)
+
+    @dont_look_inside
+    def visit_let_scope(self, names, inits, body, flag):
+        """ @see ScopeVisit
+        """
+        return self.start_form_visit(ScopeVisit(symbol_names(names), inits,
+                                                body, flag))
+
+    @dont_look_inside
+    def visit_letrec(self, w_args, flag):
+        """ (letrec ((name init) ...) body ...), where the inits are
+            evaluated in the scope of the names.
+        """
+        lst = []
+        w_rest = scmlist2py(w_args, lst)
+        names = []
+        inits = []
+        if (not w_rest.is_null() or len(lst) < 2 or
+                not parse_bindings(lst[0], names, inits)):
+            raise SchemeSyntaxError, 'letrec -- not a well-formed form'
+        body = lst[1:]
+        if self.pending_applications and self.may_capture(inits + body):
+            return self.dispatch(letrec_as_application(names, inits, body),
+                                 flag)
+        return self.start_form_visit(LetrecVisit(symbol_names(names), inits,
+                                                 body, flag))
+
+    @dont_look_inside
+    def visit_named_let(self, w_args, w_name, w_bindings, body, flag):
+        """ (let . w_args), i.e. (let w_name ((name init) ...) . body)
+            When it is a loop, @see LoopScan, the names are bound to local
+            slots and w_name to the LoopLabel of the body, which the calls
+            to it branch back to. Otherwise it's a closure.
+        """
+        names = []
+        inits = []
+        if not parse_bindings(w_bindings, names, inits):
+            raise SchemeSyntaxError, 'let -- malformed bindings'
+        sval = w_name.to_string()
+        if not self.loop_p(let_symbol, w_args):
+            return self.dispatch(named_let_as_application(w_name, names,
+                                                          inits, body), flag)
+        return self.start_form_visit(LoopVisit(sval, symbol_names(names),
+                                               inits, body, flag))
+
+    @dont_look_inside
+    def visit_loop_jump(self, label, lst):
+        """ (name . lst), where name is bound to label and the call is in
+            tail position. Assign lst to the loop's slots and branch back.
+        """
+        return self.start_form_visit(LoopJumpVisit(label, lst, None))
+
+    @dont_look_inside
+    def visit_lambda(self, w_args, flag):
+        """ (lambda . w_args)
+            Emit a placeholder for its BuildClosure, and return the
+            DeferredLambdaCompilation which will fill it in.
+        """
+        lst = []
+        w_rest = scmlist2py(w_args, lst)
+        if not w_rest.is_null():
+            raise SchemeSyntaxError, 'lambda -- not a well-formed list'
+        if len(lst) < 2:
+            raise SchemeSyntaxError, 'lambda -- missing expression'
+        if flag.has_dest():
+            frame_val_repr = flag.get_dest()
+        else:
+            frame_val_repr = FrameValueRepr(self.alloc_frame_slot())
+        current_instr_pos = len(self.instrs)
+        self.instrs.append(None)
+        # compile the lambdas in the end
+        dfd_lambda = DeferredLambdaCompilation(self, lst, current_instr_pos,
+                                               frame_val_repr)
+        self.deferred_lambdas.append(dfd_lambda)
+        return dfd_lambda
+
     @dont_look_inside
     def visit_binding(self, w_name, value_repr):
         """ This will be simpler -- if w_name is in local namespace, this is
             the same as set!. Otherwise, create a new binding.
 
             If we are in toplevel, then generate/change a global binding.
-            Otherwise, generate/change a local binding.
+            New local bindings are allocated by new_local_binding.
 
             (define w_name value_repr)
         """
         assert w_name.is_symbol()
         sval = w_name.to_string()
 
-        if sval in self.local_variables:
+        old_val = self.scoped_lookup(sval)
+        if old_val is not None:
             # modify binding
-            old_val = self.local_variables[sval]
             if old_val.on_frame(): # set frame
                 self.set_frame_slot(old_val, value_repr)
             elif old_val.is_cell(): # set cell
@@ -350,16 +1490,11 @@ class SkeletonWalker(Walker):
             else:
                 raise ValueError, 'unreachable'
         else:
-            if not self.parent_skeleton: # We are in toplevel
-                # create new global binding
-                new_val = GlobalValueRepr(w_name)
-                self.global_variables[sval] = new_val
-                self.set_global_value(new_val, value_repr)
-            else:
-                # create new local binding
-                new_val = FrameValueRepr(self.alloc_frame_slot())
-                self.local_variables[sval] = new_val
-                self.set_frame_slot(new_val, value_repr)
+            assert not self.parent_skeleton # We are in toplevel
+            # create new global binding
+            new_val = GlobalValueRepr(w_name)
+            self.global_variables[sval] = new_val
+            self.set_global_value(new_val, value_repr)
 
     @dont_look_inside
     def visit_rebind(self, w_name, value_repr):
@@ -369,9 +1504,9 @@ class SkeletonWalker(Walker):
         assert w_name.is_symbol()
         sval = w_name.to_string()
 
-        if sval in self.local_variables:
+        old_val = self.scoped_lookup(sval)
+        if old_val is not None:
             # modify binding
-            old_val = self.local_variables[sval]
             if old_val.on_frame(): # set frame
                 self.set_frame_slot(old_val, value_repr)
             elif old_val.is_cell(): # set cell
@@ -395,37 +1530,157 @@ class SkeletonWalker(Walker):
         w_rest = scmlist2py(w_args, lst)
         if not w_rest.is_null():
             raise SchemeSyntaxError('application -- not a well-formed list')
-        # allocate len(lst) + 1 frame slots
-        # XXX: ensure they sit together.
-        proc_slot = FrameValueRepr(self.alloc_frame_slot())
-        arg_slots = [FrameValueRepr(self.alloc_frame_slot())
+
+        if is_lambda_form(w_proc):
+            assert isinstance(w_proc, W_Pair)
+            formals = []
+            body = []
+            w_rest = scmlist2py(w_proc.cdr, body)
+            if w_rest.is_null() and len(body) >= 2:
+                w_rest = scmlist2py(body[0], formals)
+                # a closure in the body may refer to the formals after the
+                # application, as in visit_let.
+                if (w_rest.is_null() and len(formals) == len(lst) and
+                        symbols_p(formals) and not (
+                            self.pending_applications and
+                            self.may_capture(body[1:]))):
+                    return self.visit_let_scope(formals, lst, body[1:],
+                                                flag)
+        if w_proc.is_symbol():
+            label = self.scoped_lookup(w_proc.to_string())
+            if label is not None and label.is_loop():
+                assert isinstance(label, LoopLabel)
+                return self.visit_loop_jump(label, lst)
+        # builtin arithmetic on two operands is inlined
+        if w_proc.is_symbol() and len(lst) == 2:
+            sval = w_proc.to_string()
+            if (sval in arith_instr_map and
+                    self.local_lookup(w_proc).is_global()):
+                return self.visit_inlined_primitive(arith_instr_map[sval],
+                                                    lst[0], lst[1], flag)
+        if w_proc.is_symbol():
+            known = self.lookup_known(w_proc)
+            if known is not None and self.may_inline(known, len(lst)):
+                return self.visit_inlined_application(known, lst, flag)
+            if known is not None and known.accepts(len(lst)):
+                return self.visit_known_application(known, w_proc, lst,
+                                                    flag)
+        # allocate len(lst) + 1 frame slots, together and on the top.
+        proc_slotindex = self.alloc_top_slots(len(lst) + 1)
+        proc_slot = FrameValueRepr(proc_slotindex)
+        arg_slots = [FrameValueRepr(proc_slotindex + 1 + i)
                 for i in xrange(len(lst))]
 
         # evaluate the proc and the args
-        proc_visit_flag = CompilationFlag(0, desired_destination=proc_slot)
-        proc_val_repr = self.visit(w_proc, proc_visit_flag)
-        self.set_frame_slot(proc_slot, proc_val_repr) # could be no-op
-
-        for i in xrange(len(lst)):
-            # since enumerate is not supported in RPython...
-            w_expr = lst[i]
-            dest_slot = arg_slots[i]
-            arg_visit_flag = CompilationFlag(0, desired_destination=dest_slot)
-            arg_val_repr = self.visit(w_expr, arg_visit_flag)
-            self.set_frame_slot(dest_slot, arg_val_repr)
+        self.pending_applications += 1
+        return self.start_form_visit(ApplicationVisit(proc_slot, arg_slots,
+                                                      [w_proc] + lst, flag))
 
-        if flag.has_dest():
-            result_value_repr = flag.get_dest()
-        else:
-            result_value_repr = FrameValueRepr(self.alloc_frame_slot())
-        # call and return
-        if flag.has_tco():
-            self.emit(TailCall(result_value_repr.to_index(),
-                    proc_slot.to_index(), len(lst)))
-        else:
-            self.emit(Call(result_value_repr.to_index(),
-                    proc_slot.to_index(), len(lst)))
-        return result_value_repr
+    @dont_look_inside
+    def visit_known_application(self, known, w_proc, lst, flag):
+        """ (w_proc . lst), where w_proc is a KnownProcedure that accepts
+            len(lst) arguments. @see instruction_set.CallKnown
+        """
+        proc_slotindex = self.alloc_top_slots(len(lst) + 1)
+        proc_slot = FrameValueRepr(proc_slotindex)
+
+        self.pending_applications += 1
+        if known.skel_index != self.skel_index:
+            # not a self call, so the callee's cellvalues may be needed.
+            self.set_frame_slot(proc_slot, self.local_lookup(w_proc))
+        arg_slots = [FrameValueRepr(proc_slotindex + 1 + i)
+                for i in xrange(len(lst))]
+        return self.start_form_visit(KnownApplicationVisit(known, proc_slot,
+                arg_slots, lst, flag))
+
+    def may_inline(self, known, argcount):
+        """ Whether a call to known with argcount arguments can be
+            replaced by its body. The call has to be in the walker that
+            defines it, and every free variable of the body has to refer to
+            the binding it refers to in the lambda.
+        """
+        if (known.owner is not self or known.nb_args != argcount or
+                not known.inlinable_p() or known.name in self.inlining):
+            return False
+        for sval in known.body_symbols:
+            if sval in known.params:
+                continue
+            scope = self.binding_scope(sval, self.scopes)
+            if scope is not self.binding_scope(sval, known.scopes):
+                return False # shadowed here
+            if (scope is None and self.binding_scan is not None and
+                    sval in self.binding_scan.nb_defines):
+                return False # a local that is not defined yet
+        return True
+
+    @dont_look_inside
+    def visit_inlined_application(self, known, lst, flag):
+        """ (name . lst), where name is a KnownProcedure that may be
+            inlined. The arguments are evaluated to temporaries, which the
+            body then sees as its formals.
+        """
+        return self.start_form_visit(InlinedVisit(known, lst, flag))
+
+    @dont_look_inside
+    def visit_inlined_primitive(self, instr_cls, w_lhs, w_rhs, flag):
+        """ (op lhs rhs), where op names a global builtin primitive.
+            @see instruction_set.ArithInstr
+        """
+        return self.start_form_visit(PrimitiveVisit(instr_cls, w_lhs, w_rhs,
+                                                    flag))
+
+    @dont_look_inside
+    def try_compare_and_branch(self, w_pred):
+        """ If w_pred is a comparison, like (< a b) or (null? x), that can be
+            fused with the if's branch, evaluate its operands and return the
+            fused instruction. Otherwise return None and emit nothing.
+            @see instruction_set.CompareAndBranch
+        """
+        if not w_pred.is_pair():
+            return None
+        assert isinstance(w_pred, W_Pair)
+        w_proc = w_pred.car
+        if not w_proc.is_symbol():
+            return None
+        sval = w_proc.to_string()
+        if sval not in compare_and_branch_map:
+            return None
+        lst = []
+        w_rest = scmlist2py(w_pred.cdr, lst)
+        if not w_rest.is_null():
+            return None
+        if sval == 'null?':
+            if len(lst) != 1:
+                return None
+        elif len(lst) != 2:
+            return None
+        if not self.local_lookup(w_proc).is_global():
+            return None
+
+        instr_cls = compare_and_branch_map[sval]
+        if len(lst) == 1:
+            operand_repr = self.cast_to_local(self.visit(lst[0]))
+            self.release(operand_repr)
+            return instr_cls(operand_repr.to_index(), 0)
+        lhs_repr = self.visit_operand(lst[0], lst[1])
+        rhs_repr = self.cast_to_local(self.visit(lst[1]))
+        self.release(lhs_repr)
+        self.release(rhs_repr)
+        return instr_cls(lhs_repr.to_index(), rhs_repr.to_index())
+
+    @dont_look_inside
+    def visit_operand(self, w_expr, w_next_expr):
+        """ Evaluate w_expr to a frame slot, knowing that w_next_expr will be
+            evaluated before the slot is used.
+        """
+        if w_next_expr.is_pair():
+            # evaluating the next expression may change this one, say, when
+            # this is a local that the next one set!s. So take a copy.
+            res = FrameValueRepr(self.alloc_frame_slot())
+            visit_flag = CompilationFlag(0, desired_destination=res)
+            self.move_to_frame_slot(res, self.visit(w_expr, visit_flag))
+            return res
+        return self.cast_to_local(self.visit(w_expr))
 
     @dont_look_inside
     def cast_to_local(self, value_repr):
@@ -467,24 +1722,39 @@ class SkeletonWalker(Walker):
         else:
             raise ValueError, 'unreached'
 
+    @dont_look_inside
+    def move_to_frame_slot(self, old_repr, new_repr):
+        """ set_frame_slot, and release new_repr which is consumed.
+        """
+        self.set_frame_slot(old_repr, new_repr)
+        if old_repr is not new_repr:
+            self.release(new_repr)
+
     def set_cell_value(self, cell_repr, new_repr):
         assert cell_repr.is_cell()
         if cell_repr is new_repr:
             return # well...
-        self.emit(StoreCell(cell_repr.to_index(),
-            self.cast_to_local(new_repr).to_index()))
+        local_repr = self.cast_to_local(new_repr)
+        self.emit(StoreCell(cell_repr.to_index(), local_repr.to_index()))
+        if local_repr is not new_repr:
+            self.release(local_repr)
 
     def set_global_value(self, global_repr, new_repr):
         assert global_repr.is_global()
         if global_repr is new_repr:
             return # well...
+        local_repr = self.cast_to_local(new_repr)
         self.emit(StoreGlobal(self.new_const_slot(global_repr.w_symbol),
-            self.cast_to_local(new_repr).to_index()))
+            local_repr.to_index()))
+        if local_repr is not new_repr:
+            self.release(local_repr)
 
 
 class IntermediateRepr(object):
     """ A intermediate representation that is used during compilation.
     """
+    known = None # KnownProcedure if this is a local bound to it
+
     def to_index(self):
         raise NotImplementedError
 
@@ -503,6 +1773,9 @@ class IntermediateRepr(object):
     def is_assignable(self):
         return False
 
+    def is_loop(self):
+        return False
+
 class FrameValueRepr(IntermediateRepr):
     """ A value that is on stack.
     """
@@ -554,16 +1827,57 @@ class GlobalValueRepr(IntermediateRepr):
     def is_assignable(self):
         return True
 
+class LoopLabel(IntermediateRepr):
+    """ The name of a named let that is compiled to a loop, which starts
+        at instrs[head] with its variables in slots.
+        @see SkeletonWalker.visit_named_let
+    """
+    def __init__(self, head, slots):
+        self.head = head
+        self.slots = slots
+
+    def is_loop(self):
+        return True
+
 class DeferredLambdaCompilation(object):
     def __init__(self, walker, expr_list, instrindex, dest_val_repr):
         self.walker = walker # the walker
         self.expr_list = expr_list # the lambda formals and body, a pylist
         self.instrindex = instrindex # the instruction index
         self.dest_val_repr = dest_val_repr # a frame slot
+        # the skeleton's index is reserved now so that the calls to it can
+        # be compiled before it is. @see CallKnown
+        self.skel_index = walker.new_skel_slot(None)
+        # the scopes it's in, which are gone when it's compiled.
+        self.scopes = walker.scopes[:]
+        # those of the walker while it's compiled
+        self.outer_scopes = None
+
+    def as_known_procedure(self, name):
+        arg_list = []
+        w_rest = scmlist2py(self.expr_list[0], arg_list)
+        known = KnownProcedure(self.skel_index, len(arg_list),
+                               not w_rest.is_null())
+        params = []
+        for w_argname in arg_list:
+            if not w_argname.is_symbol():
+                return known # reported by resume_compilation
+            params.append(w_argname.to_string())
+        known.set_body(name, self.walker, self.scopes, params,
+                       self.expr_list[1:])
+        return known
 
     @dont_look_inside
     def resume_compilation(self):
+        """ Compile the lambda body and return its walker, which is to be
+            finished when its own lambdas are. The walker it's in sees the
+            scopes of the lambda until then. @see finish_compilation
+        """
         lambda_walker = SkeletonWalker(self.walker)
+        lambda_walker.skel_index = self.skel_index
+        lambda_walker.closure_index = self.instrindex
+        self.outer_scopes = self.walker.scopes
+        self.walker.scopes = self.scopes
         w_formals = self.expr_list[0]
         lambda_body = self.expr_list[1:]
 
@@ -587,20 +1901,449 @@ class DeferredLambdaCompilation(object):
 
         # fill in the frame slots using those arguments
         for w_argname in arg_list:
-            frame_slot_repr = FrameValueRepr(lambda_walker.alloc_frame_slot())
+            frame_slot_repr = FrameValueRepr(lambda_walker.alloc_local_slot())
             lambda_walker.local_variables[w_argname.to_string()] \
                     = frame_slot_repr
 
         # if vararg
         if lambda_walker.varargs_p:
-            frame_slot_repr = FrameValueRepr(lambda_walker.alloc_frame_slot())
+            frame_slot_repr = FrameValueRepr(lambda_walker.alloc_local_slot())
             lambda_walker.local_variables[w_rest.to_string()] \
                     = frame_slot_repr
 
+        outer_scan = self.walker.binding_scan
+        assert outer_scan is not None
+        lambda_walker.set_binding_scan(BindingScan(lambda_body,
+                                                   outer_scan.rebound))
+
         # compile the body. XXX: create a global skeleton table like lua?
         lambda_walker.visit_list_of_expr(lambda_body)
-        w_lambda_skeleton = lambda_walker.to_closure_skeleton()
+        return lambda_walker
+
+    def finish_compilation(self, w_lambda_skeleton):
+        self.walker.scopes = self.outer_scopes
+        self.outer_scopes = None
+        self.walker.skeleton_registry[self.skel_index] = w_lambda_skeleton
         self.walker.instrs[self.instrindex] = BuildClosure(
-            self.dest_val_repr.to_index(),
-            self.walker.new_skel_slot(w_lambda_skeleton))
+            self.dest_val_repr.to_index(), self.skel_index)
+
+
+# _________________________________________________________________________
+# the visits of the forms with subexpressions, @see SkeletonWalker.visit
+
+class FormVisit(object):
+    """ The visit of a form, which asks for its subexpressions one at a
+        time: start and resume return None after visit_next, and the value
+        repr of the form once it's done.
+    """
+    def __init__(self, flag):
+        self.flag = flag # that of the form
+        self.w_next = None # the subexpression to visit next
+        self.next_flag = None
+
+    def visit_next(self, w_expr, flag=None):
+        if flag is None:
+            flag = CompilationFlag()
+        self.w_next = w_expr
+        self.next_flag = flag
+        return None
+
+    def start(self, walker):
+        raise NotImplementedError
+
+    def resume(self, walker, value_repr):
+        """ Go on, given value_repr, that of the subexpression asked for.
+        """
+        raise NotImplementedError
+
+class BindingVisit(FormVisit):
+    """ (define w_name w_expr) or (set! w_name w_expr). A define that
+        creates a local binding evaluates w_expr right into new_val, its
+        slot. @see SkeletonWalker.new_local_binding
+    """
+    def __init__(self, form, w_name, w_expr, new_val, flag):
+        FormVisit.__init__(self, flag)
+        self.form = form
+        self.w_name = w_name
+        self.w_expr = w_expr
+        self.new_val = new_val
+
+    def start(self, walker):
+        if self.new_val is not None:
+            # the new local is not visible to the expression yet.
+            return self.visit_next(self.w_expr, CompilationFlag(0,
+                    desired_destination=self.new_val))
+        return self.visit_next(self.w_expr)
+
+    def resume(self, walker, value_repr):
+        if self.new_val is not None:
+            walker.move_to_frame_slot(self.new_val, value_repr)
+            walker.bind_local(self.w_name.to_string(), self.new_val)
+        else:
+            if self.form == 'define':
+                walker.visit_binding(self.w_name, value_repr)
+            else:
+                walker.visit_rebind(self.w_name, value_repr)
+            walker.release(value_repr)
+        return ConstValueRepr(walker.new_const_slot(w_unspecified))
+
+class IfVisit(FormVisit):
+    """ (if pred iftrue [iffalse]), whose value goes to result_value_repr.
+    """
+    PRED = 0
+    IFTRUE = 1
+    IFFALSE = 2
+
+    def __init__(self, lst, result_value_repr, flag):
+        FormVisit.__init__(self, flag)
+        self.lst = lst
+        self.result_value_repr = result_value_repr
+        self.state = self.PRED
+        # predicate value repr, a temporary which is only read by the
+        # branch.
+        self.pred_local_val = None
+        # the instr index of the branch to be calculated
+        self.branch_instr_index = -1
+
+    def start(self, walker):
+        compare_instr = walker.try_compare_and_branch(self.lst[0])
+        if compare_instr is not None:
+            # the slot is only written when the primitive is rebound.
+            walker.emit(compare_instr)
+            return self.visit_iftrue(walker,
+                                     FrameValueRepr(walker.alloc_frame_slot()))
+        return self.visit_next(self.lst[0])
+
+    def visit_iftrue(self, walker, pred_local_val):
+        self.pred_local_val = pred_local_val
+        # saved instr index, for jump to else
+        self.branch_instr_index = len(walker.instrs)
+        walker.instrs.append(None)
+        walker.release(pred_local_val)
+        self.state = self.IFTRUE
+        return self.visit_next(self.lst[1], self.flag)
+
+    def resume(self, walker, value_repr):
+        if self.state == self.PRED:
+            return self.visit_iftrue(walker, walker.cast_to_local(value_repr))
+        walker.move_to_frame_slot(self.result_value_repr, value_repr)
+        if self.state == self.IFTRUE:
+            jumpby = len(walker.instrs) - self.branch_instr_index
+            walker.instrs[self.branch_instr_index] = BranchIfFalse(
+                    self.pred_local_val.to_index(), jumpby)
+            self.branch_instr_index = len(walker.instrs)
+            walker.instrs.append(None)
+            if len(self.lst) == 3: # has else
+                self.state = self.IFFALSE
+                return self.visit_next(self.lst[2], self.flag)
+            walker.set_frame_slot(self.result_value_repr,
+                    ConstValueRepr(walker.new_const_slot(w_unspecified)))
+        jumpby = len(walker.instrs) - self.branch_instr_index - 1
+        walker.instrs[self.branch_instr_index] = Branch(jumpby)
+        return self.result_value_repr
+
+class SequenceVisit(FormVisit):
+    """ Visits the expressions of body, which isn't empty, in order. The
+        value is that of the last one, the others are released.
+    """
+    def __init__(self, body, flag):
+        FormVisit.__init__(self, flag)
+        self.body = body
+        self.body_index = 0
+
+    def start(self, walker):
+        return self.visit_body_expr()
+
+    def visit_body_expr(self):
+        w_expr = self.body[self.body_index]
+        if self.body_index == len(self.body) - 1:
+            return self.visit_next(w_expr, self.flag)
+        return self.visit_next(w_expr)
+
+    def resume(self, walker, value_repr):
+        if self.body_index == len(self.body) - 1:
+            return value_repr
+        walker.release(value_repr)
+        self.body_index += 1
+        return self.visit_body_expr()
+
+class ScopeVisit(SequenceVisit):
+    """ Evaluates inits to new local slots, binds them to names in a new
+        scope, and visits body in it, where the defines get their slots on
+        entry. @see SkeletonWalker.reserve_defines
+        Once the body is done, the slots are given back, unless a closure
+        may refer to them.
+    """
+    def __init__(self, names, inits, body, flag):
+        SequenceVisit.__init__(self, body, flag)
+        self.names = names
+        self.inits = inits
+        self.init_index = 0
+        self.slots = []
+        # the number of deferred lambdas when the scope was pushed
+        self.nb_lambdas = 0
+
+    def start(self, walker):
+        return self.visit_init(walker)
+
+    def visit_init(self, walker):
+        """ Visit the next init, or the body when they are all done.
+        """
+        if self.init_index < len(self.inits):
+            slot = self.init_slot(walker)
+            return self.visit_next(self.inits[self.init_index],
+                    CompilationFlag(0, desired_destination=slot))
+        self.push_scope(walker)
+        walker.reserve_defines(self.body, walker.scopes[-1])
+        return self.visit_body_expr()
+
+    def init_slot(self, walker):
+        slot = FrameValueRepr(walker.alloc_local_slot())
+        self.slots.append(slot)
+        return slot
+
+    def push_scope(self, walker):
+        walker.push_scope(self.new_scope(walker))
+        self.nb_lambdas = len(walker.deferred_lambdas)
+
+    def new_scope(self, walker):
+        scope = {}
+        for i in xrange(len(self.names)):
+            scope[self.names[i]] = self.slots[i]
+        return scope
+
+    def resume(self, walker, value_repr):
+        if self.init_index < len(self.inits):
+            walker.move_to_frame_slot(self.slots[self.init_index],
+                                      value_repr)
+            self.init_index += 1
+            return self.visit_init(walker)
+        value_repr = SequenceVisit.resume(self, walker, value_repr)
+        if value_repr is None:
+            return None
+        walker.reserved_slots.pop()
+        return self.close_scope(walker, value_repr)
+
+    def close_scope(self, walker, result_value_repr):
+        return walker.close_scope(result_value_repr,
+                                  walker.no_lambda_since(self.nb_lambdas))
+
+class LetrecVisit(ScopeVisit):
+    """ (letrec ((name init) ...) . body), where the inits are evaluated in
+        the scope of the names.
+    """
+    def start(self, walker):
+        for i in xrange(len(self.names)):
+            self.slots.append(FrameValueRepr(walker.alloc_local_slot()))
+        ScopeVisit.push_scope(self, walker)
+        return self.visit_init(walker)
+
+    def init_slot(self, walker):
+        return self.slots[self.init_index]
+
+    def push_scope(self, walker):
+        pass # already done
+
+class LoopVisit(ScopeVisit):
+    """ A named let which is a loop, @see LoopScan. The name is bound to the
+        LoopLabel of the body.
+    """
+    def __init__(self, loop_name, names, inits, body, flag):
+        ScopeVisit.__init__(self, names, inits, body, flag)
+        self.loop_name = loop_name
+
+    def new_scope(self, walker):
+        scope = ScopeVisit.new_scope(self, walker)
+        scope[self.loop_name] = LoopLabel(len(walker.instrs), self.slots)
+        return scope
+
+class InlinedVisit(ScopeVisit):
+    """ @see SkeletonWalker.visit_inlined_application
+    """
+    def __init__(self, known, lst, flag):
+        ScopeVisit.__init__(self, known.params, lst, known.body, flag)
+        self.known = known
+
+    def push_scope(self, walker):
+        ScopeVisit.push_scope(self, walker)
+        walker.inlining[self.known.name] = None
+
+    def close_scope(self, walker, result_value_repr):
+        del walker.inlining[self.known.name]
+        # the formals are dead now, unless a closure captured them.
+        ScopeVisit.close_scope(self, walker, result_value_repr)
+
+        known = self.known
+        descr = '%s (size %d)' % (known.name, known.body_size)
+        walker.inline_report[descr] = walker.inline_report.get(descr, 0) + 1
+        if self.flag.has_dest():
+            walker.move_to_frame_slot(self.flag.get_dest(), result_value_repr)
+            return self.flag.get_dest()
+        return result_value_repr
 
+class LoopJumpVisit(FormVisit):
+    """ @see SkeletonWalker.visit_loop_jump
+    """
+    def __init__(self, label, lst, flag):
+        FormVisit.__init__(self, flag)
+        self.label = label
+        self.lst = lst
+        self.values = []
+
+    def start(self, walker):
+        return self.visit_value(walker)
+
+    def visit_value(self, walker):
+        i = len(self.values)
+        if i < len(self.lst):
+            return self.visit_next(self.lst[i])
+        slots = self.label.slots
+        # the last value was just computed, which the peephole optimizer
+        # can then write to the slot directly.
+        for i in xrange(len(self.values) - 1, -1, -1):
+            walker.move_to_frame_slot(slots[i], self.values[i])
+        walker.emit(BranchBack(len(walker.instrs) + 1 - self.label.head))
+        return ConstValueRepr(walker.new_const_slot(w_unspecified))
+
+    def resume(self, walker, value_repr):
+        slots = self.label.slots
+        i = len(self.values)
+        later_pair_p = False
+        for w_later in self.lst[i + 1:]:
+            if w_later.is_pair():
+                later_pair_p = True
+        copy_p = False
+        if value_repr.is_const():
+            pass
+        elif (value_repr.on_frame() and walker.slot_states[
+                value_repr.to_index()] == walker.SLOT_TEMP):
+            pass
+        elif later_pair_p:
+            # which may change it, @see SkeletonWalker.visit_operand
+            copy_p = True
+        elif value_repr.on_frame():
+            # the slot of another name is assigned before it's read.
+            for j in xrange(len(slots)):
+                if j != i and slots[j].to_index() == value_repr.to_index():
+                    copy_p = True
+        if copy_p:
+            res = FrameValueRepr(walker.alloc_frame_slot())
+            walker.set_frame_slot(res, value_repr)
+            value_repr = res
+        self.values.append(value_repr)
+        return self.visit_value(walker)
+
+class ApplicationVisit(FormVisit):
+    """ Evaluates exprs, the proc and the arguments of a call, to their
+        slots, proc_slot and arg_slots, and calls.
+        @see SkeletonWalker.visit_application
+    """
+    def __init__(self, proc_slot, arg_slots, exprs, flag):
+        FormVisit.__init__(self, flag)
+        self.proc_slot = proc_slot
+        self.arg_slots = arg_slots
+        self.exprs = exprs
+        self.dest_slots = [proc_slot] + arg_slots
+        self.index = 0
+
+    def start(self, walker):
+        return self.visit_expr(walker)
+
+    def visit_expr(self, walker):
+        if self.index < len(self.exprs):
+            dest_slot = self.dest_slots[self.index]
+            return self.visit_next(self.exprs[self.index],
+                    CompilationFlag(0, desired_destination=dest_slot))
+        walker.pending_applications -= 1
+        # the arguments are dead after the call.
+        for arg_slot in self.arg_slots:
+            walker.release(arg_slot)
+        return self.call(walker)
+
+    def resume(self, walker, value_repr):
+        # could be no-op
+        walker.move_to_frame_slot(self.dest_slots[self.index], value_repr)
+        self.index += 1
+        return self.visit_expr(walker)
+
+    def call(self, walker):
+        # the result can reuse the proc slot.
+        proc_slot = self.proc_slot
+        if self.flag.has_dest():
+            result_value_repr = self.flag.get_dest()
+            walker.release(proc_slot)
+        else:
+            result_value_repr = proc_slot
+        # call and return
+        if self.flag.has_tco():
+            walker.emit(TailCall(result_value_repr.to_index(),
+                    proc_slot.to_index(), len(self.arg_slots)))
+        else:
+            walker.emit(Call(result_value_repr.to_index(),
+                    proc_slot.to_index(), len(self.arg_slots)))
+        return result_value_repr
+
+class KnownApplicationVisit(ApplicationVisit):
+    """ A call to known, whose exprs are only the arguments.
+        @see SkeletonWalker.visit_known_application
+    """
+    def __init__(self, known, proc_slot, arg_slots, exprs, flag):
+        ApplicationVisit.__init__(self, proc_slot, arg_slots, exprs, flag)
+        self.known = known
+        self.dest_slots = arg_slots
+
+    def call(self, walker):
+        proc_slotindex = self.proc_slot.to_index()
+        nb_args = len(self.arg_slots)
+        if self.flag.has_tco():
+            walker.emit(TailCallKnown(self.known.skel_index, proc_slotindex,
+                                      nb_args))
+        else:
+            walker.emit(CallKnown(self.known.skel_index, proc_slotindex,
+                                  nb_args))
+        if self.flag.has_dest():
+            walker.move_to_frame_slot(self.flag.get_dest(), self.proc_slot)
+            return self.flag.get_dest()
+        return self.proc_slot
+
+class PrimitiveVisit(FormVisit):
+    """ @see SkeletonWalker.visit_inlined_primitive
+    """
+    def __init__(self, instr_cls, w_lhs, w_rhs, flag):
+        FormVisit.__init__(self, flag)
+        self.instr_cls = instr_cls
+        self.w_lhs = w_lhs
+        self.w_rhs = w_rhs
+        self.lhs_repr = None
+        self.rhs_p = False # whether w_rhs is being visited
+
+    def start(self, walker):
+        if self.w_rhs.is_pair():
+            # a copy, @see SkeletonWalker.visit_operand
+            self.lhs_repr = FrameValueRepr(walker.alloc_frame_slot())
+            return self.visit_next(self.w_lhs, CompilationFlag(0,
+                    desired_destination=self.lhs_repr))
+        return self.visit_next(self.w_lhs)
+
+    def resume(self, walker, value_repr):
+        if not self.rhs_p:
+            if self.lhs_repr is not None:
+                walker.move_to_frame_slot(self.lhs_repr, value_repr)
+            else:
+                self.lhs_repr = walker.cast_to_local(value_repr)
+            self.rhs_p = True
+            return self.visit_next(self.w_rhs)
+        lhs_repr = self.lhs_repr
+        rhs_repr = walker.cast_to_local(value_repr)
+        # the operands are read before the result is written, so the result
+        # may take one of their slots.
+        walker.release(lhs_repr)
+        walker.release(rhs_repr)
+
+        if self.flag.has_dest():
+            result_value_repr = self.flag.get_dest()
+        else:
+            result_value_repr = FrameValueRepr(walker.alloc_frame_slot())
+        walker.emit(self.instr_cls(result_value_repr.to_index(),
+                lhs_repr.to_index(), rhs_repr.to_index()))
+        return result_value_repr
@@ -1,2 +1,40 @@
 DEBUG = False
 
+# number of register slots the vm preallocates for its register stack.
+# The stack grows on demand, so this only needs to fit the common case.
+INITIAL_STACK_SIZE = 1024
+
+# number of call records the vm preallocates. Grows on demand as well.
+INITIAL_CALL_DEPTH = 64
+
+# whether instructions may rewrite themselves to specialized variants after
+# their first execution, @see instruction_set.quicken. Never happens in
+# jitted code.
+QUICKENING = True
+
+# whether the compiler folds applications of the builtin primitives to
+# constants, @see optimize.ConstantFolder. It only folds whole programs
+# which don't rebind +, <, null? and the like, not the inputs of the repl,
+# which a later input may rebind. @see compilation.CompilationSession
+CONSTANT_FOLDING = True
+
+# whether the compiler cleans up its output, @see optimize.PeepholeOptimizer
+PEEPHOLE = True
+# print how many instructions the peephole optimizer removed per skeleton
+PEEPHOLE_STATS = False
+
+# largest lambda body, in pairs and atoms, that the compiler substitutes
+# for a call to it, @see compilation.SkeletonWalker.may_inline. 0 disables
+# the inlining.
+INLINE_BUDGET = 24
+# print which procedures were inlined, once per compiled program
+INLINE_REPORT = False
+
+# whether running a file caches its compiled chunk, which the next runs of
+# the same source load instead of compiling it, @see chunkcache
+CHUNK_CACHE = True
+# the environment variable naming the cache directory, $HOME/.cache/sanya
+# if it's not set. Setting it to nothing disables the cache.
+CHUNK_CACHE_ENV = 'SANYA_CACHE_DIR'
+# bytes that the cached chunks may take before the least recently used go
+CHUNK_CACHE_SIZE = 64 * 1024 * 1024
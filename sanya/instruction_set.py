@@ -1,10 +1,13 @@
 """ Instruction set for the virtual machine. Is register based, largely
     inspired by Lua-5.1's instruction set.
 
-    rA/rB/rC: frame slot, by frame[r_]
+    rA/rB/rC: frame slot, by stack[base + r_]
     kA/kB/kC: immediate value, by consts[k_]
     kBx: extended immediate value, usually used in branching.
 
+    In a chunk, an instruction is its opcode and then the operands it
+    uses, @see chunkio.dump_instr.
+
     A closure, in order to be executed, should have `instrs`, `consts`,
     `frame_size` and `cellvalues`.
     To figure out the number of arguments, `nb_args` and `varargs_p` are also
@@ -12,9 +15,11 @@
     In the future it may also capture its current globalvars (to make
     python-like modules).
 """
-from pypy.rlib.jit import unroll_safe
-from sanya.objectmodel import w_nil, pylist2scm
-from sanya.closure import W_CellValue, W_Closure
+from pypy.rlib.jit import unroll_safe, we_are_jitted
+from sanya.closure import W_Closure
+from sanya.config import QUICKENING
+from sanya.objectmodel import W_Fixnum, make_bool
+from sanya.stdlib import lib
 
 # define the instruction type. This is used in assembling.
 OP_TYPE_DUMMY = 0
@@ -36,22 +41,42 @@ class Instr(object):
     def dispatch(self, vm):
         raise NotImplementedError
 
+    def generic(self):
+        """ Return the generic form of this instruction. Quickened
+            instructions return a fresh instance of the instruction they
+            were specialized from, @see quicken
+        """
+        return self
+
     def __repr__(self):
         """NOT_RPYTHON"""
         return '[instr]'
 
-    def dump_u32(self):
-        if not self.op_num:
-            raise ValueError('no opnum')
+# _________________________________________________________________________
+# quickening: an instruction can replace itself in the running codes (which
+# are its skeleton's) with a variant specialized for what it has seen.
+# The variant is a subclass of the generic instruction, so that it dumps
+# as the generic form. When its guard fails, it puts a generic instruction
+# back, which won't try to quicken again.
 
-        if self.op_type == OP_TYPE_ABC:
-            return (self.op_num << (32 - 5) | self.A << (32 - 5 - 9) |
-                    self.B << (32 - 5 - 9 - 9) | self.C)
-        elif self.op_type == OP_TYPE_ABx:
-            return (self.op_num << (32 - 5) | self.A << (32 - 5 - 9) |
-                    self.Bx << (32 - 5 - 9 - 9))
-        else:
-            raise ValueError('unknown op type')
+def may_quicken(instr):
+    return QUICKENING and instr.may_quicken and not we_are_jitted()
+
+def quicken(vm, instr, new_instr):
+    """ Replace the running instruction instr with new_instr.
+    """
+    pc = vm.pc - 1
+    assert vm.codes[pc] is instr
+    vm.codes[pc] = new_instr
+
+def despecialize(vm, instr):
+    """ Replace the running quickened instr with its generic form, which
+        is returned.
+    """
+    generic = instr.generic()
+    generic.may_quicken = False
+    quicken(vm, instr, generic)
+    return generic
 
 class Halt(Instr):
     op_type = OP_TYPE_ABC
@@ -80,13 +105,16 @@ class MoveLocal(Instr):
         self.Bx = 0
 
     def dispatch(self, vm):
-        vm.frame[self.A] = vm.frame[self.B]
+        vm.stack[vm.base + self.A] = vm.stack[vm.base + self.B]
 
     def __repr__(self):
         return '[r(%d) = r(%d)]' % (self.A, self.B)
 
 class LoadGlobal(Instr):
     """ rA = globalvars[kB]
+
+        kB is resolved to the global's binding cell when the skeleton is
+        linked, @see vm.VM.link_skeleton
     """
     op_type = OP_TYPE_ABC
 
@@ -95,13 +123,44 @@ class LoadGlobal(Instr):
         self.B = B
         self.C = 0
         self.Bx = 0
+        self.may_quicken = True
 
     def dispatch(self, vm):
-        vm.frame[self.A] =  vm.globalvars[vm.consts[self.B]]
+        w_cell = vm.global_cells[self.B]
+        w_value = w_cell.w_value
+        assert w_value is not None # unbound global
+        vm.stack[vm.base + self.A] = w_value
+        if may_quicken(self):
+            quicken(vm, self, LoadGlobalCached(self.A, self.B, w_cell))
 
     def __repr__(self):
         return '[r(%d) = g(k(%d))]' % (self.A, self.B)
 
+class LoadGlobalCached(LoadGlobal):
+    """ rA = w_cell.w_value
+
+        Quickened LoadGlobal which holds kB's binding cell. Binding cells
+        are never unbound, and a relinked skeleton gets its generic
+        instructions back, @see vm.VM.link_skeleton
+    """
+    def __init__(self, A, B, w_cell):
+        LoadGlobal.__init__(self, A, B)
+        self.may_quicken = False
+        self.w_cell = w_cell
+
+    def dispatch(self, vm):
+        w_value = self.w_cell.w_value
+        if w_value is None:
+            despecialize(vm, self).dispatch(vm)
+            return
+        vm.stack[vm.base + self.A] = w_value
+
+    def generic(self):
+        return LoadGlobal(self.A, self.B)
+
+    def __repr__(self):
+        return '[r(%d) = g(k(%d)) cached]' % (self.A, self.B)
+
 class LoadCell(Instr):
     """ rA = cellvalues[B].getvalue()
     """
@@ -114,11 +173,31 @@ class LoadCell(Instr):
         self.Bx = 0
 
     def dispatch(self, vm):
-        vm.frame[self.A] = vm.cellvalues[self.B].getvalue()
+        vm.stack[vm.base + self.A] = vm.cellvalues[self.B].getvalue()
 
     def __repr__(self):
         return '[r(%d) = c(%d).get]' % (self.A, self.B)
 
+class OpenCell(Instr):
+    """ fresh_cells[A] = cellvalue(rB), which is opened
+        The binding of rB, which an inner lambda captures, is being
+        created. Until then, its slot may have been part of a callee's
+        frame, whose return would have escaped the cellvalue.
+    """
+    op_type = OP_TYPE_ABC
+
+    def __init__(self, A, B):
+        self.A = A
+        self.B = B
+        self.C = 0
+        self.Bx = 0
+
+    def dispatch(self, vm):
+        vm.open_fresh_cell(self.A, self.B)
+
+    def __repr__(self):
+        return '[fc(%d) = open r(%d)]' % (self.A, self.B)
+
 class LoadConst(Instr):
     """ rA = kB
     """
@@ -131,7 +210,7 @@ class LoadConst(Instr):
         self.Bx = 0
 
     def dispatch(self, vm):
-        vm.frame[self.A] = vm.consts[self.B]
+        vm.stack[vm.base + self.A] = vm.consts[self.B]
 
     def __repr__(self):
         return '[r(%d) = k(%d)]' % (self.A, self.B)
@@ -148,7 +227,7 @@ class StoreGlobal(Instr):
         self.Bx = 0
     
     def dispatch(self, vm):
-        vm.globalvars[vm.consts[self.A]] = vm.frame[self.B]
+        vm.global_cells[self.A].w_value = vm.stack[vm.base + self.B]
 
     def __repr__(self):
         return '[g(k(%d)) = r(%d)]' % (self.A, self.B)
@@ -165,16 +244,17 @@ class StoreCell(Instr):
         self.Bx = 0
     
     def dispatch(self, vm):
-        vm.cellvalues[self.A].setvalue(vm.frame[self.B])
+        vm.cellvalues[self.A].setvalue(vm.stack[vm.base + self.B])
 
     def __repr__(self):
         return '[c(%d).set(r(%d))]' % (self.A, self.B)
 
 class BuildClosure(Instr):
     """ The most involved things is to open cellvalues.
-        Usually the current frame need to be passed to replace the closure's
-        cellvalues' baseframe. After then, those cellvalues will be added
-        into the vm's cellval_list.
+        The cellvalues pointing into the current frame were opened when
+        their bindings were created (vm.fresh_cells, @see OpenCell) and are
+        already on the vm's open cellvalue list, so they are simply picked
+        up here.
 
         @see sdo.W_ClosureSkeleton.build_closure()
 
@@ -189,10 +269,10 @@ class BuildClosure(Instr):
         self.Bx = 0
 
     def dispatch(self, vm):
-        w_skel = vm.skeleton_registry[self.B]
+        w_skel = vm.get_skeleton(self.B)
         assert w_skel.is_procedure_skeleton()
         w_proc = w_skel.build_closure(vm)
-        vm.frame[self.A] = w_proc
+        vm.stack[vm.base + self.A] = w_proc
 
     def __repr__(self):
         return '[r(%d) = buildclosure(CloskelT[%d])]' % (self.A, self.B)
@@ -203,10 +283,10 @@ class Call(Instr):
         Eg, func(1, 2, 3, 4, 5) when func is (lambda (x y . z) ...),
                             rB+0 +1 +2 +3 +4 +5
         stack will be [..., func, 1, 2, 3, 4, 5, ...].
-        (3, 4, 5) will be packed to a cons list reversely.
-        then, z, y and x will be placed on vm's new frame reversely.
+        The callee's frame starts at rB + 1, so x and y are already in
+        place. (3, 4, 5) will be packed to a cons list and stored to z.
 
-        The current state of vm will be stored in a dump.
+        The current state of vm will be stored in a call record.
     """
     op_type = OP_TYPE_ABC
 
@@ -215,63 +295,36 @@ class Call(Instr):
         self.B = B
         self.C = C
         self.Bx = 0
+        self.may_quicken = True
 
     @unroll_safe
     def dispatch(self, vm):
         dest_reg = self.A
         proc_reg = self.B
-        index_of_first_arg = proc_reg + 1
+        index_of_first_arg = vm.base + proc_reg + 1
         actual_argcount = self.C
 
         # make sure its a procedure and we have enough args
-        w_proc = vm.frame[proc_reg]
+        w_proc = vm.stack[vm.base + proc_reg]
+
+        if may_quicken(self):
+            self.quicken(vm, w_proc)
 
         if w_proc.is_pyproc():
-            py_args = [vm.frame[index_of_first_arg + i]
-                       for i in xrange(actual_argcount)]
-            w_result = w_proc.py_call(py_args) # Call it!
-            vm.frame[dest_reg] = w_result
+            w_result = vm.call_pyproc(w_proc, index_of_first_arg,
+                                      actual_argcount) # Call it!
+            vm.stack[vm.base + dest_reg] = w_result
             return
 
         assert isinstance(w_proc, W_Closure)
-        w_skel = w_proc.skeleton
-        assert w_skel.nb_args <= actual_argcount
-
-        # handle varargs.
-        if w_skel.nb_args < actual_argcount:
-            assert(w_skel.varargs_p)
-            # vararg is slowish.
-            vararg = pylist2scm([vm.frame[index_of_first_arg + i]
-                                 for i in xrange(actual_argcount)])
-        else:
-            vararg = w_nil
 
         # save vm's current state
-        vm.save_dump()
-
-        # switch vm to the new closure
-        old_frame = vm.frame
-        vm.frame = vm.new_frame(w_skel.frame_size)
-        vm.consts = w_skel.consts
-        vm.cellvalues = w_proc.cellvalues
-        # loading cellvalues from frame to shadow cellvalue frame.
-        vm.fresh_cells = shad_frame = [None] * len(w_skel.fresh_cells)
-        for i, frameindex in enumerate(w_skel.fresh_cells):
-            w_cellvalue = shad_frame[i] = W_CellValue(vm.frame, frameindex)
-            vm.cellval_head.append(w_cellvalue)
-
-        vm.codes = w_skel.codes
-        vm.pc = 0
+        vm.save_callinfo()
         vm.return_addr = dest_reg
 
-        # push the arguments on the new frame
-        # Note that if we have continuous stack frame then the argument
-        # copying overhead could be avoided. But does it worth?
-        # Anyway we can take a profile first.
-        for i in xrange(w_skel.nb_args):
-            vm.frame[i] = old_frame[i + index_of_first_arg]
-        if w_skel.varargs_p:
-            vm.frame[w_skel.nb_args] = vararg
+        # switch vm to the new closure. Its frame slides over the argument
+        # slots so there is nothing to copy.
+        vm.enter_closure(w_proc, index_of_first_arg, actual_argcount)
 
     def __repr__(self):
         if self.C == 0:
@@ -287,9 +340,57 @@ class Call(Instr):
             return '[r(%d) = r(%d).call(r(%d), ..., r(%d))]' % (
                     self.A, self.B, self.B + 1, self.B + self.C)
 
+    def quicken(self, vm, w_proc):
+        if w_proc.is_pyproc():
+            quicken(vm, self, CallPrimitive(self.A, self.B, self.C))
+        elif isinstance(w_proc, W_Closure):
+            w_skel = w_proc.skeleton
+            if w_skel.nb_args == self.C and not w_skel.varargs_p:
+                quicken(vm, self, CallClosureExact(self.A, self.B, self.C))
+
+class CallPrimitive(Call):
+    """ Quickened Call whose callee has been a python procedure.
+    """
+    def __init__(self, A, B, C):
+        Call.__init__(self, A, B, C)
+        self.may_quicken = False
+
+    def dispatch(self, vm):
+        w_proc = vm.stack[vm.base + self.B]
+        if not w_proc.is_pyproc():
+            despecialize(vm, self).dispatch(vm)
+            return
+        vm.stack[vm.base + self.A] = vm.call_pyproc(
+                w_proc, vm.base + self.B + 1, self.C)
+
+    def generic(self):
+        return Call(self.A, self.B, self.C)
+
+class CallClosureExact(Call):
+    """ Quickened Call whose callee has been a closure taking exactly C
+        arguments, so that there are no varargs to pack.
+    """
+    def __init__(self, A, B, C):
+        Call.__init__(self, A, B, C)
+        self.may_quicken = False
+
+    def dispatch(self, vm):
+        w_proc = vm.stack[vm.base + self.B]
+        if not (isinstance(w_proc, W_Closure) and
+                w_proc.skeleton.nb_args == self.C and
+                not w_proc.skeleton.varargs_p):
+            despecialize(vm, self).dispatch(vm)
+            return
+        vm.save_callinfo()
+        vm.return_addr = self.A
+        vm.enter_closure_exact(w_proc, vm.base + self.B + 1)
+
+    def generic(self):
+        return Call(self.A, self.B, self.C)
+
 
 class TailCall(Instr):
-    """ TailCall -- do not save dump. However, escape the cellvalues on
+    """ TailCall -- do not save callinfo. However, escape the cellvalues on
         the current stack frame since the current closure's frame
         is gone.
         If it's a pyfunc then it's just like normal Call.
@@ -308,61 +409,38 @@ class TailCall(Instr):
     def dispatch(self, vm):
         dest_reg = self.A
         proc_reg = self.B
-        index_of_first_arg = proc_reg + 1
+        index_of_first_arg = vm.base + proc_reg + 1
         actual_argcount = self.C
 
         # make sure its a procedure and we have enough args
-        w_proc = vm.frame[proc_reg]
+        w_proc = vm.stack[vm.base + proc_reg]
 
         if w_proc.is_pyproc():
-            py_args = [vm.frame[index_of_first_arg + i]
-                       for i in xrange(actual_argcount)]
-            w_result = w_proc.py_call(py_args) # Call it!
-            vm.frame[dest_reg] = w_result
+            w_result = vm.call_pyproc(w_proc, index_of_first_arg,
+                                      actual_argcount) # Call it!
+            vm.stack[vm.base + dest_reg] = w_result
             return
 
         assert isinstance(w_proc, W_Closure)
-        w_skel = w_proc.skeleton
-        assert w_skel.nb_args <= actual_argcount
-
-        # handle varargs.
-        if w_skel.nb_args < actual_argcount:
-            assert(w_skel.varargs_p)
-            # vararg is slowish.
-            # XXX: scmlist_to_pylist here
-            vararg = pylist2scm([vm.frame[index_of_first_arg + i]
-                                 for i in xrange(actual_argcount)])
-        else:
-            vararg = None # make pypy happy
 
         # do not save vm's current state. However, escape current cell values
-        #vm.save_dump()
-        vm.escape_cellvalues()
-
-        # switch vm to the new closure
-        old_frame = vm.frame
-        vm.frame = vm.new_frame(w_skel.frame_size)
-        vm.consts = w_skel.consts
-        vm.cellvalues = w_proc.cellvalues
-
-        # loading cellvalues from frame to shadow cellvalue frame.
-        vm.fresh_cells = shad_frame = [None] * len(w_skel.fresh_cells)
-        for i, frameindex in enumerate(w_skel.fresh_cells):
-            w_cellvalue = shad_frame[i] = W_CellValue(vm.frame, frameindex)
-            vm.cellval_head.append(w_cellvalue)
-
-        vm.codes = w_skel.codes
-        vm.pc = 0
-        #vm.return_addr = dest_reg # return address is not changed.
+        #vm.save_callinfo()
+        if vm.captured_p:
+            vm.escape_cellvalues()
 
-        # push the arguments on the new frame
-        # Note that if we have continuous stack frame then the argument
-        # copying overhead could be avoided. But does it worth?
-        # Anyway we can take a profile first.
-        for i in xrange(w_skel.nb_args):
-            vm.frame[i] = old_frame[i + index_of_first_arg]
-        if w_skel.varargs_p:
-            vm.frame[w_skel.nb_args] = vararg
+        # slide the arguments down to the bottom of the current frame,
+        # which is then reused by the new closure.
+        #vm.return_addr = dest_reg # return address is not changed.
+        base = vm.base
+        for i in xrange(actual_argcount):
+            vm.stack[base + i] = vm.stack[index_of_first_arg + i]
+        if w_proc.skeleton.codes is vm.codes:
+            # calling a closure of the running skeleton (e.g., a loop),
+            # the frame is already set up for it.
+            vm.reenter_closure(w_proc.skeleton, w_proc.cellvalues,
+                               actual_argcount)
+        else:
+            vm.enter_closure(w_proc, base, actual_argcount)
 
     def __repr__(self):
         if self.C == 0:
@@ -379,6 +457,69 @@ class TailCall(Instr):
                     self.A, self.B, self.B + 1, self.B + self.C)
 
 
+class CallKnown(Instr):
+    """ rB = skeleton_registry[A](rB + 1, ..., rB + C)
+
+        Call to a procedure that the compiler knows statically, say, a
+        local (define f (lambda ...)) which is never set!. The arity was
+        checked at compile time, so the callee is entered without looking
+        at what rB holds, except for its cellvalues:
+        - a call to the running skeleton uses the running closure's,
+        - a skeleton that captures nothing has none,
+        - otherwise the compiler has loaded the closure to rB.
+        @see vm.VM.known_cellvalues
+    """
+    op_type = OP_TYPE_ABC
+
+    def __init__(self, A, B, C):
+        self.A = A
+        self.B = B
+        self.C = C
+        self.Bx = 0
+
+    def dispatch(self, vm):
+        w_skel = vm.get_skeleton(self.A)
+        cellvalues = vm.known_cellvalues(w_skel, self.B)
+        vm.save_callinfo()
+        vm.return_addr = self.B
+        vm.enter_skeleton(w_skel, cellvalues, vm.base + self.B + 1, self.C)
+
+    def __repr__(self):
+        return '[r(%d) = CloskelT[%d].call(r(%d), ..., r(%d))]' % (
+                self.B, self.A, self.B + 1, self.B + self.C)
+
+class TailCallKnown(Instr):
+    """ TailCall version of CallKnown, @see CallKnown
+    """
+    op_type = OP_TYPE_ABC
+
+    def __init__(self, A, B, C):
+        self.A = A
+        self.B = B
+        self.C = C
+        self.Bx = 0
+
+    @unroll_safe
+    def dispatch(self, vm):
+        w_skel = vm.get_skeleton(self.A)
+        # rB may be overwritten by the arguments.
+        cellvalues = vm.known_cellvalues(w_skel, self.B)
+        if vm.captured_p:
+            vm.escape_cellvalues()
+
+        base = vm.base
+        index_of_first_arg = base + self.B + 1
+        for i in xrange(self.C):
+            vm.stack[base + i] = vm.stack[index_of_first_arg + i]
+        if w_skel.codes is vm.codes:
+            vm.reenter_closure(w_skel, cellvalues, self.C)
+        else:
+            vm.enter_skeleton(w_skel, cellvalues, base, self.C)
+
+    def __repr__(self):
+        return '[r(%d) = CloskelT[%d].tailcall(r(%d), ..., r(%d))]' % (
+                self.B, self.A, self.B + 1, self.B + self.C)
+
 class Return(Instr):
     """ return rB
         
@@ -394,14 +535,14 @@ class Return(Instr):
         self.Bx = 0
 
     def dispatch(self, vm):
-        """ return_value = vm.frame[self.B]
+        """ return_value = vm.stack[vm.base + self.B]
             escape_cellvalues(vm)
-            restore_dump(vm)
+            restore_callinfo(vm)
             # some how the dest reg for return value is restored.
-            vm.frame[dest_reg] = return_value
+            vm.stack[vm.base + dest_reg] = return_value
         """
-        return_value = vm.frame[self.B]
-        vm.restore_dump(return_value)
+        return_value = vm.stack[vm.base + self.B]
+        vm.restore_callinfo(return_value)
 
     def __repr__(self):
         return '[return r(%d)]' % (self.B,)
@@ -425,6 +566,25 @@ class Branch(Instr):
         return '[pc += %d]' % (self.Bx,)
 
 
+class BranchBack(Instr):
+    """ Unconditional jump backward, pc -= Bx, which closes a loop.
+        Bx is unsigned, so the forward branches can't do that.
+    """
+    op_type = OP_TYPE_ABx
+
+    def __init__(self, Bx):
+        self.Bx = Bx
+        self.A = 0
+        self.B = 0
+        self.C = 0
+
+    def dispatch(self, vm):
+        vm.pc -= self.Bx
+
+    def __repr__(self):
+        return '[pc -= %d]' % (self.Bx,)
+
+
 class BranchIfFalse(Instr):
     """ if not rA then pc += self.Bx
     """
@@ -437,7 +597,7 @@ class BranchIfFalse(Instr):
         self.C = 0
 
     def dispatch(self, vm):
-        if not vm.frame[self.A].to_bool():
+        if not vm.stack[vm.base + self.A].to_bool():
             vm.pc += self.Bx
 
     def __repr__(self):
@@ -445,8 +605,217 @@ class BranchIfFalse(Instr):
 
 
 # _________________________________________________________________________
-# application instructions
+# inlined primitives
+
+class ArithInstr(Instr):
+    """ rA = rB <op> rC, for a builtin fixnum primitive.
+
+        The compiler emits these for applications of the global +, -, etc.
+        They are only correct as long as the global is still bound to the
+        builtin, so the binding is checked on every execution through
+        vm.prim_cells. If it was rebound or the operands are not fixnums,
+        this falls back to a generic call of whatever the global holds.
+    """
+    op_type = OP_TYPE_ABC
+    _symbol_name_ = '?'
+    prim_index = -1 # @see inlined_primitive_names
+    w_builtin = None
+
+    def __init__(self, A, B, C):
+        self.A = A
+        self.B = B
+        self.C = C
+        self.Bx = 0
+
+    def fixnum_op(self, lhs, rhs):
+        raise NotImplementedError
+
+    def dispatch(self, vm):
+        w_lhs = vm.stack[vm.base + self.B]
+        w_rhs = vm.stack[vm.base + self.C]
+        w_proc = vm.prim_cells[self.prim_index].w_value
+        if (w_proc is self.w_builtin and w_lhs.is_fixnum() and
+                w_rhs.is_fixnum()):
+            vm.stack[vm.base + self.A] = self.fixnum_op(w_lhs.get_fixnum(),
+                                                        w_rhs.get_fixnum())
+        else:
+            # deoptimize: the primitive was rebound or got some strange args
+            vm.apply_procedure(self.A, w_proc, [w_lhs, w_rhs])
+
+    def __repr__(self):
+        return '[r(%d) = r(%d) %s r(%d)]' % (self.A, self.B,
+                                             self._symbol_name_, self.C)
+
+class Add(ArithInstr):
+    _symbol_name_ = '+'
+
+    def fixnum_op(self, lhs, rhs):
+        return W_Fixnum(lhs + rhs)
+
+class Sub(ArithInstr):
+    _symbol_name_ = '-'
+
+    def fixnum_op(self, lhs, rhs):
+        return W_Fixnum(lhs - rhs)
+
+class Mul(ArithInstr):
+    _symbol_name_ = '*'
+
+    def fixnum_op(self, lhs, rhs):
+        return W_Fixnum(lhs * rhs)
+
+class Lt(ArithInstr):
+    _symbol_name_ = '<'
+
+    def fixnum_op(self, lhs, rhs):
+        return make_bool(lhs < rhs)
+
+class Le(ArithInstr):
+    _symbol_name_ = '<='
+
+    def fixnum_op(self, lhs, rhs):
+        return make_bool(lhs <= rhs)
+
+class Gt(ArithInstr):
+    _symbol_name_ = '>'
+
+    def fixnum_op(self, lhs, rhs):
+        return make_bool(lhs > rhs)
+
+class Ge(ArithInstr):
+    _symbol_name_ = '>='
 
+    def fixnum_op(self, lhs, rhs):
+        return make_bool(lhs >= rhs)
+
+class NumEq(ArithInstr):
+    _symbol_name_ = '='
+
+    def fixnum_op(self, lhs, rhs):
+        return make_bool(lhs == rhs)
+
+class CompareAndBranch(Instr):
+    """ if not (rB <op> rC): pc += 1 + next.Bx
+        else: pc += 1
+
+        Fuses the test of an if with its branch. The compiler always emits a
+        BranchIfFalse rP right after this one, which tells where to jump.
+        In the fast path, the predicate is never materialized and the
+        BranchIfFalse is never dispatched. When the primitive was rebound
+        or the operands are not fixnums, the generic call stores its result
+        to rP and then the BranchIfFalse runs as usual.
+
+        A is the kind of the comparison, @see compare_and_branch_kinds
+    """
+    op_type = OP_TYPE_ABC
+    _symbol_name_ = '?'
+    kind = -1
+    prim_index = -1 # @see inlined_primitive_names
+    w_builtin = None
+
+    def __init__(self, B, C):
+        self.A = self.kind
+        self.B = B
+        self.C = C
+        self.Bx = 0
+
+    def fixnum_test(self, lhs, rhs):
+        raise NotImplementedError
+
+    def dispatch(self, vm):
+        w_lhs = vm.stack[vm.base + self.B]
+        w_rhs = vm.stack[vm.base + self.C]
+        w_proc = vm.prim_cells[self.prim_index].w_value
+        branch = vm.codes[vm.pc]
+        assert isinstance(branch, BranchIfFalse)
+        if (w_proc is self.w_builtin and w_lhs.is_fixnum() and
+                w_rhs.is_fixnum()):
+            if self.fixnum_test(w_lhs.get_fixnum(), w_rhs.get_fixnum()):
+                vm.pc += 1
+            else:
+                vm.pc += 1 + branch.Bx
+        else:
+            # deoptimize, and let the following BranchIfFalse do the rest.
+            vm.apply_procedure(branch.A, w_proc, [w_lhs, w_rhs])
+
+    def __repr__(self):
+        return '[if not r(%d) %s r(%d): pc += 1 + next.Bx]' % (
+                self.B, self._symbol_name_, self.C)
+
+class BranchIfNotLt(CompareAndBranch):
+    _symbol_name_ = '<'
+
+    def fixnum_test(self, lhs, rhs):
+        return lhs < rhs
+
+class BranchIfNotLe(CompareAndBranch):
+    _symbol_name_ = '<='
+
+    def fixnum_test(self, lhs, rhs):
+        return lhs <= rhs
+
+class BranchIfNotGt(CompareAndBranch):
+    _symbol_name_ = '>'
+
+    def fixnum_test(self, lhs, rhs):
+        return lhs > rhs
+
+class BranchIfNotGe(CompareAndBranch):
+    _symbol_name_ = '>='
+
+    def fixnum_test(self, lhs, rhs):
+        return lhs >= rhs
+
+class BranchIfNotNumEq(CompareAndBranch):
+    _symbol_name_ = '='
+
+    def fixnum_test(self, lhs, rhs):
+        return lhs == rhs
+
+class BranchIfNotNull(CompareAndBranch):
+    """ if not (null? rB): pc += 1 + next.Bx
+        else: pc += 1
+
+        C is not used.
+    """
+    _symbol_name_ = 'null?'
+
+    def dispatch(self, vm):
+        w_obj = vm.stack[vm.base + self.B]
+        w_proc = vm.prim_cells[self.prim_index].w_value
+        branch = vm.codes[vm.pc]
+        assert isinstance(branch, BranchIfFalse)
+        if w_proc is self.w_builtin:
+            if w_obj.is_null():
+                vm.pc += 1
+            else:
+                vm.pc += 1 + branch.Bx
+        else:
+            vm.apply_procedure(branch.A, w_proc, [w_obj])
+
+    def __repr__(self):
+        return '[if not null?(r(%d)): pc += 1 + next.Bx]' % (self.B,)
+
+# the primitives that are inlined. vm.prim_cells[i] is the binding cell of
+# inlined_primitive_names[i]
+inlined_primitive_names = ['+', '-', '*', '<', '<=', '>', '>=', '=', 'null?']
+
+arith_instr_map = {} # maps the primitive's name to its instruction class
+for instr_cls in [Add, Sub, Mul, Lt, Le, Gt, Ge, NumEq]:
+    arith_instr_map[instr_cls._symbol_name_] = instr_cls
+
+compare_and_branch_kinds = [BranchIfNotLt, BranchIfNotLe, BranchIfNotGt,
+                            BranchIfNotGe, BranchIfNotNumEq, BranchIfNotNull]
+compare_and_branch_map = {} # maps the primitive's name to its class
+for kind in xrange(len(compare_and_branch_kinds)):
+    instr_cls = compare_and_branch_kinds[kind]
+    instr_cls.kind = kind
+    compare_and_branch_map[instr_cls._symbol_name_] = instr_cls
+
+for instr_cls in arith_instr_map.values() + compare_and_branch_kinds:
+    instr_cls.prim_index = inlined_primitive_names.index(
+            instr_cls._symbol_name_)
+    instr_cls.w_builtin = lib[instr_cls._symbol_name_]
 
 # _________________________________________________________________________
 # opcode numbers map
@@ -463,21 +832,31 @@ op_map = {
     'TailCall':     10,
     'Return':       11,
     'Branch':       12,
-    'BranchIfFalse': 13
+    'BranchIfFalse': 13,
+    'Add':          14,
+    'Sub':          15,
+    'Mul':          16,
+    'Lt':           17,
+    'Le':           18,
+    'Gt':           19,
+    'Ge':           20,
+    'NumEq':        21,
+    'CompareAndBranch': 22,
+    'CallKnown':    23,
+    'TailCallKnown': 24,
+    'BranchBack':   25,
+    'OpenCell':     26,
 }
 
 for op_name, op_num in op_map.items():
     globals()[op_name].op_num = op_num
 
 # _________________________________________________________________________
-# make instruction from a uint32
-def make_instr(u32):
-    op = u32 >> (32 - 5)
-    A = (u32 >> (32 - 5 - 9)) & ((1 << 9) - 1)
-    B = (u32 >> (32 - 5 - 9 - 9)) & ((1 << 9) - 1)
-    C = u32 & ((1 << 9) - 1)
-    Bx = (u32 >> (32 - 5 - 9 - 9)) & ((1 << 18) - 1)
-
+# make an instruction from its opcode and operands
+def new_instr(op, A, B, C, Bx):
+    """ Make the instruction of opcode op from its operands, those it
+        doesn't use are ignored.
+    """
     if op == 1:
         return Halt()
     elif op == 2:
@@ -504,6 +883,32 @@ def make_instr(u32):
         return Branch(Bx)
     elif op == 13:
         return BranchIfFalse(A, Bx)
+    elif op == 14:
+        return Add(A, B, C)
+    elif op == 15:
+        return Sub(A, B, C)
+    elif op == 16:
+        return Mul(A, B, C)
+    elif op == 17:
+        return Lt(A, B, C)
+    elif op == 18:
+        return Le(A, B, C)
+    elif op == 19:
+        return Gt(A, B, C)
+    elif op == 20:
+        return Ge(A, B, C)
+    elif op == 21:
+        return NumEq(A, B, C)
+    elif op == 22:
+        return compare_and_branch_kinds[A](B, C)
+    elif op == 23:
+        return CallKnown(A, B, C)
+    elif op == 24:
+        return TailCallKnown(A, B, C)
+    elif op == 25:
+        return BranchBack(Bx)
+    elif op == 26:
+        return OpenCell(A, B)
     else:
         raise ValueError('unknown opcode -- %d' % op)
 
@@ -284,13 +284,47 @@ w_unspecified = W_Unspecified()
 class W_PyProc(W_Root):
     """ A Python foreign function. Subclass from this to create
         custom procedures.
+
+        Calls with up to three arguments go through call0 ... call3, so
+        that the vm doesn't need to build an argument list. Override the
+        ones for the arities the procedure accepts. py_call is the generic
+        entry, used for more arguments, and is what the default callN
+        fall back to. So a variadic procedure overrides py_call as well.
     """
     def is_pyproc(self):
         return True
 
+    def call0(self):
+        return self.py_call([])
+
+    def call1(self, w_arg0):
+        return self.py_call([w_arg0])
+
+    def call2(self, w_arg0, w_arg1):
+        return self.py_call([w_arg0, w_arg1])
+
+    def call3(self, w_arg0, w_arg1, w_arg2):
+        return self.py_call([w_arg0, w_arg1, w_arg2])
+
     @unroll_safe
     def py_call(self, py_args):
-        raise NotImplementedError
+        raise TypeError('%s -- wrong number of arguments: %d' % (
+            self.to_string(), len(py_args)))
+
+    def call_with_list(self, py_args):
+        """ Call this procedure with a list of arguments of any length.
+        """
+        argc = len(py_args)
+        if argc == 0:
+            return self.call0()
+        elif argc == 1:
+            return self.call1(py_args[0])
+        elif argc == 2:
+            return self.call2(py_args[0], py_args[1])
+        elif argc == 3:
+            return self.call3(py_args[0], py_args[1], py_args[2])
+        else:
+            return self.py_call(py_args)
 
     def to_string(self):
         return '#<py-procedure>'
@@ -0,0 +1,677 @@
+""" Optimization passes over the instructions of a skeleton, run by the
+    compiler before the skeleton is built.
+    @see compilation.SkeletonWalker.to_closure_skeleton
+
+    Every branch goes forward, except the BranchBack that closes a loop
+    compiled from a named let. A loop is only entered through its head,
+    so a forward walk sees every predecessor of an instruction before the
+    instruction itself, save for the back edges to the loop heads.
+"""
+from pypy.rlib.jit import dont_look_inside
+from sanya.config import PEEPHOLE_STATS
+from sanya.instruction_set import (MoveLocal, LoadConst, LoadGlobal,
+        LoadCell, StoreGlobal, StoreCell, BuildClosure, Call, TailCall,
+        CallKnown, TailCallKnown, Return, Halt, Branch, BranchBack,
+        BranchIfFalse,
+        ArithInstr, CompareAndBranch, BranchIfNotNull, arith_instr_map,
+        inlined_primitive_names)
+from sanya.objectmodel import W_Fixnum, make_bool
+from sanya.stdlib import lib
+
+# largest magnitude of a folded fixnum, so that chunkio can still dump it.
+MAX_FOLDED_FIXNUM = (1 << 31) - 2
+
+def branch_target(instrs, index):
+    """ Return the index the branch at instrs[index] may jump to.
+        For a CompareAndBranch, that's the target of its BranchIfFalse.
+    """
+    instr = instrs[index]
+    if isinstance(instr, CompareAndBranch):
+        return branch_target(instrs, index + 1)
+    if isinstance(instr, BranchBack):
+        return index + 1 - instr.Bx
+    assert isinstance(instr, Branch) or isinstance(instr, BranchIfFalse)
+    return index + 1 + instr.Bx
+
+@dont_look_inside
+def remove_instrs(instrs, dead):
+    """ Return instrs without the instructions whose dead flag is set, with
+        the branch offsets fixed up. A branch to a removed instruction then
+        goes to the next instruction that is kept.
+    """
+    new_index = [0] * (len(instrs) + 1)
+    nb_kept = 0
+    for i in xrange(len(instrs)):
+        new_index[i] = nb_kept
+        if not dead[i]:
+            nb_kept += 1
+    new_index[len(instrs)] = nb_kept
+
+    new_instrs = [None] * nb_kept
+    for i in xrange(len(instrs)):
+        if dead[i]:
+            continue
+        instr = instrs[i]
+        if isinstance(instr, Branch) or isinstance(instr, BranchIfFalse):
+            new_Bx = new_index[branch_target(instrs, i)] - new_index[i] - 1
+            if isinstance(instr, Branch):
+                instr = Branch(new_Bx)
+            else:
+                instr = BranchIfFalse(instr.A, new_Bx)
+        elif isinstance(instr, BranchBack):
+            instr = BranchBack(new_index[i] + 1 -
+                               new_index[branch_target(instrs, i)])
+        elif isinstance(instr, CompareAndBranch):
+            # the pair is kept or removed together
+            assert not dead[i + 1]
+        new_instrs[new_index[i]] = instr
+    return new_instrs
+
+# _________________________________________________________________________
+# constant folding
+
+class KnownValue(object):
+    """ What is known about a frame slot: it's either the constant
+        consts[const_index] or the builtin primitive prim_name.
+    """
+    def __init__(self, const_index, w_const, prim_name):
+        self.const_index = const_index
+        self.w_const = w_const
+        self.prim_name = prim_name
+
+    def is_const(self):
+        return self.const_index >= 0
+
+    def same_as(self, other):
+        return (self.const_index == other.const_index and
+                self.prim_name == other.prim_name)
+
+def merge_states(state, other):
+    for slotindex in state.keys():
+        other_known = other.get(slotindex, None)
+        if other_known is None or not state[slotindex].same_as(other_known):
+            del state[slotindex]
+
+def forget_from(state, first):
+    """ Forget what is known about the slots from first on.
+    """
+    for slotindex in state.keys():
+        if slotindex >= first:
+            del state[slotindex]
+
+def fold_primitive(prim_name, args_w):
+    """ Return the result of applying the builtin prim_name to args_w, or
+        None if that can't be done at compile time.
+    """
+    if prim_name == 'null?':
+        if len(args_w) != 1:
+            return None
+        return make_bool(args_w[0].is_null())
+
+    for w_arg in args_w:
+        if not w_arg.is_fixnum():
+            return None
+    if prim_name in ['+', '*']:
+        pass
+    elif prim_name == '-':
+        if len(args_w) == 0:
+            return None
+    elif len(args_w) != 2: # comparisons
+        return None
+    w_result = lib[prim_name].call_with_list(args_w)
+    if w_result.is_fixnum():
+        ival = w_result.get_fixnum()
+        if ival > MAX_FOLDED_FIXNUM or ival < -MAX_FOLDED_FIXNUM:
+            return None
+    return w_result
+
+class ConstantFolder(object):
+    """ Folds applications of builtin primitives to constants, propagates
+        constants through the frame slots and removes the branches whose
+        predicate is constant, together with the code that becomes
+        unreachable.
+
+        This assumes that the builtins named in inlined_primitive_names are
+        never rebound, @see config.CONSTANT_FOLDING
+
+        Slots in fresh_cells are never known, since they can be changed
+        through their cellvalue by any call. Neither are the slots that a
+        loop writes to when entering its head, so its back edges need not
+        be followed.
+    """
+    def __init__(self, walker):
+        self.walker = walker
+        self.instrs = walker.instrs
+        self.captured = {}
+        for frameindex in walker.fresh_cells:
+            self.captured[frameindex] = None
+        # state of the frame when entering each instruction, a dict which
+        # maps the known slots to their KnownValue, or None if the
+        # instruction can't be reached (yet).
+        self.states = [None] * (len(self.instrs) + 1)
+        self.dead = [False] * len(self.instrs)
+        self.loops = self.find_loops()
+
+    def find_loops(self):
+        """ Return a map from the head of every loop to the slots that may be
+            written from there until the loop's last back edge, including
+            the loops which branch back into it.
+        """
+        instrs = self.instrs
+        back_edges = []
+        for i in xrange(len(instrs)):
+            if isinstance(instrs[i], BranchBack):
+                back_edges.append(i)
+        loops = {}
+        for i in back_edges:
+            head = branch_target(instrs, i)
+            if head in loops:
+                continue
+            end = head
+            changed = True
+            while changed:
+                changed = False
+                for j in back_edges:
+                    target = branch_target(instrs, j)
+                    if j > end and head <= target and target <= end:
+                        end = j
+                        changed = True
+            written = {}
+            for j in xrange(head, end + 1):
+                for slotindex in self.instr_writes(j):
+                    written[slotindex] = None
+            loops[head] = written
+        return loops
+
+    def instr_writes(self, index):
+        instr = self.instrs[index]
+        if (isinstance(instr, Call) or isinstance(instr, TailCall) or
+                isinstance(instr, CallKnown) or
+                isinstance(instr, TailCallKnown)):
+            # the callee's frame overlaps every slot above the proc.
+            writes = range(instr.B, self.walker.frame_size)
+            writes.append(instr.A)
+            return writes
+        elif isinstance(instr, CompareAndBranch):
+            return [self.instrs[index + 1].A]
+        dest = instr_dest(instr)
+        if dest >= 0:
+            return [dest]
+        return []
+
+    @dont_look_inside
+    def run(self):
+        instrs = self.instrs
+        self.states[0] = {}
+        i = 0
+        while i < len(instrs):
+            state = self.states[i]
+            if state is None: # unreachable
+                self.dead[i] = True
+                i += 1
+            else:
+                if i in self.loops:
+                    for slotindex in self.loops[i]:
+                        if slotindex in state:
+                            del state[slotindex]
+                i = self.fold_instr(i, state)
+        return remove_instrs(instrs, self.dead)
+
+    def flow_to(self, index, state):
+        assert index < len(self.states)
+        if self.states[index] is None:
+            self.states[index] = state.copy()
+        else:
+            merge_states(self.states[index], state)
+
+    def fall_to(self, index, state):
+        """ Like flow_to, for the instruction that follows, which then takes
+            state, so that straight-line code doesn't copy it.
+        """
+        assert index < len(self.states)
+        if self.states[index] is None:
+            self.states[index] = state
+        else:
+            merge_states(self.states[index], state)
+
+    def set_slot(self, state, slotindex, known):
+        if known is None or slotindex in self.captured:
+            if slotindex in state:
+                del state[slotindex]
+        else:
+            state[slotindex] = known
+
+    def load_const(self, index, state, dest, w_const):
+        """ Replace instrs[index] with rA = w_const.
+        """
+        const_index = self.walker.new_const_slot(w_const)
+        self.instrs[index] = LoadConst(dest, const_index)
+        self.set_slot(state, dest, KnownValue(const_index, w_const, None))
+
+    def known_const(self, state, slotindex):
+        known = state.get(slotindex, None)
+        if known is not None and known.is_const():
+            return known.w_const
+        return None
+
+    def fold_instr(self, i, state):
+        """ Fold instrs[i], which is entered with state, and propagate the
+            resulting state to its successors. Return the index of the next
+            instruction to fold. state is updated in place, since it's only
+            copied to the branch targets.
+        """
+        instr = self.instrs[i]
+
+        if isinstance(instr, LoadConst):
+            self.set_slot(state, instr.A, KnownValue(instr.B,
+                    self.walker.consts[instr.B], None))
+
+        elif isinstance(instr, MoveLocal):
+            known = state.get(instr.B, None)
+            if known is not None and known.is_const():
+                self.instrs[i] = LoadConst(instr.A, known.const_index)
+            self.set_slot(state, instr.A, known)
+
+        elif isinstance(instr, LoadGlobal):
+            w_symbol = self.walker.consts[instr.B]
+            known = None
+            if w_symbol.to_string() in inlined_primitive_names:
+                known = KnownValue(-1, None, w_symbol.to_string())
+            self.set_slot(state, instr.A, known)
+
+        elif isinstance(instr, LoadCell) or isinstance(instr, BuildClosure):
+            self.set_slot(state, instr.A, None)
+
+        elif isinstance(instr, ArithInstr):
+            w_lhs = self.known_const(state, instr.B)
+            w_rhs = self.known_const(state, instr.C)
+            w_result = None
+            if w_lhs is not None and w_rhs is not None:
+                w_result = fold_primitive(instr._symbol_name_, [w_lhs, w_rhs])
+            if w_result is not None:
+                self.load_const(i, state, instr.A, w_result)
+            else:
+                self.set_slot(state, instr.A, None)
+
+        elif isinstance(instr, Call) or isinstance(instr, TailCall):
+            w_result = self.fold_call(state, instr)
+            if w_result is not None:
+                self.load_const(i, state, instr.A, w_result)
+            else:
+                # the callee's frame overlaps every slot above the proc.
+                forget_from(state, instr.B)
+                self.set_slot(state, instr.A, None)
+
+        elif (isinstance(instr, CallKnown) or
+                isinstance(instr, TailCallKnown)):
+            # the result goes to rB.
+            forget_from(state, instr.B)
+
+        elif isinstance(instr, CompareAndBranch):
+            return self.fold_compare_and_branch(i, state)
+
+        elif isinstance(instr, BranchIfFalse):
+            w_pred = self.known_const(state, instr.A)
+            if w_pred is None:
+                self.flow_to(branch_target(self.instrs, i), state)
+            elif w_pred.to_bool():
+                self.dead[i] = True
+            else:
+                self.instrs[i] = Branch(instr.Bx)
+                self.flow_to(branch_target(self.instrs, i), state)
+                return i + 1
+
+        elif isinstance(instr, Branch):
+            self.flow_to(branch_target(self.instrs, i), state)
+            return i + 1
+
+        elif isinstance(instr, BranchBack):
+            return i + 1 # the head's state is already conservative
+
+        elif isinstance(instr, Return) or isinstance(instr, Halt):
+            return i + 1
+
+        # StoreGlobal and StoreCell don't write to the frame.
+        self.fall_to(i + 1, state)
+        return i + 1
+
+    def fold_call(self, state, instr):
+        known = state.get(instr.B, None)
+        if known is None or known.prim_name is None:
+            return None
+        args_w = [None] * instr.C
+        for i in xrange(instr.C):
+            w_arg = self.known_const(state, instr.B + 1 + i)
+            if w_arg is None:
+                return None
+            args_w[i] = w_arg
+        return fold_primitive(known.prim_name, args_w)
+
+    def fold_compare_and_branch(self, i, state):
+        instr = self.instrs[i]
+        assert isinstance(instr, CompareAndBranch)
+        args_w = [self.known_const(state, instr.B)]
+        if not isinstance(instr, BranchIfNotNull):
+            args_w.append(self.known_const(state, instr.C))
+        w_result = None
+        if None not in args_w:
+            w_result = fold_primitive(instr._symbol_name_, args_w)
+        if w_result is None:
+            # when not taking the fast path, the predicate is stored to
+            # the BranchIfFalse's slot, which then runs.
+            self.set_slot(state, self.instrs[i + 1].A, None)
+            self.fall_to(i + 1, state)
+            return i + 1
+
+        # the pair is replaced as a whole.
+        self.dead[i] = True
+        if w_result.to_bool():
+            self.dead[i + 1] = True
+            self.fall_to(i + 2, state)
+        else:
+            branch = self.instrs[i + 1]
+            self.instrs[i + 1] = Branch(branch.Bx)
+            self.flow_to(branch_target(self.instrs, i + 1), state)
+        return i + 2
+
+@dont_look_inside
+def fold_constants(walker):
+    """ Return the walker's instructions with constants folded,
+        @see ConstantFolder
+    """
+    return ConstantFolder(walker).run()
+
+# _________________________________________________________________________
+# peephole optimization
+
+def instr_uses(instr):
+    """ Return the list of frame slots that instr reads.
+    """
+    if isinstance(instr, MoveLocal):
+        return [instr.B]
+    elif isinstance(instr, StoreGlobal) or isinstance(instr, StoreCell):
+        return [instr.B]
+    elif isinstance(instr, Return):
+        return [instr.B]
+    elif isinstance(instr, BranchIfFalse):
+        return [instr.A]
+    elif isinstance(instr, ArithInstr):
+        return [instr.B, instr.C]
+    elif isinstance(instr, BranchIfNotNull):
+        return [instr.B]
+    elif isinstance(instr, CompareAndBranch):
+        return [instr.B, instr.C]
+    elif (isinstance(instr, Call) or isinstance(instr, TailCall) or
+            isinstance(instr, CallKnown) or isinstance(instr, TailCallKnown)):
+        return [instr.B + i for i in xrange(instr.C + 1)]
+    return []
+
+def instr_dest(instr):
+    """ Return the frame slot that instr always writes to, or -1.
+    """
+    if (isinstance(instr, MoveLocal) or isinstance(instr, LoadConst) or
+            isinstance(instr, LoadGlobal) or isinstance(instr, LoadCell) or
+            isinstance(instr, BuildClosure) or isinstance(instr, ArithInstr)
+            or isinstance(instr, Call)):
+        return instr.A
+    elif isinstance(instr, CallKnown):
+        return instr.B
+    return -1
+
+def with_dest(instr, dest):
+    """ Return a copy of instr that writes to dest instead, or None if
+        that's not supported.
+    """
+    if isinstance(instr, MoveLocal):
+        return MoveLocal(dest, instr.B)
+    elif isinstance(instr, LoadConst):
+        return LoadConst(dest, instr.B)
+    elif isinstance(instr, LoadGlobal):
+        return LoadGlobal(dest, instr.B)
+    elif isinstance(instr, LoadCell):
+        return LoadCell(dest, instr.B)
+    elif isinstance(instr, ArithInstr):
+        return arith_instr_map[instr._symbol_name_](dest, instr.B, instr.C)
+    elif isinstance(instr, Call):
+        return Call(dest, instr.B, instr.C)
+    return None
+
+def successors(instrs, index):
+    instr = instrs[index]
+    if isinstance(instr, Branch) or isinstance(instr, BranchBack):
+        return [branch_target(instrs, index)]
+    elif isinstance(instr, BranchIfFalse):
+        return [index + 1, branch_target(instrs, index)]
+    elif isinstance(instr, Return) or isinstance(instr, Halt):
+        return []
+    return [index + 1]
+
+class PeepholeOptimizer(object):
+    """ Cleans up what the walker emits, repeating until nothing changes:
+
+        - branches to an unconditional branch go to its target instead,
+        - branches to the next instruction are removed,
+        - loads into a slot that is never read afterwards are removed,
+          e.g., the unspecified value of a define in a begin,
+        - rA = ...; rB = rA, when rA is dead afterwards, becomes rB = ...
+
+        A CompareAndBranch and its BranchIfFalse are never split.
+        Slots in fresh_cells are always live, since their cellvalue may be
+        read by any call.
+    """
+    def __init__(self, walker):
+        self.instrs = walker.instrs
+        self.frame_size = walker.frame_size
+        self.captured = [False] * walker.frame_size
+        for frameindex in walker.fresh_cells:
+            self.captured[frameindex] = True
+
+    @dont_look_inside
+    def run(self):
+        changed = True
+        while changed:
+            self.thread_branches()
+            dead = [False] * len(self.instrs)
+            changed = self.remove_dead_code(dead)
+            if changed:
+                self.instrs = remove_instrs(self.instrs, dead)
+        return self.instrs
+
+    def thread_branches(self):
+        instrs = self.instrs
+        for i in xrange(len(instrs)):
+            instr = instrs[i]
+            if not (isinstance(instr, Branch) or
+                    isinstance(instr, BranchIfFalse)):
+                continue
+            target = branch_target(instrs, i)
+            while target < len(instrs) and isinstance(instrs[target],
+                                                      Branch):
+                target = branch_target(instrs, target)
+            Bx = target - i - 1
+            if Bx != instr.Bx:
+                if isinstance(instr, Branch):
+                    instrs[i] = Branch(Bx)
+                else:
+                    instrs[i] = BranchIfFalse(instr.A, Bx)
+
+    def compute_liveness(self):
+        """ Return, for every instruction, a dict that maps the slot it
+            writes to and those it reads to whether that slot may be read
+            after it. The captured slots, which are always live, are left
+            out, @see live_after
+
+            This is first found for the basic blocks: each slot is followed
+            back from the blocks that read it before writing it, through
+            their predecessors, until the blocks that write it. It takes
+            time in the size of the live ranges, counted in blocks, and
+            loops need no fixpoint. Each block is then walked backwards,
+            from the slots that are live after it.
+        """
+        instrs = self.instrs
+        # the basic blocks, as the index of their first instruction
+        block_of = [0] * len(instrs)
+        starts = []
+        leader = [False] * (len(instrs) + 1)
+        leader[0] = True
+        for i in xrange(len(instrs)):
+            succs = successors(instrs, i)
+            if len(succs) != 1 or succs[0] != i + 1:
+                leader[i + 1] = True
+                for succ in succs:
+                    leader[succ] = True
+        for i in xrange(len(instrs)):
+            if leader[i]:
+                starts.append(i)
+            block_of[i] = len(starts) - 1
+        nblocks = len(starts)
+        starts.append(len(instrs))
+
+        predecessors = [None] * nblocks
+        exposed = [None] * nblocks # the slots read before being written
+        written = [None] * nblocks
+        for b in xrange(nblocks):
+            predecessors[b] = []
+            exposed[b] = {}
+            written[b] = {}
+        readers = [None] * self.frame_size # the blocks exposing each slot
+        for b in xrange(nblocks):
+            for i in xrange(starts[b + 1] - 1, starts[b] - 1, -1):
+                dest = instr_dest(instrs[i])
+                if dest >= 0 and not self.captured[dest]:
+                    written[b][dest] = None
+                    if dest in exposed[b]:
+                        del exposed[b][dest]
+                for slotindex in instr_uses(instrs[i]):
+                    if not self.captured[slotindex]:
+                        exposed[b][slotindex] = None
+            for slotindex in exposed[b]:
+                if readers[slotindex] is None:
+                    readers[slotindex] = []
+                readers[slotindex].append(b)
+            for succ in successors(instrs, starts[b + 1] - 1):
+                if succ < len(instrs):
+                    predecessors[block_of[succ]].append(b)
+
+        block_live_out = [None] * nblocks
+        for b in xrange(nblocks):
+            block_live_out[b] = {}
+        live_in = [-1] * nblocks # the last slot found live on entry
+        for slotindex in xrange(self.frame_size):
+            pending = readers[slotindex]
+            if pending is None:
+                continue
+            for b in pending:
+                live_in[b] = slotindex
+            while pending:
+                b = pending.pop()
+                for pred in predecessors[b]:
+                    block_live_out[pred][slotindex] = None
+                    if (live_in[pred] != slotindex and
+                            slotindex not in written[pred]):
+                        live_in[pred] = slotindex
+                        pending.append(pred)
+
+        live_out = [None] * len(instrs)
+        for b in xrange(nblocks):
+            live = {} # for the slots used further in the block
+            for i in xrange(starts[b + 1] - 1, starts[b] - 1, -1):
+                instr = instrs[i]
+                dest = instr_dest(instr)
+                uses = instr_uses(instr)
+                answers = {}
+                if dest >= 0:
+                    uses.append(dest)
+                for slotindex in uses:
+                    if self.captured[slotindex]:
+                        continue
+                    if slotindex in live:
+                        answers[slotindex] = live[slotindex]
+                    else:
+                        answers[slotindex] = slotindex in block_live_out[b]
+                live_out[i] = answers
+                if dest >= 0:
+                    live[dest] = False
+                for slotindex in instr_uses(instr):
+                    live[slotindex] = True
+        return live_out
+
+    def live_after(self, live_out, i, slotindex):
+        """ Whether slotindex, which instrs[i] writes to or reads, may be
+            read after it.
+        """
+        return self.captured[slotindex] or live_out[i][slotindex]
+
+    def branch_targets(self):
+        instrs = self.instrs
+        targets = [False] * (len(instrs) + 1)
+        for i in xrange(len(instrs)):
+            instr = instrs[i]
+            if (isinstance(instr, Branch) or isinstance(instr, BranchIfFalse)
+                    or isinstance(instr, BranchBack)):
+                targets[branch_target(instrs, i)] = True
+        return targets
+
+    def remove_dead_code(self, dead):
+        """ Mark the useless instructions in dead, possibly rewriting the
+            others. Return whether anything was marked.
+        """
+        instrs = self.instrs
+        live_out = self.compute_liveness()
+        targets = self.branch_targets()
+        changed = False
+        for i in xrange(len(instrs)):
+            instr = instrs[i]
+            if dead[i]:
+                continue
+            if isinstance(instr, Branch) and instr.Bx == 0:
+                dead[i] = True
+            elif (isinstance(instr, BranchIfFalse) and instr.Bx == 0 and
+                    not (i > 0 and isinstance(instrs[i - 1],
+                                              CompareAndBranch))):
+                dead[i] = True
+            elif (isinstance(instr, MoveLocal) and instr.A == instr.B):
+                dead[i] = True
+            elif ((isinstance(instr, LoadConst) or
+                    isinstance(instr, MoveLocal) or
+                    isinstance(instr, LoadCell)) and
+                    not self.live_after(live_out, i, instr.A)):
+                dead[i] = True
+            elif self.coalesce_move(i, live_out, targets):
+                dead[i + 1] = True
+            else:
+                continue
+            changed = True
+        return changed
+
+    def coalesce_move(self, i, live_out, targets):
+        """ If instrs[i] writes rA, which is only read by the MoveLocal
+            that follows it, write to the MoveLocal's destination instead.
+        """
+        instrs = self.instrs
+        instr = instrs[i]
+        dest = instr_dest(instr)
+        if dest < 0 or i + 1 >= len(instrs) or targets[i + 1]:
+            return False
+        move = instrs[i + 1]
+        if not (isinstance(move, MoveLocal) and move.B == dest and
+                move.A != dest and
+                not self.live_after(live_out, i + 1, dest)):
+            return False
+        new_instr = with_dest(instr, move.A)
+        if new_instr is None:
+            return False
+        instrs[i] = new_instr
+        return True
+
+@dont_look_inside
+def peephole(walker):
+    """ Return the walker's instructions, cleaned up by the
+        PeepholeOptimizer.
+    """
+    nb_instrs = len(walker.instrs)
+    instrs = PeepholeOptimizer(walker).run()
+    if PEEPHOLE_STATS:
+        print 'peephole: %d -> %d instructions, %d removed' % (
+                nb_instrs, len(instrs), nb_instrs - len(instrs))
+    return instrs
@@ -1,5 +1,7 @@
 """ Provides some builtin functions so that we don't need to write in asm...
     Calling functions here may be a bottleneck but what to do?
+    Calls with few arguments use W_PyProc's fixed-arity protocol,
+    @see objectmodel.W_PyProc
 """
 import os
 from pypy.rlib.jit import unroll_safe
@@ -7,18 +9,29 @@ from sanya.objectmodel import *
 
 def open_lib(vm):
     for name, value in lib.items():
-        vm.globalvars[make_symbol(name)] = value
+        vm.get_global_cell(make_symbol(name)).w_value = value
 
 class W_AddProc(W_PyProc):
     _symbol_name_ = '+'
 
+    def call0(self):
+        return W_Fixnum(0)
+
+    def call1(self, w_obj):
+        assert w_obj.is_fixnum()
+        return w_obj
+
+    def call2(self, lhs, rhs):
+        assert lhs.is_fixnum() and rhs.is_fixnum()
+        return W_Fixnum(lhs.get_fixnum() + rhs.get_fixnum())
+
     @unroll_safe
     def py_call(self, py_args):
-        res = W_Fixnum(0)
+        res = 0
         for w_obj in py_args:
             assert w_obj.is_fixnum()
-            res = W_Fixnum(res.get_fixnum()+ w_obj.get_fixnum())
-        return res
+            res += w_obj.get_fixnum()
+        return W_Fixnum(res)
 
     def to_string(self):
         return '#<primitive-procedure +>'
@@ -26,6 +39,13 @@ class W_AddProc(W_PyProc):
 class W_SubtractProc(W_PyProc):
     _symbol_name_ = '-'
 
+    def call1(self, w_obj):
+        return w_obj
+
+    def call2(self, lhs, rhs):
+        assert lhs.is_fixnum() and rhs.is_fixnum()
+        return W_Fixnum(lhs.get_fixnum() - rhs.get_fixnum())
+
     @unroll_safe
     def py_call(self, py_args):
         assert len(py_args) >= 1
@@ -40,13 +60,36 @@ class W_SubtractProc(W_PyProc):
     def to_string(self):
         return '#<primitive-procedure ->'
 
-class W_DisplayProc(W_PyProc):
-    _symbol_name_ = 'display'
+class W_MultiplyProc(W_PyProc):
+    _symbol_name_ = '*'
+
+    def call0(self):
+        return W_Fixnum(1)
+
+    def call1(self, w_obj):
+        assert w_obj.is_fixnum()
+        return w_obj
+
+    def call2(self, lhs, rhs):
+        assert lhs.is_fixnum() and rhs.is_fixnum()
+        return W_Fixnum(lhs.get_fixnum() * rhs.get_fixnum())
 
     @unroll_safe
     def py_call(self, py_args):
-        assert len(py_args) == 1
-        os.write(1, py_args[0].to_string())
+        res = 1
+        for w_obj in py_args:
+            assert w_obj.is_fixnum()
+            res *= w_obj.get_fixnum()
+        return W_Fixnum(res)
+
+    def to_string(self):
+        return '#<primitive-procedure *>'
+
+class W_DisplayProc(W_PyProc):
+    _symbol_name_ = 'display'
+
+    def call1(self, w_obj):
+        os.write(1, w_obj.to_string())
         return w_unspecified
 
     def to_string(self):
@@ -55,9 +98,7 @@ class W_DisplayProc(W_PyProc):
 class W_NewlineProc(W_PyProc):
     _symbol_name_ = 'newline'
 
-    @unroll_safe
-    def py_call(self, py_args):
-        assert len(py_args) == 0
+    def call0(self):
         os.write(1, '\n')
         return w_unspecified
 
@@ -67,25 +108,57 @@ class W_NewlineProc(W_PyProc):
 class W_LessThanProc(W_PyProc):
     _symbol_name_ = '<'
 
-    @unroll_safe
-    def py_call(self, py_args):
-        assert len(py_args) == 2
-        lhs = py_args[0]
-        rhs = py_args[1]
+    def call2(self, lhs, rhs):
         assert lhs.is_fixnum() and rhs.is_fixnum()
         return make_bool(lhs.get_fixnum() < rhs.get_fixnum())
 
     def to_string(self):
         return '#<primitive-procedure lt>'
 
+class W_LessEqualProc(W_PyProc):
+    _symbol_name_ = '<='
+
+    def call2(self, lhs, rhs):
+        assert lhs.is_fixnum() and rhs.is_fixnum()
+        return make_bool(lhs.get_fixnum() <= rhs.get_fixnum())
+
+    def to_string(self):
+        return '#<primitive-procedure le>'
+
+class W_GreaterThanProc(W_PyProc):
+    _symbol_name_ = '>'
+
+    def call2(self, lhs, rhs):
+        assert lhs.is_fixnum() and rhs.is_fixnum()
+        return make_bool(lhs.get_fixnum() > rhs.get_fixnum())
+
+    def to_string(self):
+        return '#<primitive-procedure gt>'
+
+class W_GreaterEqualProc(W_PyProc):
+    _symbol_name_ = '>='
+
+    def call2(self, lhs, rhs):
+        assert lhs.is_fixnum() and rhs.is_fixnum()
+        return make_bool(lhs.get_fixnum() >= rhs.get_fixnum())
+
+    def to_string(self):
+        return '#<primitive-procedure ge>'
+
+class W_NumEqualProc(W_PyProc):
+    _symbol_name_ = '='
+
+    def call2(self, lhs, rhs):
+        assert lhs.is_fixnum() and rhs.is_fixnum()
+        return make_bool(lhs.get_fixnum() == rhs.get_fixnum())
+
+    def to_string(self):
+        return '#<primitive-procedure eq>'
+
 class W_Cons(W_PyProc):
     _symbol_name_ = 'cons'
 
-    @unroll_safe
-    def py_call(self, py_args):
-        assert len(py_args) == 2
-        lhs = py_args[0]
-        rhs = py_args[1]
+    def call2(self, lhs, rhs):
         return W_Pair(lhs, rhs)
 
     def to_string(self):
@@ -94,10 +167,7 @@ class W_Cons(W_PyProc):
 class W_Car(W_PyProc):
     _symbol_name_ = 'car'
 
-    @unroll_safe
-    def py_call(self, py_args):
-        assert len(py_args) == 1
-        w_pair = py_args[0]
+    def call1(self, w_pair):
         assert isinstance(w_pair, W_Pair)
         return w_pair.car
 
@@ -107,16 +177,22 @@ class W_Car(W_PyProc):
 class W_Cdr(W_PyProc):
     _symbol_name_ = 'cdr'
 
-    @unroll_safe
-    def py_call(self, py_args):
-        assert len(py_args) == 1
-        w_pair = py_args[0]
+    def call1(self, w_pair):
         assert isinstance(w_pair, W_Pair)
         return w_pair.cdr
 
     def to_string(self):
         return '#<primitive-procedure cdr>'
 
+class W_NullP(W_PyProc):
+    _symbol_name_ = 'null?'
+
+    def call1(self, w_obj):
+        return make_bool(w_obj.is_null())
+
+    def to_string(self):
+        return '#<primitive-procedure null?>'
+
 lib = {}
 for name in dir():
     obj = globals()[name]
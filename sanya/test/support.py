@@ -0,0 +1,27 @@
+import os
+import subprocess
+import sys
+
+import sanya
+from sanya.config import CHUNK_CACHE_ENV
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(sanya.__file__)))
+TEST_DIR = os.path.join(ROOT, 'sanya', 'test')
+SCRIPT_DIR = os.path.join(ROOT, 'test-scripts')
+
+def run_targetscheme(*args, **kwds):
+    """ Run targetscheme.py on top of this python with the arguments, and
+        return what it wrote. The chunk cache is disabled, unless the
+        directory of one is given as cache_dir.
+    """
+    cmd = [sys.executable, os.path.join(ROOT, 'targetscheme.py')]
+    env = os.environ.copy()
+    env[CHUNK_CACHE_ENV] = kwds.get('cache_dir', '')
+    proc = subprocess.Popen(cmd + list(args), cwd=ROOT, env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = proc.communicate()[0]
+    assert proc.returncode == 0, output
+    return output
+
+def run_script(name):
+    return run_targetscheme(os.path.join(SCRIPT_DIR, name))
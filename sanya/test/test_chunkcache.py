@@ -0,0 +1,43 @@
+import os
+import shutil
+import tempfile
+
+import __pypy_path__
+from sanya import chunkio
+from sanya.test.support import run_targetscheme
+
+SOURCE = '(define f (lambda (x) (+ x 12345))) (display (f 1))'
+
+def corrupt_const(path, ival):
+    """ Flip a bit of the fixnum constant ival in the chunk at path.
+    """
+    f = open(path, 'rb')
+    data = f.read()
+    f.close()
+    const = chunkio.ChunkWriter()
+    const.write(chunkio.K_FIXNUM)
+    chunkio.dump_varint(chunkio.zigzag(ival), const)
+    pos = data.index(const.getvalue()) + 1
+    f = open(path, 'wb')
+    f.write(data[:pos] + chr(ord(data[pos]) ^ 2) + data[pos + 1:])
+    f.close()
+
+def test_corrupted_skeleton_is_recompiled():
+    cache_dir = tempfile.mkdtemp()
+    try:
+        source_path = os.path.join(cache_dir, 'f.scm')
+        f = open(source_path, 'w')
+        f.write(SOURCE)
+        f.close()
+        chunk_dir = os.path.join(cache_dir, 'chunks')
+        assert run_targetscheme(source_path, cache_dir=chunk_dir) == '12346'
+        [name] = os.listdir(chunk_dir)
+        chunk_path = os.path.join(chunk_dir, name)
+        # the constant is only in the skeleton of f, not the toplevel one
+        corrupt_const(chunk_path, 12345)
+        assert run_targetscheme(source_path, cache_dir=chunk_dir) == '12346'
+        # and the chunk was compiled again
+        chunkio.open_chunk(chunk_path).verify_all()
+        assert run_targetscheme(source_path, cache_dir=chunk_dir) == '12346'
+    finally:
+        shutil.rmtree(cache_dir)
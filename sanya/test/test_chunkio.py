@@ -0,0 +1,156 @@
+import os
+
+import __pypy_path__
+from sanya import chunkio
+from sanya.compilation import compile_list_of_expr
+from sanya.instruction_set import Branch, MoveLocal
+from sanya.parser import parse_string
+from sanya.test.support import TEST_DIR, run_targetscheme
+
+def fixture(name):
+    return os.path.join(TEST_DIR, name)
+
+def load_fixture(name):
+    f = open(fixture(name), 'rb')
+    try:
+        return chunkio.load_from_string(f.read())
+    finally:
+        f.close()
+
+def test_load_v1_fibo():
+    # test-scripts/fibo.scm, compiled by the release which wrote version 1
+    w_root = load_fixture('fibo-v1.scmc')
+    assert len(w_root.skeleton_registry) == 1
+    w_fibo = w_root.skeleton_registry[0]
+    assert [repr(instr) for instr in w_fibo.codes[:7]] == [
+        '[r(2) = g(k(0))]',
+        '[r(3) = r(0)]',
+        '[r(4) = k(1)]',
+        '[r(5) = r(2).call(r(3), r(4))]',
+        '[if not r(5): pc += 2]',
+        '[r(1) = r(0)]',
+        '[pc += 15]',
+    ]
+    assert [w_const.to_string() for w_const in w_fibo.consts] == [
+        '<', '2', '+', 'fibo', '-', '1', '2']
+    assert w_fibo.nb_args == 1
+    assert not w_fibo.varargs_p
+    assert not w_fibo.captured_p
+
+def test_run_v1_escaped_cellval_shared():
+    output = run_targetscheme('-r', fixture('escaped-cellval-shared-v1.scmc'))
+    assert output == '123210'
+
+def test_reject_unknown_version():
+    data = chunkio.CHUNK_MAGIC + chr(chunkio.CHUNK_VERSION + 1)
+    try:
+        chunkio.load_from_string(data)
+    except ValueError, e:
+        assert 'unsupported version' in str(e)
+    else:
+        assert False, 'expected a ValueError'
+
+def v1_word(ival):
+    return ''.join([chr((ival >> shift) & 0xff) for shift in (0, 8, 16, 24)])
+
+def v1_chunk(const_data):
+    """ A chunk of version 1 whose toplevel skeleton has no code and a
+        single constant.
+    """
+    return ''.join([chunkio.CHUNK_MAGIC, '-',
+                    v1_word(0), # codes
+                    v1_word(1), const_data,
+                    v1_word(0), # frame_size
+                    v1_word(0), v1_word(0), # cellvalues, fresh_cells
+                    v1_word(0), '\x00', '\n', # nb_args, varargs_p
+                    v1_word(0)]) # skeleton_registry
+
+def test_load_v1_long_list():
+    n = 100000
+    pieces = []
+    for i in xrange(n):
+        pieces.append(chunkio.K_PAIR + chunkio.K_FIXNUM + v1_word(i - 1))
+    pieces.append(chunkio.K_NULL)
+    w_root = chunkio.load_from_string(v1_chunk(''.join(pieces)))
+    w_list = w_root.consts[0]
+    for i in xrange(n):
+        assert w_list.car.to_string() == str(i - 1)
+        w_list = w_list.cdr
+    assert w_list.is_null()
+
+def test_load_v1_nested_cars():
+    n = 100000
+    data = (chunkio.K_PAIR * n + chunkio.K_SYMBOL + v1_word(1) + 'a' +
+            (chunkio.K_NULL * n))
+    w_obj = chunkio.load_from_string(v1_chunk(data)).consts[0]
+    for i in xrange(n):
+        assert w_obj.cdr.is_null()
+        w_obj = w_obj.car
+    assert w_obj.to_string() == 'a'
+
+def dump_program(source):
+    return chunkio.dump_to_string(compile_list_of_expr(parse_string(source)))
+
+def test_roundtrip():
+    data = dump_program("(define f (lambda (x) (cons x '(1 (2 . #t) foo))))"
+                        "(display (f (lambda () 0)))")
+    w_root = chunkio.load_from_string(data)
+    assert len(w_root.skeleton_registry) == 2
+    assert chunkio.dump_to_string(w_root) == data
+
+def test_checksum_of_skeleton_checked_when_decoded():
+    data = dump_program('(define f (lambda (x) (+ x 12345))) (display 1)')
+    # the constant 12345 is only in the skeleton of f
+    const = chunkio.ChunkWriter()
+    const.write(chunkio.K_FIXNUM)
+    chunkio.dump_varint(chunkio.zigzag(12345), const)
+    pos = data.index(const.getvalue()) + 1
+    corrupted = data[:pos] + chr(ord(data[pos]) ^ 2) + data[pos + 1:]
+    chunk = chunkio.LazyChunk(chunkio.ChunkReader(corrupted))
+    try:
+        chunk.load_skeleton(0)
+    except ValueError, e:
+        assert 'checksum' in str(e)
+    else:
+        assert False, 'expected a ValueError'
+
+def test_verify_all():
+    data = dump_program('(define f (lambda (x) (+ x 12345)))'
+                        '(define g (lambda () (f 1))) (display 1)')
+    chunk = chunkio.LazyChunk(chunkio.ChunkReader(data))
+    chunk.verify_all()
+    # a bit of any byte of code or constants, which are both before the
+    # section of skeletons
+    for pos in xrange(chunk.consts_start, chunk.skeletons_start):
+        corrupted = data[:pos] + chr(ord(data[pos]) ^ 16) + data[pos + 1:]
+        try:
+            # which raises already if the byte is the toplevel skeleton's
+            chunkio.LazyChunk(chunkio.ChunkReader(corrupted)).verify_all()
+        except ValueError:
+            pass
+        else:
+            assert False, 'expected a ValueError at %d' % pos
+
+def test_checksum_of_records():
+    data = dump_program('(display 1)')
+    # the last byte of the chunk is in the record of its only skeleton
+    corrupted = data[:-1] + chr(ord(data[-1]) ^ 1)
+    try:
+        chunkio.load_from_string(corrupted)
+    except ValueError, e:
+        assert 'checksum' in str(e)
+    else:
+        assert False, 'expected a ValueError'
+
+def test_operand_out_of_range():
+    for instr in [Branch(-1), MoveLocal(0, chunkio.MAX_OPERAND + 1)]:
+        try:
+            chunkio.dump_instr(instr, chunkio.ChunkWriter())
+        except ValueError, e:
+            assert 'operand out of range' in str(e)
+        else:
+            assert False, 'expected a ValueError'
+    stream = chunkio.ChunkWriter()
+    chunkio.dump_instr(MoveLocal(0, chunkio.MAX_OPERAND), stream)
+    instr = chunkio.load_instr(chunkio.ChunkReader(stream.getvalue()))
+    assert instr.B == chunkio.MAX_OPERAND
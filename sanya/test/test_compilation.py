@@ -0,0 +1,102 @@
+import os
+import tempfile
+
+import __pypy_path__
+from sanya import chunkio
+from sanya.compilation import CompilationSession, compile_list_of_expr
+from sanya.objectmodel import W_Fixnum, make_symbol, pylist2scm
+from sanya.parser import parse_string
+from sanya.stdlib import open_lib
+from sanya.test.support import run_targetscheme
+from sanya.vm import VM
+
+# deep enough for a compiler which recursed on the nesting to exceed the
+# recursion limit; the programs are built as objects, not parsed
+DEPTH = 1000
+
+def sym(name):
+    return make_symbol(name)
+
+def lst(*items_w):
+    return pylist2scm(list(items_w))
+
+def nested_lets(depth):
+    # (let ((x0 0)) (let ((x1 1)) ... (+ x0 x<depth-1>)))
+    w_expr = lst(sym('+'), sym('x0'), sym('x%d' % (depth - 1)))
+    for i in xrange(depth - 1, -1, -1):
+        w_binding = lst(sym('x%d' % i), W_Fixnum(i))
+        w_expr = lst(sym('let'), lst(w_binding), w_expr)
+    return w_expr
+
+def nested_applications(depth):
+    # (g (g ... (g 1)))
+    w_expr = W_Fixnum(1)
+    for i in xrange(depth):
+        w_expr = lst(sym('g'), w_expr)
+    return w_expr
+
+def nested_loops(depth):
+    # (let l0 ((i0 0)) (if (= i0 1) 0 (let l1 ((i1 0)) ... (l0 1))))
+    w_expr = lst(sym('l0'), W_Fixnum(1))
+    for i in xrange(depth - 1, -1, -1):
+        w_index = sym('i%d' % i)
+        w_test = lst(sym('='), w_index, W_Fixnum(1))
+        w_expr = lst(sym('let'), sym('l%d' % i),
+                     lst(lst(w_index, W_Fixnum(0))),
+                     lst(sym('if'), w_test, W_Fixnum(0), w_expr))
+    return w_expr
+
+def in_procedure(w_body):
+    w_lambda = lst(sym('lambda'), lst(sym('g')), w_body)
+    return lst(sym('define'), sym('f'), w_lambda)
+
+def run_program(program_w):
+    fd, path = tempfile.mkstemp(suffix='.scmc')
+    try:
+        os.write(fd, chunkio.dump_to_string(compile_list_of_expr(program_w)))
+        os.close(fd)
+        return run_targetscheme('-r', path)
+    finally:
+        os.remove(path)
+
+def run_repl(inputs):
+    """ Compile and run the inputs as the repl does, and return the
+        printed value of each.
+    """
+    vm = VM()
+    open_lib(vm)
+    session = CompilationSession()
+    results = []
+    for source in inputs:
+        vm.bootstrap(session.compile(parse_string(source)))
+        vm.run()
+        results.append(vm.exit_value.to_string())
+    return results
+
+def test_repl_rebinds_primitive():
+    results = run_repl(['(define f (lambda () (+ 1 2)))', '(f)',
+                        '(set! + -)', '(f)'])
+    assert results[1] == '3'
+    assert results[3] == '-1'
+
+def test_nested_lets():
+    compile_list_of_expr([in_procedure(nested_lets(DEPTH))])
+
+def test_nested_applications():
+    compile_list_of_expr([in_procedure(nested_applications(DEPTH))])
+
+def test_nested_lets_under_application():
+    w_body = lst(sym('g'), nested_lets(DEPTH))
+    compile_list_of_expr([in_procedure(w_body)])
+
+def test_long_let_star():
+    bindings_w = [lst(sym('x%d' % i), W_Fixnum(i)) for i in xrange(DEPTH)]
+    w_body = lst(sym('let*'), pylist2scm(bindings_w), sym('x0'))
+    compile_list_of_expr([in_procedure(w_body)])
+
+def test_nested_loops():
+    compile_list_of_expr([in_procedure(nested_loops(DEPTH // 4))])
+
+def test_run_nested_lets():
+    w_display = lst(sym('display'), nested_lets(DEPTH))
+    assert run_program([w_display]) == str(DEPTH - 1)
@@ -0,0 +1,21 @@
+import __pypy_path__
+from sanya.test.support import run_script
+
+def test_captured_define_after_call():
+    assert run_script('captured-define-after-call.scm') == '20'
+
+def test_captured_let_after_call():
+    assert run_script('captured-let-after-call.scm') == '20'
+
+def test_escaped_cellval():
+    assert run_script('escaped-cellval.scm') == '91011'
+    assert run_script('escaped-cellval-shared.scm') == '123210'
+
+def test_captured_define_ahead():
+    assert run_script('captured-define-ahead.scm') == '2040'
+
+def test_captured_let_closure():
+    assert run_script('captured-let-closure.scm') == '20'
+
+def test_define_in_operand():
+    assert run_script('define-in-operand.scm') == '56'
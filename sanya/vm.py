@@ -1,7 +1,10 @@
-from pypy.rlib.jit import hint, unroll_safe
-from sanya.closure import W_CellValue, CellValueNode
-from sanya.config import DEBUG
+from pypy.rlib.jit import hint, unroll_safe, dont_look_inside
+from sanya.closure import W_CellValue, W_GlobalCell, W_Closure
+from sanya.config import DEBUG, INITIAL_STACK_SIZE, INITIAL_CALL_DEPTH
+from sanya.instruction_set import (LoadGlobal, StoreGlobal, BranchBack,
+        inlined_primitive_names)
 from sanya.jit import jitdriver
+from sanya.objectmodel import w_nil, pylist2scm, make_symbol
 
 
 class HaltException(Exception):
@@ -9,110 +12,406 @@ class HaltException(Exception):
     """
     pass
 
-class Dump(object):
-    _immutable_ = True
-    def __init__(self, vm):
-        self.frame = vm.frame
+class CallInfo(object):
+    """ Saved state of a suspended caller. The vm keeps a growable array of
+        them indexed by the call depth. Calling and returning only moves the
+        depth, and the records are reused by later calls.
+    """
+    def __init__(self):
+        self.base = 0
+        self.frame_size = 0
+        self.consts = None
+        self.global_cells = None
+        self.cellvalues = None
+        self.fresh_cells = None
+        self.codes = None
+        self.pc = 0
+        self.return_addr = 0
+        self.captured_p = False
+
+    def save(self, vm):
+        self.base = vm.base
+        self.frame_size = vm.frame_size
         self.consts = vm.consts
+        self.global_cells = vm.global_cells
         self.cellvalues = vm.cellvalues
         self.fresh_cells = vm.fresh_cells
         self.codes = vm.codes
         self.pc = vm.pc
         self.return_addr = vm.return_addr
-        self.dump = vm.dump
+        self.captured_p = vm.captured_p
 
     def restore(self, vm):
-        vm.frame = self.frame
+        vm.base = self.base
+        vm.frame_size = self.frame_size
         vm.consts = self.consts
+        vm.global_cells = self.global_cells
         vm.cellvalues = self.cellvalues
         vm.fresh_cells = self.fresh_cells
         vm.codes = self.codes
         vm.pc = self.pc
         vm.return_addr = self.return_addr
-        vm.dump = self.dump
+        vm.captured_p = self.captured_p
+
 
+# shared by the frames that have no captured locals
+no_fresh_cells = []
+# shared by the closures that capture nothing
+no_cellvalues = []
 
 class VM(object):
     _immutable_fields_ = ['globalvars']
-    _virtualizable2_ = ['frame', 'consts', 'cellvalues', 'fresh_cells',
-                        'codes', 'pc', 'return_addr', 'dump',
-                        'cellval_head', 'skeleton_registry']
+    _virtualizable2_ = ['stack', 'base', 'frame_size', 'consts',
+                        'global_cells', 'cellvalues', 'fresh_cells', 'codes',
+                        'pc', 'return_addr', 'captured_p', 'callinfo',
+                        'depth', 'open_cells', 'skeleton_registry']
     def __init__(self):
         self = hint(self, promote=True, access_directly=True,
                     fresh_virtualizable=True)
         self.reboot()
 
     def reboot(self):
-        # current local status
-        self.frame = None
+        # current local status. All the frames live in one register stack,
+        # and the running closure's frame starts at stack[base].
+        self.stack = []
+        self.base = 0
+        self.frame_size = 0
         self.consts = []
+        self.global_cells = []
         self.cellvalues = []
         self.fresh_cells = []
-        self.globalvars = {}
+        self.globalvars = {} # maps w_symbol to its W_GlobalCell
+        # binding cells of the primitives that the compiler inlines,
+        # @see instruction_set.ArithInstr
+        self.prim_cells = [self.get_global_cell(make_symbol(name))
+                           for name in inlined_primitive_names]
         self.codes = []
         self.pc = 0
         self.return_addr = 0
-        self.dump = None
+        # whether the running frame may have open cellvalues,
+        # @see closure.W_Skeleton.captured_p
+        self.captured_p = False
         self.exit_value = None # the toplevel return value
 
-        # cellvalues are stored in a doubly-linkedlist since they birth and die
-        # quickly and d-list allow O(1) insertion/deletion.
+        # open cellvalues are chained through W_CellValue.next_open and kept
+        # sorted by stack index, highest first. The cells of the running
+        # frame are therefore always at the head of the list.
         # ``hao ba zhe shi chao xi Lua-5.1 de....``
-        self.cellval_head = CellValueNode(None, None, None)
-        self.cellval_head.nextnode = self.cellval_head
-        self.cellval_head.prevnode = self.cellval_head
+        self.open_cells = None
         self.skeleton_registry = []
+        # skeleton_registry[:nb_linked_skeletons] are linked already
+        self.nb_linked_skeletons = 0
+        # decodes the skeletons that are still None in skeleton_registry,
+        # @see load_skeleton
+        self.skeleton_loader = None
 
-    def new_frame(self, size):
-        return [None] * size
+        # saved states of the suspended callers, @see CallInfo
+        self.callinfo = [CallInfo() for i in xrange(INITIAL_CALL_DEPTH)]
+        self.depth = 0
+
+    def ensure_stack(self, size):
+        """ Grow the register stack so that it has at least ``size`` slots.
+            The stack is extended in place since open cellvalues keep a
+            reference to it.
+        """
+        stacksize = len(self.stack)
+        if stacksize < size:
+            newsize = stacksize * 2
+            if newsize < size:
+                newsize = size
+            self.stack.extend([None] * (newsize - stacksize))
 
     def bootstrap(self, w_skel):
         assert w_skel.is_procedure_skeleton()
-        newsize = w_skel.frame_size
-        if self.frame is None:
-            self.frame = self.new_frame(newsize)
+        if w_skel.frame_size > INITIAL_STACK_SIZE:
+            self.ensure_stack(w_skel.frame_size)
         else:
-            if len(self.frame) < newsize:
-                self.frame.extend([None] * (newsize - len(self.frame)))
+            self.ensure_stack(INITIAL_STACK_SIZE)
+        self.base = 0
+        self.frame_size = w_skel.frame_size
         self.pc = 0
-        self.consts = w_skel.consts
         self.codes = w_skel.codes
+        self.captured_p = w_skel.captured_p
 
-        # since toplevel variables are all globals, we dont have to bother
-        # with cellvalues-related things
+        # toplevel variables are globals, but the let forms and the lambdas
+        # that the compiler inlined may leave captured locals.
+        self.cellvalues = no_cellvalues
+        if w_skel.captured_p:
+            self.make_fresh_cells(w_skel)
+        else:
+            self.fresh_cells = no_fresh_cells
 
-        # load the skeleton table and clean up
-        self.skeleton_registry = w_skel.skeleton_registry
+        # load the skeleton table and clean up. The inputs of a
+        # CompilationSession share theirs, of which only the new skeletons
+        # need to be linked.
+        if w_skel.skeleton_registry is not self.skeleton_registry:
+            self.skeleton_registry = w_skel.skeleton_registry
+            self.nb_linked_skeletons = 0
+            self.skeleton_loader = None
         w_skel.skeleton_registry = None
 
+        # resolve global variables to their binding cells. The skeletons
+        # yet to be decoded are linked then.
+        self.link_skeleton(w_skel)
+        registry = self.skeleton_registry
+        for i in xrange(self.nb_linked_skeletons, len(registry)):
+            if registry[i] is not None:
+                self.link_skeleton(registry[i])
+        self.nb_linked_skeletons = len(registry)
+        self.consts = w_skel.consts
+        self.global_cells = w_skel.global_cells
+
+    def bootstrap_chunk(self, chunk):
+        """ Bootstrap the toplevel skeleton of chunk, a chunkio.LazyChunk
+            whose other skeletons are decoded when first needed.
+        """
+        self.bootstrap(chunk.w_root)
+        self.skeleton_loader = chunk
+
+    def get_skeleton(self, index):
+        w_skel = self.skeleton_registry[index]
+        if w_skel is None:
+            w_skel = self.load_skeleton(index)
+        return w_skel
+
+    @dont_look_inside
+    def load_skeleton(self, index):
+        """ Decode and link skeleton_registry[index], which was left to the
+            first instruction that refers to it.
+        """
+        assert self.skeleton_loader is not None, 'skeleton not loaded'
+        w_skel = self.skeleton_loader.load_skeleton(index)
+        self.link_skeleton(w_skel)
+        self.skeleton_registry[index] = w_skel
+        return w_skel
+
+    def get_global_cell(self, w_symbol):
+        """ Return the binding cell of the global w_symbol, creating an
+            unbound one if it's not defined yet.
+        """
+        w_cell = self.globalvars.get(w_symbol, None)
+        if w_cell is None:
+            w_cell = self.globalvars[w_symbol] = W_GlobalCell(w_symbol)
+        return w_cell
+
+    def link_skeleton(self, w_skel):
+        """ Resolve the global names used by w_skel's LoadGlobal and
+            StoreGlobal to binding cells, so that they become field reads
+            and writes, and undo quickening. Globals which are defined later
+            (e.g., by another line in the repl) get an unbound cell which is
+            filled in then.
+        """
+        global_cells = [None] * len(w_skel.consts)
+        codes = w_skel.codes
+        for i in xrange(len(codes)):
+            # quickened instructions may hold the cells of another link
+            instr = codes[i] = codes[i].generic()
+            if isinstance(instr, LoadGlobal):
+                const_index = instr.B
+            elif isinstance(instr, StoreGlobal):
+                const_index = instr.A
+            else:
+                continue
+            if global_cells[const_index] is None:
+                global_cells[const_index] = self.get_global_cell(
+                        w_skel.consts[const_index])
+        w_skel.global_cells = global_cells
+
     def halt(self):
         raise HaltException
 
-    def save_dump(self):
-        self.dump = Dump(self)
+    def save_callinfo(self):
+        depth = self.depth
+        if depth == len(self.callinfo):
+            self.callinfo.extend([CallInfo() for i in xrange(depth)])
+        self.callinfo[depth].save(self)
+        self.depth = depth + 1
 
-    def restore_dump(self, return_value):
-        self.escape_cellvalues()
-        if self.dump is not None:
+    def restore_callinfo(self, return_value):
+        if self.captured_p:
+            self.escape_cellvalues()
+        if self.depth > 0:
             return_addr = self.return_addr
-            self.dump.restore(self)
-            self.frame[return_addr] = return_value
+            self.depth -= 1
+            self.callinfo[self.depth].restore(self)
+            self.stack[self.base + return_addr] = return_value
         else: # top-level return
             self.exit_value = return_value
             self.halt()
 
+    @unroll_safe
+    def enter_closure(self, w_proc, new_base, actual_argcount):
+        """ Switch the vm to w_proc, whose frame starts at stack[new_base].
+            The caller has already placed the arguments at the bottom of
+            the new frame, so nothing but the varargs needs to be moved.
+        """
+        self.enter_skeleton(w_proc.skeleton, w_proc.cellvalues, new_base,
+                            actual_argcount)
+
+    def enter_skeleton(self, w_skel, cellvalues, new_base, actual_argcount):
+        """ enter_closure, for the closure of w_skel with cellvalues.
+        """
+        self.ensure_stack(new_base + w_skel.frame_size)
+        self.pack_varargs(w_skel, new_base, actual_argcount)
+        self.enter_frame(w_skel, cellvalues, new_base)
+
+    def enter_closure_exact(self, w_proc, new_base):
+        """ enter_closure, for a call passing exactly nb_args arguments to
+            a closure without varargs.
+        """
+        w_skel = w_proc.skeleton
+        self.ensure_stack(new_base + w_skel.frame_size)
+        self.enter_frame(w_skel, w_proc.cellvalues, new_base)
+
+    def enter_frame(self, w_skel, cellvalues, new_base):
+        self.base = new_base
+        self.frame_size = w_skel.frame_size
+        self.consts = w_skel.consts
+        self.global_cells = w_skel.global_cells
+        self.cellvalues = cellvalues
+        self.captured_p = w_skel.captured_p
+        if w_skel.captured_p:
+            self.make_fresh_cells(w_skel)
+        else:
+            self.fresh_cells = no_fresh_cells
+
+        self.codes = w_skel.codes
+        self.pc = 0
+
+    def reenter_closure(self, w_skel, cellvalues, actual_argcount):
+        """ Restart the current frame with the closure of w_skel with
+            cellvalues, where w_skel is the running skeleton. The caller
+            has already placed the arguments at the bottom of the frame.
+            Everything that only depends on the skeleton (frame size,
+            consts, codes...) is kept as it is.
+        """
+        self.pack_varargs(w_skel, self.base, actual_argcount)
+        self.cellvalues = cellvalues
+        if w_skel.captured_p:
+            self.make_fresh_cells(w_skel)
+        self.pc = 0
+
+    @unroll_safe
+    def pack_varargs(self, w_skel, new_base, actual_argcount):
+        """ Check the argument count of a call to w_skel, and pack the
+            extra arguments to the vararg slot if it accepts varargs.
+        """
+        assert w_skel.nb_args <= actual_argcount
+
+        if w_skel.nb_args < actual_argcount:
+            assert w_skel.varargs_p
+            # vararg is slowish.
+            vararg = pylist2scm([self.stack[new_base + i] for i in
+                                 xrange(w_skel.nb_args, actual_argcount)])
+        else:
+            vararg = w_nil
+
+        if w_skel.varargs_p:
+            self.stack[new_base + w_skel.nb_args] = vararg
+
+    def make_fresh_cells(self, w_skel):
+        """ Make room for the cellvalues of w_skel's captured locals, which
+            are built as their bindings are, @see open_fresh_cell
+        """
+        self.fresh_cells = [None] * len(w_skel.fresh_cells)
+
+    def open_fresh_cell(self, shadow_id, frameindex):
+        """ Build the cellvalue of the captured local at
+            stack[base + frameindex], whose binding is being created, and
+            open it. Until then, the slot may be part of a callee's frame,
+            which must not escape the cellvalue when it returns.
+        """
+        w_cellvalue = W_CellValue(self.stack, self.base + frameindex)
+        self.fresh_cells[shadow_id] = w_cellvalue
+        self.open_cellvalue(w_cellvalue)
+
+    def known_cellvalues(self, w_skel, proc_reg):
+        """ Return the cellvalues of the closure of w_skel that a CallKnown
+            calls. For a call to the running skeleton, that's the running
+            closure, otherwise the compiler has loaded it to proc_reg.
+            @see instruction_set.CallKnown
+        """
+        if w_skel.codes is self.codes:
+            return self.cellvalues
+        elif len(w_skel.cell_recipt) == 0:
+            return no_cellvalues
+        w_proc = self.stack[self.base + proc_reg]
+        assert isinstance(w_proc, W_Closure)
+        return w_proc.cellvalues
+
+    def call_pyproc(self, w_proc, index_of_first_arg, actual_argcount):
+        """ Call the python procedure w_proc with the arguments in
+            stack[index_of_first_arg:index_of_first_arg+actual_argcount].
+            Up to three arguments are passed without building a list,
+            @see objectmodel.W_PyProc
+        """
+        stack = self.stack
+        if actual_argcount == 0:
+            return w_proc.call0()
+        elif actual_argcount == 1:
+            return w_proc.call1(stack[index_of_first_arg])
+        elif actual_argcount == 2:
+            return w_proc.call2(stack[index_of_first_arg],
+                                stack[index_of_first_arg + 1])
+        elif actual_argcount == 3:
+            return w_proc.call3(stack[index_of_first_arg],
+                                stack[index_of_first_arg + 1],
+                                stack[index_of_first_arg + 2])
+        else:
+            return w_proc.py_call([stack[index_of_first_arg + i]
+                                   for i in xrange(actual_argcount)])
+
+    @unroll_safe
+    def apply_procedure(self, dest_reg, w_proc, args_w):
+        """ Call w_proc with args_w and have the result stored to dest_reg.
+            Unlike Call, the arguments don't need to be on the stack. A
+            closure's frame is placed right above the current one.
+        """
+        if w_proc.is_pyproc():
+            self.stack[self.base + dest_reg] = w_proc.call_with_list(args_w)
+            return
+
+        assert isinstance(w_proc, W_Closure)
+        new_base = self.base + self.frame_size
+        self.ensure_stack(new_base + len(args_w))
+        for i in xrange(len(args_w)):
+            self.stack[new_base + i] = args_w[i]
+        self.save_callinfo()
+        self.return_addr = dest_reg
+        self.enter_closure(w_proc, new_base, len(args_w))
+
+    def open_cellvalue(self, w_cellvalue):
+        """ Insert w_cellvalue into the sorted open cellvalue list. New cells
+            belong to the newest frame, so this stops at the head almost
+            always.
+        """
+        stackindex = w_cellvalue.stackindex
+        prev_cell = None
+        next_cell = self.open_cells
+        while next_cell is not None and next_cell.stackindex > stackindex:
+            prev_cell = next_cell
+            next_cell = next_cell.next_open
+        w_cellvalue.next_open = next_cell
+        if prev_cell is None:
+            self.open_cells = w_cellvalue
+        else:
+            prev_cell.next_open = w_cellvalue
+
     @unroll_safe
     def escape_cellvalues(self):
-        frame = self.frame
-        dummy_node = self.cellval_head
-        iter_node = dummy_node.nextnode
-        while iter_node is not dummy_node:
-            cellval = iter_node.val
-            assert isinstance(cellval, W_CellValue)
-            if cellval.try_escape(frame):
-                iter_node = iter_node.remove() # returns next node
-            else:
-                iter_node = iter_node.nextnode
+        """ Escape the cellvalues that point into the current frame,
+            which is about to be discarded. They sit at the head of the
+            open cellvalue list, so cells of the frames below are never
+            visited and a frame without captured locals costs one check.
+        """
+        base = self.base
+        w_cellvalue = self.open_cells
+        while w_cellvalue is not None and w_cellvalue.stackindex >= base:
+            w_cellvalue.escape()
+            next_cell = w_cellvalue.next_open
+            w_cellvalue.next_open = None
+            w_cellvalue = next_cell
+        self.open_cells = w_cellvalue
 
     @unroll_safe
     def run(self):
@@ -126,6 +425,10 @@ class VM(object):
                     print self
                 self.pc += 1
                 instr.dispatch(self)
+                if isinstance(instr, BranchBack):
+                    # the head of a loop within this skeleton
+                    jitdriver.can_enter_jit(pc=self.pc, codes=self.codes,
+                                            vm=self)
         except HaltException:
             return
 
@@ -5,8 +5,8 @@ import __pypy_path__
 from pypy.rlib.objectmodel import we_are_translated
 from pypy.rlib.streamio import fdopen_as_stream, open_file_as_stream
 
-from sanya import chunkio
-from sanya.compilation import compile_list_of_expr
+from sanya import chunkio, chunkcache
+from sanya.compilation import compile_list_of_expr, CompilationSession
 from sanya.config import DEBUG
 from sanya.objectmodel import w_unspecified
 from sanya.parser import parse_string
@@ -21,17 +21,32 @@ def jitpolicy(driver):
     from pypy.jit.codewriter.policy import JitPolicy
     return JitPolicy()
 
-def filename_to_expr_list(filename):
+def read_file(filename):
     stream = open_file_as_stream(filename, 'r')
     content = stream.readall()
-    expr_list = parse_string(content)
     stream.close()
-    return expr_list
+    return content
+
+def filename_to_expr_list(filename):
+    return parse_string(read_file(filename))
 
 def run_file(filename):
+    """ Run the file, whose compiled chunk is cached, @see chunkcache
+    """
     vm = VM()
     open_lib(vm)
-    vm.bootstrap(compile_list_of_expr(filename_to_expr_list(filename)))
+    source = read_file(filename)
+    cache = chunkcache.default_cache()
+    chunk = None
+    if cache is not None:
+        chunk = cache.lookup(source)
+    if chunk is not None:
+        vm.bootstrap_chunk(chunk)
+    else:
+        w_skel = compile_list_of_expr(parse_string(source))
+        if cache is not None:
+            cache.store(source, w_skel)
+        vm.bootstrap(w_skel)
     vm.run()
 
 def disassemble_file(filename):
@@ -64,10 +79,9 @@ def compile_file(filename, outfname):
 def load_compiled_chunk(filename):
     vm = VM()
     open_lib(vm)
-    stream = open_file_as_stream(filename, 'r')
-    w_skel = chunkio.load(stream)
-    stream.close()
-    vm.bootstrap(w_skel)
+    chunk = chunkio.open_chunk(filename)
+    chunk.verify_all() # rather than fail when the skeleton is first run
+    vm.bootstrap_chunk(chunk)
     vm.run()
 
 def repl():
@@ -75,6 +89,7 @@ def repl():
     stdout = fdopen_as_stream(1, 'a')
     vm = VM()
     open_lib(vm)
+    session = CompilationSession()
 
     while True:
         if we_are_translated():
@@ -100,7 +115,7 @@ def repl():
         if not expr_list:
             continue # handle whitespace in RPy
 
-        w_skel = compile_list_of_expr(expr_list)
+        w_skel = session.compile(expr_list)
         # some hack so as to not return the vm?
 
         # to view code
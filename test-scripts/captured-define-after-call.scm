@@ -0,0 +1,15 @@
+; q is bound after the call to g, in a slot that was part of g's frame.
+; g's return must not escape the cellvalue of q.
+(define g
+  (lambda ()
+    (define y 1)
+    (lambda () y)))
+
+(define f
+  (lambda (a)
+    (g)
+    (define p 10)
+    (define q 20)
+    (lambda () q)))
+
+(display ((f 0)))
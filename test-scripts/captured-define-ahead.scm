@@ -0,0 +1,25 @@
+; the lambdas refer to q before it is defined, after the call to g.
+(define g
+  (lambda ()
+    (define y 1)
+    (lambda () y)))
+
+(define f
+  (lambda (a)
+    (define get-q (lambda () q))
+    (g)
+    (define p 10)
+    (define q 20)
+    get-q))
+
+(define h
+  (lambda (a)
+    (let ((b 0))
+      (define get-q (lambda () q))
+      (g)
+      (define p 30)
+      (define q 40)
+      get-q)))
+
+(display ((f 0)))
+(display ((h 0)))
@@ -0,0 +1,13 @@
+; the same as captured-define-after-call.scm, with q bound by a let.
+(define g
+  (lambda ()
+    (define y 1)
+    (lambda () y)))
+
+(define f
+  (lambda (a)
+    (g)
+    (let ((p 10) (q 20))
+      (lambda () q))))
+
+(display ((f 0)))
@@ -0,0 +1,12 @@
+; the loop of the named let is a closure that refers to q, so q's slot is
+; not given back at the end of the let, and d doesn't overwrite it.
+(define f
+  (lambda ()
+    (define c
+      (let ((q 20))
+        (let loop ((i 0))
+          (if (= i 0) loop q))))
+    (define d 99)
+    (c 1)))
+
+(display (f))
@@ -0,0 +1,14 @@
+; the defines in the operands of an application bind locals of the lambda,
+; whose slots are reserved below the application's, and so w outlives the
+; calls.
+(define f (lambda (x) x))
+(define g (lambda (x y) x))
+(define h (lambda (n) (f (if n (begin (define w 5) w) 6))))
+(define k
+  (lambda (n)
+    (g (begin (define w (+ n 5)) w) (g n n))
+    (g 7 (g 8 9))
+    w))
+
+(display (h #t))
+(display (k 1))